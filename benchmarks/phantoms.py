@@ -0,0 +1,122 @@
+"""
+phantoms
+
+Synthetic T1 phantoms, atlas, priors and design files for the nipypeVBM benchmarks
+
+Each phantom is a set of nested ellipsoids (WM, GM, CSF and a skull shell) with soft
+tissue boundaries. Subjects differ by random radii, position and noise.
+"""
+import os
+
+import nibabel as nib
+import numpy as np
+
+VOXEL_SIZE = 2.0
+
+# Normalised radii of the outer boundary of each tissue
+_WM_RADIUS = 0.55
+_GM_RADIUS = 0.8
+_CSF_RADIUS = 0.9
+_SKULL_RADIUS = (0.93, 1.0)
+_EDGE_WIDTH = 0.03
+
+
+def _affine(size):
+    affine = np.diag([VOXEL_SIZE, VOXEL_SIZE, VOXEL_SIZE, 1.0])
+    affine[:3, 3] = -VOXEL_SIZE * (size - 1) / 2
+    return affine
+
+
+def _radius(size, scale=(1.0, 1.0, 1.0), shift=(0.0, 0.0, 0.0)):
+    axes = [(np.arange(size, dtype=np.float32) - (size - 1) / 2) / (0.45 * size) for _ in range(3)]
+    x, y, z = np.meshgrid(*axes, indexing='ij')
+    return np.sqrt(((x - shift[0]) / (0.8 * scale[0])) ** 2 + ((y - shift[1]) / scale[1]) ** 2
+                   + ((z - shift[2]) / (0.9 * scale[2])) ** 2)
+
+
+def _inside(radius, boundary):
+    return 1 / (1 + np.exp((radius - boundary) / _EDGE_WIDTH))
+
+
+def tissue_probabilities(radius):
+    """CSF, GM and WM probability maps of a phantom, stacked along the last axis"""
+    wm = _inside(radius, _WM_RADIUS)
+    gm = _inside(radius, _GM_RADIUS) - wm
+    csf = _inside(radius, _CSF_RADIUS) - wm - gm
+    return np.stack([csf, gm, wm], axis=-1).astype(np.float32)
+
+
+def _t1(radius, noise=0.0, rng=None):
+    csf, gm, wm = np.moveaxis(tissue_probabilities(radius), -1, 0)
+    skull = _inside(radius, _SKULL_RADIUS[1]) - _inside(radius, _SKULL_RADIUS[0])
+    t1 = 0.2 * csf + 0.6 * gm + 1.0 * wm + 0.3 * skull
+    if noise:
+        t1 += rng.normal(0, noise, t1.shape).astype(np.float32)
+    return np.clip(t1, 0, None).astype(np.float32)
+
+
+def make_subjects(out_dir, size, num_subjects, seed=0):
+    """Write num_subjects noisy T1 phantoms of size^3 voxels, returning their paths"""
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    struct_files = []
+    for i in range(num_subjects):
+        radius = _radius(size, scale=rng.uniform(0.9, 1.1, 3), shift=rng.uniform(-0.03, 0.03, 3))
+        struct_file = os.path.join(out_dir, 'sub%03d_T1.nii.gz' % i)
+        nib.Nifti1Image(_t1(radius, 0.03, rng), _affine(size)).to_filename(struct_file)
+        struct_files.append(struct_file)
+    return struct_files
+
+
+def make_atlas(out_dir, size):
+    """Write a noiseless masked atlas T1, its 4D CSF/GM/WM priors and a GM template
+
+    Returns the paths of the atlas image, the priors and the GM template.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    radius = _radius(size)
+    priors = tissue_probabilities(radius)
+    brain = _inside(radius, _CSF_RADIUS)
+
+    atlas_image = os.path.join(out_dir, 'atlas_t1_masked.nii.gz')
+    atlas_priors = os.path.join(out_dir, 'atlas_priors.nii.gz')
+    gm_template = os.path.join(out_dir, 'GM_template.nii.gz')
+    nib.Nifti1Image(_t1(radius) * brain, _affine(size)).to_filename(atlas_image)
+    nib.Nifti1Image(priors, _affine(size)).to_filename(atlas_priors)
+    nib.Nifti1Image(priors[..., 1], _affine(size)).to_filename(gm_template)
+    return atlas_image, atlas_priors, gm_template
+
+
+def make_design(out_dir, num_subjects):
+    """Write a two-group FSL design matrix and a group difference contrast"""
+    os.makedirs(out_dir, exist_ok=True)
+    design_mat = os.path.join(out_dir, 'design.mat')
+    design_con = os.path.join(out_dir, 'design.con')
+    with open(design_mat, 'w') as fileobj:
+        fileobj.write('/NumWaves 2\n/NumPoints %d\n/Matrix\n' % num_subjects)
+        for i in range(num_subjects):
+            fileobj.write('1 0\n' if i % 2 == 0 else '0 1\n')
+    with open(design_con, 'w') as fileobj:
+        fileobj.write('/NumWaves 2\n/NumContrasts 1\n/Matrix\n1 -1\n')
+    return design_mat, design_con
+
+
+def make_stacks(out_dir, size, num_subjects, seed=0):
+    """Write warped-GM-like 3D images and the same volumes as one 4D image, for GenerateTemplate
+
+    Returns the 3D paths and the 4D path.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    gm_files = []
+    volumes = []
+    for i in range(num_subjects):
+        radius = _radius(size, scale=rng.uniform(0.95, 1.05, 3))
+        gm = tissue_probabilities(radius)[..., 1]
+        gm_file = os.path.join(out_dir, 'gm%03d.nii.gz' % i)
+        nib.Nifti1Image(gm, _affine(size)).to_filename(gm_file)
+        gm_files.append(gm_file)
+        volumes.append(gm)
+    gm_4d_file = os.path.join(out_dir, 'gm_4d.nii.gz')
+    nib.Nifti1Image(np.stack(volumes, axis=-1), _affine(size)).to_filename(gm_4d_file)
+    return gm_files, gm_4d_file
@@ -0,0 +1,201 @@
+#! /usr/bin/env python
+"""
+run_benchmarks
+
+Benchmark the nipypeVBM interfaces and workflows on synthetic phantoms, without network access
+
+The in-house interfaces (GenerateTemplate, GeneratePriors) are timed in isolation over a
+grid of image sizes and cohort counts, with the tracemalloc peak as their memory. The bet,
+preproc and proc workflows are then run end to end on a phantom cohort, with the FSL and
+ANTs commands replaced by the stand-ins of standins.py unless --real-tools is given, and
+profiled per node. Everything is written to one JSON file; --compare prints the change
+against a previous results file.
+
+    python benchmarks/run_benchmarks.py -o results.json --sizes 32 64 --cohorts 4 16
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import phantoms
+import standins
+from nipypeVBM.execution import add_execution_arguments, cohort_resources, run_workflow, workflow_outputs
+from nipypeVBM.interfaces import GenerateTemplate, GeneratePriors
+from nipypeVBM.workflows import INTERMEDIATE_FORMATS, create_bet_workflow, create_preproc_workflow, \
+    create_proc_workflow
+
+
+def _measure(interface, cwd, repeat):
+    """Best wall time and tracemalloc peak of running an interface repeat times in cwd"""
+    times = []
+    peaks = []
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        interface.run(cwd=cwd)
+        times.append(time.perf_counter() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return {'wall_time_s': min(times), 'peak_traced_mb': max(peaks) / 2 ** 20}
+
+
+def benchmark_interfaces(work_dir, sizes, cohorts, repeat):
+    results = []
+    for size in sizes:
+        atlas_image, atlas_priors, _ = phantoms.make_atlas(os.path.join(work_dir, 'atlas%d' % size), size)
+        run_dir = os.path.join(work_dir, 'run')
+        os.makedirs(run_dir, exist_ok=True)
+        results.append(dict(interface='GeneratePriors', size=size, num_subjects=1,
+                            **_measure(GeneratePriors(reference_file=atlas_image, prior_4D_file=atlas_priors),
+                                       run_dir, repeat)))
+
+        for num_subjects in cohorts:
+            stack_dir = os.path.join(work_dir, 'stacks%d_%d' % (size, num_subjects))
+            gm_files, gm_4d_file = phantoms.make_stacks(stack_dir, size, num_subjects)
+            results.append(dict(interface='GenerateTemplate', layout='3D files', size=size,
+                                num_subjects=num_subjects,
+                                **_measure(GenerateTemplate(input_files=gm_files), run_dir, repeat)))
+            results.append(dict(interface='GenerateTemplate', layout='4D file', size=size,
+                                num_subjects=num_subjects,
+                                **_measure(GenerateTemplate(input_file=gm_4d_file), run_dir, repeat)))
+            shutil.rmtree(stack_dir)
+            print('interfaces: size %d, %d subjects done' % (size, num_subjects))
+    return results
+
+
+def _run_profiled(wf, args, work_dir):
+    args.profile = os.path.join(work_dir, 'profile_' + wf.name)
+    start = time.perf_counter()
+    exec_graph = run_workflow(wf, args)
+    wall_time = time.perf_counter() - start
+    with open(os.path.join(args.profile, 'profile.json')) as fileobj:
+        hotspots = json.load(fileobj)['hotspots']
+    return exec_graph, {'workflow': wf.name, 'wall_time_s': wall_time, 'nodes': hotspots}
+
+
+def benchmark_workflows(work_dir, size, num_subjects, num_perm, args):
+    """Run the bet, preproc and proc workflows in turn on a phantom cohort"""
+    atlas_image, atlas_priors, gm_template = phantoms.make_atlas(os.path.join(work_dir, 'atlas'), size)
+    struct_files = phantoms.make_subjects(os.path.join(work_dir, 'subjects'), size, num_subjects)
+    design_mat, tcon = phantoms.make_design(os.path.join(work_dir, 'design'), num_subjects)
+    output_root = os.path.join(work_dir, 'output')
+    resources = cohort_resources(args, num_subjects, struct_files[0])
+    results = []
+
+    wf = create_bet_workflow(output_root, args.intermediate_format, resources)
+    wf.inputs.input_node.struct_files = struct_files
+    exec_graph, result = _run_profiled(wf, args, work_dir)
+    results.append(result)
+    bet_outputs = workflow_outputs(wf, exec_graph, 'fslvbm_1_bet')
+
+    wf = create_preproc_workflow(output_root, registration_profile=args.registration_profile,
+                                 atlas_image=atlas_image, atlas_priors=atlas_priors,
+                                 intermediate_format=args.intermediate_format, resources=resources)
+    wf.inputs.input_node.brain_files = bet_outputs['brain_files']
+    wf.inputs.input_node.mask_files = bet_outputs['mask_files']
+    wf.inputs.input_node.GM_template = gm_template
+    exec_graph, result = _run_profiled(wf, args, work_dir)
+    results.append(result)
+    preproc_outputs = workflow_outputs(wf, exec_graph, 'fslvbm_2_template')
+
+    wf = create_proc_workflow(output_root, args.sigma, 0 if args.intermediate_format == 'NIFTI' else 1,
+                              registration_profile=args.registration_profile,
+                              randomise_shards=args.randomise_shards, num_perm=num_perm,
+                              intermediate_format=args.intermediate_format, resources=resources)
+    wf.inputs.input_node.GM_files = preproc_outputs['GM_files']
+    wf.inputs.input_node.GM_template = preproc_outputs['GM_template']
+    wf.inputs.input_node.design_mat = design_mat
+    wf.inputs.input_node.tcon = tcon
+    _, result = _run_profiled(wf, args, work_dir)
+    results.append(result)
+
+    for result in results:
+        print('%s: %.1f s' % (result['workflow'], result['wall_time_s']))
+    return results
+
+
+def _environment(real_tools):
+    import nibabel
+    import nipype
+    import numpy
+    import scipy
+
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+            'numpy': numpy.__version__, 'scipy': scipy.__version__, 'nibabel': nibabel.__version__,
+            'nipype': nipype.__version__, 'tools': 'real' if real_tools else 'standins'}
+
+
+def _key(result):
+    return tuple((k, result[k]) for k in ('interface', 'layout', 'size', 'num_subjects', 'workflow')
+                 if k in result)
+
+
+def compare(results, previous):
+    """Print the relative change of every wall time and memory peak found in both results"""
+    previous_results = {_key(r): r for r in previous['interfaces'] + previous['workflows']}
+    for result in results['interfaces'] + results['workflows']:
+        old = previous_results.get(_key(result))
+        if old is None:
+            continue
+        name = ', '.join(str(v) for _, v in _key(result))
+        for metric in ('wall_time_s', 'peak_traced_mb'):
+            if metric in result and old.get(metric):
+                print('%-50s %-15s %10.3f -> %10.3f (%+.1f%%)'
+                      % (name, metric, old[metric], result[metric], 100 * (result[metric] / old[metric] - 1)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output-file', type=str, default='benchmark_results.json')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[32, 64, 96],
+                        help='grid sizes (voxels per side) of the interface benchmarks')
+    parser.add_argument('--cohorts', nargs='+', type=int, default=[4, 16, 64],
+                        help='cohort counts of the GenerateTemplate benchmarks')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workflow-size', type=int, default=32,
+                        help='grid size of the end-to-end phantoms, 0 to skip the workflows')
+    parser.add_argument('--workflow-subjects', type=int, default=6)
+    parser.add_argument('--num-perm', type=int, default=100, help='randomise permutations of the proc workflow')
+    parser.add_argument('-s', '--sigma', nargs='+', type=float, default=[2])
+    parser.add_argument('--registration-profile', type=str, default='default')
+    parser.add_argument('--randomise-shards', type=int, default=1)
+    parser.add_argument('--intermediate-format', type=str, default='NIFTI_GZ', choices=INTERMEDIATE_FORMATS)
+    parser.add_argument('--real-tools', action='store_true',
+                        help='use the FSL and ANTs found on PATH instead of the stand-ins')
+    parser.add_argument('--work-dir', type=str, default=None, help='keep the intermediate files here')
+    parser.add_argument('--compare', type=str, default=None, help='previous results file to compare with')
+    add_execution_arguments(parser)
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='nipypevbm_bench_')
+    work_dir = os.path.abspath(os.path.expanduser(work_dir))
+    os.makedirs(work_dir, exist_ok=True)
+    if not args.real_tools:
+        os.environ.update(standins.install(os.path.join(work_dir, 'standins')))
+
+    results = {'environment': _environment(args.real_tools), 'arguments': vars(args).copy(),
+               'interfaces': benchmark_interfaces(os.path.join(work_dir, 'interfaces'), args.sizes, args.cohorts,
+                                                  args.repeat),
+               'workflows': []}
+    if args.workflow_size:
+        results['workflows'] = benchmark_workflows(os.path.join(work_dir, 'workflows'), args.workflow_size,
+                                                   args.workflow_subjects, args.num_perm, args)
+
+    with open(args.output_file, 'w') as fileobj:
+        json.dump(results, fileobj, indent=2)
+    print('Results written to %s' % os.path.abspath(args.output_file))
+
+    if args.compare is not None:
+        with open(args.compare) as fileobj:
+            compare(results, json.load(fileobj))
+
+    if args.work_dir is None:
+        shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,273 @@
+"""
+standins
+
+Lightweight stand-ins for the FSL and ANTs commands called by the nipypeVBM workflows
+
+Each stand-in parses the command line nipype builds, reads its inputs and writes outputs
+with the names and grids the next node expects, using cheap numpy operations in place of
+the real algorithm. Registrations are identity transforms in world space. They let the
+workflows run end to end on a machine without FSL or ANTs, so that the Python-side
+overhead and scaling can be measured.
+
+    python standins.py <tool> [args...]
+"""
+import os
+import re
+import stat
+import sys
+
+import nibabel as nib
+import numpy as np
+
+TOOLS = ['bet', 'antsRegistration', 'antsApplyTransforms', 'CompositeTransformUtil', 'Atropos',
+         'CreateJacobianDeterminantImage', 'ResampleImageBySpacing', 'randomise']
+ANTS_VERSION = '2.3.5-standin'
+FSL_VERSION = '6.0.5'
+
+
+def install(out_dir):
+    """Write an executable wrapper per tool and a fake FSLDIR under out_dir
+
+    Returns the environment variables to set, with the wrapper directory first on PATH.
+    """
+    bin_dir = os.path.join(out_dir, 'bin')
+    fsl_dir = os.path.join(out_dir, 'fsl')
+    os.makedirs(bin_dir, exist_ok=True)
+    os.makedirs(os.path.join(fsl_dir, 'etc'), exist_ok=True)
+    with open(os.path.join(fsl_dir, 'etc', 'fslversion'), 'w') as fileobj:
+        fileobj.write(FSL_VERSION + '\n')
+
+    for tool in TOOLS:
+        wrapper = os.path.join(bin_dir, tool)
+        with open(wrapper, 'w') as fileobj:
+            fileobj.write('#!/bin/sh\nexec "%s" "%s" %s "$@"\n' % (sys.executable, os.path.abspath(__file__), tool))
+        os.chmod(wrapper, os.stat(wrapper).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+    return {'PATH': bin_dir + os.pathsep + os.environ.get('PATH', ''), 'FSLDIR': fsl_dir,
+            'FSLOUTPUTTYPE': 'NIFTI_GZ'}
+
+
+def _nifti_name(file_name):
+    """FSL adds the output type extension to output names given without one"""
+    return file_name if '.nii' in file_name else file_name + '.nii.gz'
+
+
+def _strip_nifti(file_name):
+    return file_name.split('.nii')[0]
+
+
+def _option(cmdline, name):
+    """Value of a --name option, with the [ a, b ] lists of ANTs returned as a list"""
+    match = re.search(r'%s\s+(\[[^\]]*\]|\S+)' % re.escape(name), cmdline)
+    if match is None:
+        return None
+    value = match.group(1)
+    if value.startswith('['):
+        return [v.strip() for v in value.strip('[]').split(',')]
+    return value
+
+
+def _save(data, ref_obj, file_name, dtype=np.float32):
+    obj = nib.Nifti1Image(np.asarray(data, dtype=dtype), ref_obj.affine)
+    obj.header.set_xyzt_units(*ref_obj.header.get_xyzt_units())
+    obj.to_filename(file_name)
+
+
+def _resample(in_obj, ref_obj, order=1):
+    """Resample a 3D or 4D image onto the grid of a reference image through world coordinates"""
+    from scipy import ndimage
+
+    mapping = np.linalg.inv(in_obj.affine) @ ref_obj.affine
+    out_shape = ref_obj.shape[:3]
+    data = in_obj.get_fdata(dtype=np.float32)
+    if data.ndim == 3:
+        return ndimage.affine_transform(data, mapping[:3, :3], mapping[:3, 3], output_shape=out_shape, order=order)
+    return np.stack([ndimage.affine_transform(data[..., i], mapping[:3, :3], mapping[:3, 3],
+                                              output_shape=out_shape, order=order)
+                     for i in range(data.shape[3])], axis=-1)
+
+
+def _displacement_field(ref_obj, file_name):
+    """Write a zero displacement field in the 5D layout ANTs uses"""
+    field = nib.Nifti1Image(np.zeros(ref_obj.shape[:3] + (1, 3), dtype=np.float32), ref_obj.affine)
+    field.header.set_intent('vector')
+    field.to_filename(file_name)
+
+
+def bet(args):
+    """bet <in> <out> [-f <frac>] [-m]"""
+    from scipy import ndimage
+
+    in_obj = nib.load(args[0])
+    out_file = _nifti_name(args[1])
+    data = in_obj.get_fdata(dtype=np.float32)
+
+    # The component containing the centre, with holes filled, is the brain
+    labels, _ = ndimage.label(data > 0.15 * data.max())
+    centre = labels[tuple(s // 2 for s in data.shape[:3])]
+    mask = ndimage.binary_fill_holes(labels == centre) if centre else data > 0
+
+    _save(data * mask, in_obj, out_file)
+    if '-m' in args:
+        # The mask has the extension of the output, like FSL under FSLOUTPUTTYPE
+        base_name = _strip_nifti(out_file)
+        _save(mask, in_obj, base_name + '_mask' + out_file[len(base_name):], np.uint8)
+
+
+def antsRegistration(args):
+    if '--version' in args:
+        print('ANTs Version: %s\nCompiled: standin' % ANTS_VERSION)
+        return
+    cmdline = ' '.join(args)
+    fixed_file, moving_file = re.search(r'--metric\s+\w+\[\s*([^,\s]+)\s*,\s*([^,\s]+)', cmdline).groups()
+    output = _option(cmdline, '--output')
+    prefix = output[0] if isinstance(output, list) else output
+    fixed_obj = nib.load(fixed_file)
+
+    if isinstance(output, list) and len(output) > 1:
+        _save(_resample(nib.load(moving_file), fixed_obj), fixed_obj, output[1])
+    if isinstance(output, list) and len(output) > 2:
+        _save(_resample(fixed_obj, nib.load(moving_file)), nib.load(moving_file), output[2])
+
+    # Every transform either layout of the outputs may refer to, with the fixed image recorded
+    # so that CompositeTransformUtil can write the displacement field on its grid
+    for name in ['0GenericAffine.mat', 'Composite.h5', 'InverseComposite.h5']:
+        with open(prefix + name, 'w') as fileobj:
+            fileobj.write('#Insight Transform File V1.0\n#Fixed: %s\n#Transform 0\n'
+                          'Transform: IdentityTransform_double_3_3\n' % os.path.abspath(fixed_file))
+    if 'SyN' in cmdline:
+        _displacement_field(fixed_obj, prefix + '1Warp.nii.gz')
+        _displacement_field(nib.load(moving_file), prefix + '1InverseWarp.nii.gz')
+
+
+def antsApplyTransforms(args):
+    cmdline = ' '.join(args)
+    ref_obj = nib.load(_option(cmdline, '--reference-image'))
+    output = _option(cmdline, '--output')
+    order = 0 if _option(cmdline, '--interpolation') in ('NearestNeighbor', 'MultiLabel') else 1
+    _save(_resample(nib.load(_option(cmdline, '--input')), ref_obj, order), ref_obj, output)
+
+
+def CompositeTransformUtil(args):
+    """CompositeTransformUtil --disassemble <composite> <prefix>"""
+    if args[0] != '--disassemble':
+        sys.exit('Only --disassemble is supported')
+    with open(args[1]) as fileobj:
+        fixed_file = re.search(r'^#Fixed: (.*)$', fileobj.read(), re.MULTILINE).group(1)
+    with open('00_%s_AffineTransform.mat' % args[2], 'w') as fileobj:
+        fileobj.write('#Insight Transform File V1.0\n#Transform 0\nTransform: IdentityTransform_double_3_3\n')
+    _displacement_field(nib.load(fixed_file), '01_%s_DisplacementFieldTransform.nii.gz' % args[2])
+
+
+def Atropos(args):
+    """Posteriors are the priors restricted to the mask, the labels their argmax"""
+    cmdline = ' '.join(args)
+    initialization = re.search(r'PriorProbabilityImages\[\s*(\d+)\s*,\s*([^,\s]+)', cmdline)
+    num_classes, prior_pattern = int(initialization.group(1)), initialization.group(2)
+    classified_file, posterior_pattern = _option(cmdline, '--output')[:2]
+    mask_obj = nib.load(_option(cmdline, '--mask-image'))
+    mask = mask_obj.get_fdata(dtype=np.float32) > 0
+
+    posteriors = np.stack([nib.load(prior_pattern % (i + 1)).get_fdata(dtype=np.float32) * mask
+                           for i in range(num_classes)], axis=-1)
+    for i in range(num_classes):
+        _save(posteriors[..., i], mask_obj, posterior_pattern % (i + 1))
+    _save((posteriors.argmax(axis=-1) + 1) * mask, mask_obj, classified_file, np.uint8)
+
+
+def CreateJacobianDeterminantImage(args):
+    """CreateJacobianDeterminantImage <dim> <field> <out> [log] [geometric]"""
+    field_obj = nib.load(args[1])
+    _save(np.ones(field_obj.shape[:3]), field_obj, args[2])
+
+
+def ResampleImageBySpacing(args):
+    """ResampleImageBySpacing <dim> <in> <out> <sx> <sy> <sz> [smooth] [addvox] [nn]"""
+    in_obj = nib.load(args[1])
+    spacing = np.array([float(s) for s in args[3:6]])
+    zooms = np.array(in_obj.header.get_zooms()[:3])
+    shape = tuple(int(n) for n in np.ceil(np.array(in_obj.shape[:3]) * zooms / spacing))
+    affine = in_obj.affine.copy()
+    affine[:3, :3] = affine[:3, :3] / zooms * spacing
+    ref_obj = nib.Nifti1Image(np.zeros(shape, dtype=np.uint8), affine)
+    order = 0 if len(args) > 8 and args[8] == '1' else 1
+    _save(_resample(in_obj, ref_obj, order), ref_obj, args[2])
+
+
+def _load_fsl_matrix(file_name):
+    with open(file_name) as fileobj:
+        rows = [line for line in fileobj if line.strip() and not line.startswith('/')]
+    return np.loadtxt(rows, ndmin=2)
+
+
+def _tstats(data, design, contrasts):
+    """GLM t-statistics of voxels x subjects data, one column per contrast"""
+    pinv = np.linalg.pinv(design)
+    beta = data @ pinv.T
+    residuals = data - beta @ design.T
+    dof = design.shape[0] - np.linalg.matrix_rank(design)
+    sigma2 = (residuals ** 2).sum(axis=1) / max(dof, 1)
+    scale = np.sqrt(np.einsum('ij,jk,ik->i', contrasts, pinv @ pinv.T, contrasts))
+    return (beta @ contrasts.T) / np.sqrt(sigma2[:, None] + 1e-12) / scale
+
+
+def randomise(args):
+    """randomise -i <in> -o <base> -d <mat> -t <con> -m <mask> -n <perms> [-T] [-x] [-P] [-R] [--seed=<n>]
+
+    Permutes the rows of the design, with the unpermuted design first like randomise. The
+    TFCE statistic is approximated by the absolute t-statistic. Like randomise, the raw
+    TFCE image is only written with -R, and -P only writes the null distributions of the
+    corrected statistics.
+    """
+    cmdline = ' '.join(args)
+    in_obj = nib.load(_option(cmdline, '-i'))
+    base_name = _option(cmdline, '-o').strip('"\'')
+    design = _load_fsl_matrix(_option(cmdline, '-d'))
+    contrasts = _load_fsl_matrix(_option(cmdline, '-t'))
+    mask = nib.load(_option(cmdline, '-m')).get_fdata() > 0
+    num_perm = int(_option(cmdline, '-n') or 5000)
+    seed = re.search(r'--seed=(\d+)', cmdline)
+    rng = np.random.default_rng(int(seed.group(1)) if seed else 0)
+
+    data = in_obj.get_fdata(dtype=np.float32)[mask]
+    stats = {'tstat': _tstats(data, design, contrasts)}
+    if '-T' in args:
+        stats['tfce_tstat'] = np.abs(stats['tstat'])
+    null_dist = {name: [stat.max(axis=0)] for name, stat in stats.items()}
+    num_ge = {name: np.ones_like(stat) for name, stat in stats.items()}
+    for _ in range(num_perm - 1):
+        perm_tstat = _tstats(data, design[rng.permutation(design.shape[0])], contrasts)
+        for name in stats:
+            perm_stat = perm_tstat if name == 'tstat' else np.abs(perm_tstat)
+            null_dist[name].append(perm_stat.max(axis=0))
+            num_ge[name] += perm_stat >= stats[name]
+
+    def save(values, suffix):
+        volume = np.zeros(mask.shape, dtype=np.float32)
+        volume[mask] = values
+        _save(volume, in_obj, '%s_%s.nii.gz' % (base_name, suffix))
+
+    for c in range(contrasts.shape[0]):
+        save(stats['tstat'][:, c], 'tstat%d' % (c + 1))
+        outputs = [('tfce_tstat', 'tfce')] if '-T' in args else []
+        if '-x' in args:
+            outputs.append(('tstat', 'vox'))
+        for name, prefix in outputs:
+            maxima = np.array(null_dist[name])[:, c]
+            if name != 'tstat' and '-R' in args:
+                save(stats[name][:, c], '%s%d' % (name, c + 1))
+            save(1 - num_ge[name][:, c] / num_perm, '%s_p_tstat%d' % (prefix, c + 1))
+            save((maxima[None, :] < stats[name][:, c, None]).mean(axis=1), '%s_corrp_tstat%d' % (prefix, c + 1))
+            if '-P' in args:
+                np.savetxt('%s_perm_%s%d.txt' % (base_name, name, c + 1), maxima)
+
+
+def main(argv):
+    tool = argv[1]
+    if tool not in TOOLS:
+        sys.exit('Unknown stand-in %s, expected one of %s' % (tool, ', '.join(TOOLS)))
+    globals()[tool](argv[2:])
+
+
+if __name__ == '__main__':
+    main(sys.argv)
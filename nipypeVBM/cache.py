@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+
+# Digests already computed in this process, keyed by (path, size, mtime) so a rewritten file is hashed again.
+# Processes forked afterwards (MultiProc workers, batch service studies) inherit them.
+_DIGESTS = {}
+
+
+def file_digest(file_path, block_size=2 ** 20):
+    """Return the sha256 hex digest of the contents of a file"""
+    stat = os.stat(file_path)
+    memo_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    if memo_key in _DIGESTS:
+        return _DIGESTS[memo_key]
+
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as fileobj:
+        for block in iter(lambda: fileobj.read(block_size), b''):
+            digest.update(block)
+    _DIGESTS[memo_key] = digest.hexdigest()
+    return _DIGESTS[memo_key]
+
+
+def digest_files(value):
+    """Replace existing file paths in a (nested) input value with their content digests"""
+    if isinstance(value, (list, tuple)):
+        return [digest_files(v) for v in value]
+    if isinstance(value, dict):
+        return {k: digest_files(v) for k, v in value.items()}
+    if isinstance(value, str) and os.path.isfile(value):
+        return 'sha256:' + file_digest(value)
+    return value
+
+
+class TransformCache(object):
+    """Content-addressed store of registration outputs with LRU eviction
+
+    Each entry is a directory named by its key containing the cached files and a
+    manifest.json. The manifest modification time records the last use and
+    determines the eviction order once the cache grows beyond max_size_gb.
+    """
+
+    def __init__(self, cache_dir, max_size_gb=None):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_size_gb = max_size_gb
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(inputs):
+        """Hash a dict of inputs whose files have been replaced with digests"""
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _manifest(self, key):
+        return os.path.join(self.cache_dir, key, 'manifest.json')
+
+    def fetch(self, key, out_files):
+        """Copy the cached files of an entry to out_files, returning False on a miss"""
+        manifest_file = self._manifest(key)
+        try:
+            with open(manifest_file) as fileobj:
+                cached_files = json.load(fileobj)['files']
+        except (OSError, ValueError, KeyError):
+            return False
+        if len(cached_files) != len(out_files):
+            return False
+
+        # Another process may evict the entry while it is copied, which is then a miss
+        try:
+            for cached_file, out_file in zip(cached_files, out_files):
+                if cached_file is not None:
+                    shutil.copyfile(os.path.join(self.cache_dir, key, cached_file), out_file)
+            os.utime(manifest_file)
+        except OSError:
+            for out_file in out_files:
+                if os.path.exists(out_file):
+                    os.remove(out_file)
+            return False
+        return True
+
+    def store(self, key, out_files):
+        """Add the existing out_files under key, then evict old entries above the size cap"""
+        entry_dir = os.path.join(self.cache_dir, key)
+        if os.path.exists(entry_dir):
+            return
+
+        # Build the entry in a temporary directory so concurrent readers never see a partial entry
+        tmp_dir = tempfile.mkdtemp(prefix='.tmp_', dir=self.cache_dir)
+        cached_files = []
+        for i, out_file in enumerate(out_files):
+            if os.path.exists(out_file):
+                cached_file = '%03d_%s' % (i, os.path.basename(out_file))
+                shutil.copyfile(out_file, os.path.join(tmp_dir, cached_file))
+                cached_files.append(cached_file)
+            else:
+                cached_files.append(None)
+        with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as fileobj:
+            json.dump({'files': cached_files}, fileobj)
+
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_size_gb"""
+        if self.max_size_gb is None:
+            return
+
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            manifest_file = self._manifest(key)
+            if not os.path.exists(manifest_file):
+                continue
+            entry_dir = os.path.join(self.cache_dir, key)
+            try:
+                size = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+                entries.append((os.path.getmtime(manifest_file), size, entry_dir))
+            except OSError:
+                # Evicted by another process meanwhile
+                continue
+
+        total_size = sum(entry[1] for entry in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total_size <= self.max_size_gb * 2 ** 30:
+                break
+            # Move the entry out of the way first so no reader finds it half deleted
+            tmp_dir = tempfile.mkdtemp(prefix='.tmp_', dir=self.cache_dir)
+            try:
+                os.rename(entry_dir, os.path.join(tmp_dir, 'entry'))
+            except OSError:
+                pass
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            total_size -= size
@@ -0,0 +1,100 @@
+import json
+import os
+import shutil
+
+STATE_FILE = 'cohort.json'
+
+
+def load_cohort(state_dir):
+    """Load the subjects and template running sums recorded by a previous incremental run"""
+    state_file = os.path.join(state_dir, STATE_FILE)
+    if not os.path.exists(state_file):
+        return {'struct_files': [], 'templates': {}}
+    with open(state_file) as fileobj:
+        return json.load(fileobj)
+
+
+def merge_cohort(state, struct_files):
+    """Check that the cohort lists the previous subjects, in their original order, followed by the new ones
+
+    Keeping the previous subjects at the same MapNode indices lets nipype reuse their
+    per-subject results, and the rows of the design matrix follow the order of struct_files,
+    so the subjects are never reordered. Returns the files and the number of previous subjects.
+    """
+    previous = state['struct_files']
+    missing = [f for f in previous if f not in struct_files]
+    if missing:
+        raise ValueError('Subjects cannot be removed in incremental mode, missing: ' + ', '.join(missing))
+    if len(set(struct_files)) != len(struct_files):
+        raise ValueError('Subjects are listed more than once')
+    if struct_files[:len(previous)] != previous:
+        raise ValueError('In incremental mode the previous subjects have to come first, in the order of '
+                         'cohort_state/struct_files.txt, followed by the new ones; the design matrix rows '
+                         'follow the same order')
+    if previous and len(struct_files) == len(previous):
+        raise ValueError('No new subjects to add in incremental mode')
+    return list(struct_files), len(previous)
+
+
+def check_design(design_mat, n_subjects):
+    """Raise a ValueError if the /NumPoints of an FSL design matrix is not the number of subjects"""
+    with open(design_mat) as fileobj:
+        for line in fileobj:
+            if line.startswith('/NumPoints'):
+                num_points = int(line.split()[1])
+                break
+        else:
+            raise ValueError('%s has no /NumPoints line' % design_mat)
+    if num_points != n_subjects:
+        raise ValueError('%s has %d rows but the cohort has %d subjects' % (design_mat, num_points, n_subjects))
+
+
+def has_templates(state):
+    """Whether a previous run recorded the affine template and nonlinear running sums"""
+    return 'affine' in state['templates'] and 'nonlinear' in state['templates']
+
+
+def set_cohort_inputs(input_node, state, n_previous):
+    """Set the affine template and nonlinear running sums of a previous run on the input node of
+    create_nipypevbm_workflow"""
+    if not has_templates(state):
+        return
+    templates = state['templates']
+    input_node.inputs.n_previous = n_previous
+    input_node.inputs.affine_template_file = templates['affine']['template_file']
+    input_node.inputs.nonlinear_sum_file = templates['nonlinear']['sum_file']
+    input_node.inputs.nonlinear_count = templates['nonlinear']['count']
+
+
+def _extension(file_name):
+    return '.nii.gz' if file_name.endswith('.gz') else '.nii'
+
+
+def save_cohort(state_dir, struct_files, outputs):
+    """Record the cohort and copy the affine template and the nonlinear running sums out of the nipype
+    working directory
+
+    The working directory of the template nodes is cleared when they rerun, so the files
+    of the next incremental run have to be kept elsewhere. The affine template of the
+    first run is kept for all later runs.
+
+    Keyword arguments:
+    state_dir -- directory of the cohort state
+    struct_files -- subjects of the run, in order
+    outputs -- output_node fields of the fslvbm_2_template workflow, see execution.workflow_outputs
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    affine_template_file = os.path.join(state_dir, 'affine_template' + _extension(outputs['affine_template_file']))
+    if os.path.abspath(outputs['affine_template_file']) != affine_template_file:
+        shutil.copyfile(outputs['affine_template_file'], affine_template_file)
+    sum_file = os.path.join(state_dir, 'nonlinear_sum' + _extension(outputs['nonlinear_sum_file']))
+    shutil.copyfile(outputs['nonlinear_sum_file'], sum_file)
+    templates = {'affine': {'template_file': affine_template_file},
+                 'nonlinear': {'sum_file': sum_file, 'count': outputs['nonlinear_count']}}
+
+    state = {'struct_files': struct_files, 'templates': templates}
+    with open(os.path.join(state_dir, STATE_FILE), 'w') as fileobj:
+        json.dump(state, fileobj, indent=2)
+    # Design matrix rows have to follow this order
+    with open(os.path.join(state_dir, 'struct_files.txt'), 'w') as fileobj:
+        fileobj.write('\n'.join(struct_files) + '\n')
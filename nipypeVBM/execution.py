@@ -0,0 +1,110 @@
+import os
+
+from nipypeVBM.profiling import NodeProfiler
+from nipypeVBM.resources import NodeResources, configure_scheduler, image_voxels
+
+PLUGINS = ['Linear', 'MultiProc', 'SLURM', 'SGE']
+
+
+def add_execution_arguments(parser):
+    """Add the arguments shared by the bin scripts that control how a workflow is run"""
+    parser.add_argument('-t', '--num_threads', type=int, default=1,
+                        help='CPUs available to MultiProc, or CPUs per cluster node for SLURM/SGE')
+    parser.add_argument('--mem-gb', type=float, default=None,
+                        help='memory budget in GB, or memory per cluster node for SLURM/SGE '
+                             '(default: let the plugin decide)')
+    parser.add_argument('--plugin', type=str, default=None, choices=PLUGINS,
+                        help='nipype plugin (default: Linear for one thread, MultiProc otherwise)')
+    parser.add_argument('--queue-args', type=str, default='',
+                        help='extra sbatch/qsub arguments for the SLURM and SGE plugins')
+    parser.add_argument('--profile', type=str, default=None, metavar='DIR',
+                        help='record per-node time, memory and input/output file sizes and write the report to DIR; '
+                             'MapNode iterations get rows of their own only with the MultiProc plugin')
+
+
+def cohort_resources(args, n_subjects, ref_image):
+    """Node sizes for a cohort, to pass as resources to the create_*_workflow functions
+
+    Keyword arguments:
+    args -- parsed arguments of add_execution_arguments
+    n_subjects -- number of subjects in the cohort
+    ref_image -- image whose grid size is used for the memory estimates
+    """
+    # Cluster jobs each get a node of num_threads CPUs instead of sharing them
+    return NodeResources(n_subjects, image_voxels(ref_image), args.num_threads, args.mem_gb,
+                         shared=args.plugin not in ('SLURM', 'SGE'))
+
+
+def run_workflow(wf, args):
+    """Run the workflow with the plugin selected in args
+
+    The nodes are sized when the workflow is created, see cohort_resources. With SLURM
+    and SGE their sizes are also requested from the scheduler.
+
+    Keyword arguments:
+    wf -- workflow to run
+    args -- parsed arguments of add_execution_arguments
+    """
+    plugin = args.plugin
+    if plugin is None:
+        plugin = 'Linear' if args.num_threads == 1 else 'MultiProc'
+
+    configure_scheduler(wf, plugin, args.queue_args)
+
+    if plugin == 'Linear':
+        plugin_args = {}
+    elif plugin == 'MultiProc':
+        plugin_args = {'n_procs': args.num_threads}
+        if args.mem_gb is not None:
+            plugin_args['memory_gb'] = args.mem_gb
+    elif plugin == 'SLURM':
+        plugin_args = {'sbatch_args': args.queue_args}
+    else:
+        plugin_args = {'qsub_args': args.queue_args}
+
+    if getattr(args, 'profile', None) is None:
+        return wf.run(plugin=plugin, plugin_args=plugin_args)
+
+    from nipype import config
+    config.enable_resource_monitor()
+    if not config.resource_monitor:
+        # Without it the CPU time and peak memory of every node would be reported as zero
+        raise RuntimeError('--profile needs the nipype resource monitor, which requires psutil>=5.0')
+    profiler = NodeProfiler()
+    plugin_args['status_callback'] = profiler
+    try:
+        return wf.run(plugin=plugin, plugin_args=plugin_args)
+    finally:
+        # Also report the nodes that ran before a failure
+        profiler.write(os.path.abspath(args.profile))
+
+
+def _source_value(flat_graph, exec_nodes, node, field):
+    from nipype.interfaces.utility import IdentityInterface
+
+    if not isinstance(node.interface, IdentityInterface):
+        return getattr(exec_nodes[node.fullname].result.outputs, field)
+    for source, _, data in flat_graph.in_edges(node, data=True):
+        for source_field, dest_field in data['connect']:
+            if dest_field == field:
+                return _source_value(flat_graph, exec_nodes, source, source_field)
+    return getattr(node.inputs, field)
+
+
+def workflow_outputs(wf, exec_graph, workflow_name):
+    """Return the values of the output_node fields of a (sub-)workflow after a run, as a dict
+
+    nipype drops the IdentityInterface nodes from the executed graph, so every field is read
+    from the outputs of the node connected to it.
+
+    Keyword arguments:
+    wf -- workflow that was run
+    exec_graph -- graph returned by its run
+    workflow_name -- name of the workflow (wf itself or a sub-workflow) whose output_node is read
+    """
+    flat_graph = wf._create_flat_graph()
+    exec_nodes = {node.fullname: node for node in exec_graph.nodes()}
+    output_node = [node for node in flat_graph.nodes()
+                   if node.name == 'output_node' and node.fullname.split('.')[-2] == workflow_name][0]
+    return {field: _source_value(flat_graph, exec_nodes, output_node, field)
+            for field in output_node.interface._fields}
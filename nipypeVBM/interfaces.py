@@ -1,17 +1,55 @@
 import os.path
-import glob
+import shutil
+import subprocess
 
 import nipype.interfaces.base as base
+import nipype.interfaces.ants as ants
+import nipype.interfaces.fsl as fsl
 import nipype.utils.filemanip as fip
 
+from nipypeVBM.cache import TransformCache, digest_files
+
+_EXTENSIONS = {'NIFTI': '.nii', 'NIFTI_GZ': '.nii.gz'}
+
+
+def _iter_volume_sums(in_files, dtype, chunk_size=1):
+    """Yield (partial sum, number of volumes) for slabs of the input images
+
+    Only chunk_size volumes are held in memory at a time, so the peak memory
+    does not depend on the number of subjects.
+    """
+    import nibabel as nib
+    import numpy as np
+
+    for in_file in in_files:
+        vol_obj = nib.load(in_file, keep_file_open=True)
+        if len(vol_obj.shape) == 3:
+            yield vol_obj.get_fdata(dtype=dtype), 1
+            continue
+        num_vols = vol_obj.shape[3]
+        for start in range(0, num_vols, chunk_size):
+            stop = min(start + chunk_size, num_vols)
+            slab = np.asanyarray(vol_obj.dataobj[..., start:stop])
+            yield slab.sum(axis=-1, dtype=dtype), stop - start
+
 
 class GenerateTemplateInputSpec(base.BaseInterfaceInputSpec):
-    input_file = base.File(exists=True, desc='input image', mandatory=True)
+    input_file = base.File(exists=True, desc='input 4D image', mandatory=True, xor=['input_files'])
+    input_files = base.InputMultiPath(base.File(exists=True), desc='input 3D images', mandatory=True,
+                                      xor=['input_file'])
     flip_axis = base.traits.Int(0, desc='Axis number to flip (-1 to not flip)', usedefault=True)
     output_name = base.traits.Str(desc='Filename for output template')
+    chunk_size = base.traits.Range(low=1, value=1, desc='Number of volumes read at once from a 4D image',
+                                   usedefault=True)
+    sum_dtype = base.traits.Enum('float64', 'float32', desc='Precision of the running sum', usedefault=True)
+    prior_sum_file = base.File(exists=True, desc='Running sum of previously added images', requires=['prior_count'])
+    prior_count = base.traits.Int(desc='Number of images in prior_sum_file')
+    output_type = base.traits.Enum('NIFTI_GZ', 'NIFTI', desc='Format of the template and sum', usedefault=True)
 
 class GenerateTemplateOutputSpec(base.TraitedSpec):
     template_file = base.File(exists=True, desc='output template')
+    sum_file = base.File(exists=True, desc='running sum of all images in the template (before flipping)')
+    count = base.traits.Int(desc='number of images in the template')
 
 
 class GenerateTemplate(base.BaseInterface):
@@ -22,35 +60,71 @@ class GenerateTemplate(base.BaseInterface):
         import nibabel as nib
         import numpy as np
 
-        vol_obj = nib.load(self.inputs.input_file)
-        vol_data = vol_obj.get_fdata()
+        in_files = self._in_files()
 
-        if self.inputs.flip_axis == -1:
-            template_data = np.average(vol_data, axis=-1)
-        else:
-            template_data = (np.average(vol_data, axis=-1) + np.average(np.flip(vol_data, axis=self.inputs.flip_axis), axis=-1)) / 2
+        # Start from the sums of a previous run when adding subjects to an existing cohort
+        sum_data = None
+        count = 0
+        if base.isdefined(self.inputs.prior_sum_file):
+            sum_data = nib.load(self.inputs.prior_sum_file).get_fdata(dtype=self.inputs.sum_dtype)
+            count = self.inputs.prior_count
+        ref_obj = nib.load(in_files[0] if in_files else self.inputs.prior_sum_file)
 
-        template_obj = nib.Nifti1Image(template_data, vol_obj.affine, vol_obj.header)
-        if base.isdefined(self.inputs.output_name):
-            output_name = self.inputs.output_name + '.nii.gz'
-        else:
-            output_name = 'template.nii.gz'
-        template_obj.to_filename(output_name)
+        # Accumulate one volume (or slab) at a time instead of loading the whole 4D stack
+        for partial_sum, num_vols in _iter_volume_sums(in_files, self.inputs.sum_dtype, self.inputs.chunk_size):
+            if sum_data is None:
+                sum_data = partial_sum
+            else:
+                sum_data += partial_sum
+            count += num_vols
+
+        sum_obj = nib.Nifti1Image(sum_data, ref_obj.affine, ref_obj.header)
+        sum_obj.set_data_dtype(self.inputs.sum_dtype)
+        sum_obj.to_filename(self._output_basename() + '_sum' + _EXTENSIONS[self.inputs.output_type])
+        template_data = sum_data / count
+
+        # Flipping is linear, so averaging the flipped mean matches averaging each flipped volume
+        if self.inputs.flip_axis != -1:
+            template_data = (template_data + np.flip(template_data, axis=self.inputs.flip_axis)) / 2
+
+        template_obj = nib.Nifti1Image(template_data, ref_obj.affine, ref_obj.header)
+        template_obj.to_filename(self._output_basename() + _EXTENSIONS[self.inputs.output_type])
 
         return runtime
 
+    def _in_files(self):
+        if base.isdefined(self.inputs.input_file):
+            return [self.inputs.input_file]
+        return self.inputs.input_files
+
+    def _output_basename(self):
+        if base.isdefined(self.inputs.output_name):
+            return self.inputs.output_name
+        return 'template'
+
     def _list_outputs(self):
+        import nibabel as nib
+
         outputs = self._outputs().get()
-        if base.isdefined(self.inputs.output_name):
-            outputs['template_file'] = os.path.abspath(self.inputs.output_name + '.nii.gz')
-        else:
-            outputs['template_file'] = os.path.abspath('template.nii.gz')
+        extension = _EXTENSIONS[self.inputs.output_type]
+        outputs['template_file'] = os.path.abspath(self._output_basename() + extension)
+        outputs['sum_file'] = os.path.abspath(self._output_basename() + '_sum' + extension)
+        # Count the volumes from the headers only
+        count = 0
+        for in_file in self._in_files():
+            shape = nib.load(in_file).shape
+            count += shape[3] if len(shape) > 3 else 1
+        if base.isdefined(self.inputs.prior_sum_file):
+            count += self.inputs.prior_count
+        outputs['count'] = count
         return outputs
 
 
 class GeneratePriorsInputSpec(base.BaseInterfaceInputSpec):
     reference_file = base.File(exists=True, desc='input image', mandatory=True)
     prior_4D_file = base.File(exists=True, desc='input image', mandatory=True)
+    output_type = base.traits.Enum('NIFTI_GZ', 'NIFTI', desc='Format of the priors (NIFTI can be memory-mapped)',
+                                   usedefault=True)
 
 
 class GeneratePriorsOutputSpec(base.TraitedSpec):
@@ -67,27 +141,502 @@ class GeneratePriors(base.BaseInterface):
         import numpy as np
 
         vol_obj = nib.load(self.inputs.prior_4D_file)
-        vol_data = vol_obj.get_fdata()
+        vol_data = vol_obj.get_fdata(dtype=np.float32)
         ref_obj = nib.load(self.inputs.reference_file)
 
-        bg_priors = 1 - np.sum(vol_data, 3)
-        output_filename = fip.split_filename(self.inputs.reference_file)[1] + '_prior01.nii.gz'
-        prior_obj = nib.Nifti1Image(bg_priors, ref_obj.affine, ref_obj.header)
-        prior_obj.to_filename(output_filename)
+        prior_string = self._prior_string()
+        bg_priors = 1 - np.sum(vol_data, axis=3, dtype=np.float32)
+        priors = [bg_priors] + [vol_data[:, :, :, i] for i in range(vol_data.shape[3])]
+        for i, prior_data in enumerate(priors):
+            prior_obj = nib.Nifti1Image(prior_data, ref_obj.affine, ref_obj.header)
+            prior_obj.set_data_dtype(np.float32)
+            prior_obj.to_filename(prior_string % (i + 1))
+
+        return runtime
+
+    def _prior_string(self):
+        basename = fip.split_filename(self.inputs.reference_file)[1]
+        return os.path.abspath(basename + '_prior%02d' + _EXTENSIONS[self.inputs.output_type])
+
+    def _list_outputs(self):
+        import nibabel as nib
+
+        outputs = self._outputs().get()
+        # Background prior plus one prior per class of the 4D input, read from the header only
+        num_priors = nib.load(self.inputs.prior_4D_file).shape[3] + 1
+        outputs['prior_string'] = self._prior_string()
+        outputs['prior_3D_files'] = [outputs['prior_string'] % (i + 1) for i in range(num_priors)]
+        return outputs
+
+
+class _PigzWriter(object):
+    """Write-only file object that gzips through a multithreaded pigz process"""
+
+    def __init__(self, out_file, compresslevel, threads):
+        self._out = open(out_file, 'wb')
+        self._proc = subprocess.Popen(['pigz', '-%d' % compresslevel, '-p', str(threads), '-c'],
+                                      stdin=subprocess.PIPE, stdout=self._out)
+
+    def write(self, data):
+        return self._proc.stdin.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._proc.stdin.close()
+        returncode = self._proc.wait()
+        self._out.close()
+        if returncode != 0 and exc_info[0] is None:
+            raise RuntimeError('pigz exited with code %d' % returncode)
+
+
+def _open_4d(out_file, ref_obj, num_vols, compresslevel=1, threads=1):
+    """Open a float32 4D NIfTI on the grid of ref_obj and write its header
 
-        for i in range(vol_data.shape[3]):
-            output_filename = fip.split_filename(self.inputs.reference_file)[1] + '_prior0' + str(i + 2) + '.nii.gz'
-            img = vol_data[:, :, :, i]
-            prior_obj = nib.Nifti1Image(img, ref_obj.affine, ref_obj.header)
-            prior_obj.to_filename(output_filename)
+    Returns the open file and the on-disk dtype; volumes are then written in order with
+    fileobj.write(vol_data.astype(dtype).tobytes(order='F')). Compressed outputs go
+    through pigz when more than one thread is given and it is on the PATH.
+    """
+    import nibabel as nib
+    import numpy as np
+
+    header = ref_obj.header.copy()
+    header.set_data_shape(ref_obj.shape[:3] + (num_vols,))
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(np.nan, np.nan)
+    header['vox_offset'] = 0
+
+    if out_file.endswith('.gz') and threads > 1 and shutil.which('pigz'):
+        fileobj = _PigzWriter(out_file, compresslevel, threads)
+    else:
+        kwargs = {'compresslevel': compresslevel} if out_file.endswith('.gz') else {}
+        fileobj = nib.openers.Opener(out_file, 'wb', **kwargs)
+    header.write_to(fileobj)
+    return fileobj, header.get_data_dtype()
+
+
+def _modulate_smooth(gm_file, jacobian_file, sigmas_vox):
+    """Load one subject, modulate the GM by the Jacobian and smooth it with separable Gaussians
+
+    Returns the GM image and one smoothed image per kernel in sigmas_vox.
+    """
+    import nibabel as nib
+    import numpy as np
+    from scipy import ndimage
+
+    gm_data = nib.load(gm_file).get_fdata(dtype=np.float32)
+    mod_data = gm_data * nib.load(jacobian_file).get_fdata(dtype=np.float32)
+    return gm_data, [ndimage.gaussian_filter(mod_data, sigma_vox, mode='constant') for sigma_vox in sigmas_vox]
+
+
+class ModulateSmoothInputSpec(base.BaseInterfaceInputSpec):
+    gm_files = base.InputMultiPath(base.File(exists=True), desc='GM images in template space', mandatory=True)
+    jacobian_files = base.InputMultiPath(base.File(exists=True), desc='Jacobian determinant images',
+                                         mandatory=True)
+    sigma = base.InputMultiObject(base.traits.Float, mandatory=True,
+                                  desc='Sigma of the Gaussian kernel in mm, one output per sigma')
+    mask_threshold = base.traits.Float(0.01, desc='Threshold of the mean GM image for the mask', usedefault=True)
+    output_name = base.traits.Str('GM_mod_merg', desc='Prefix of the output 4D images, followed by _s<sigma>',
+                                  usedefault=True)
+    compression = base.traits.Range(low=0, high=9, value=1, usedefault=True,
+                                    desc='gzip level of the output (0 writes uncompressed .nii)')
+    num_threads = base.traits.Int(1, desc='Number of subjects processed in parallel, and of pigz threads',
+                                  usedefault=True, nohash=True)
+
+
+class ModulateSmoothOutputSpec(base.TraitedSpec):
+    smoothed_files = base.OutputMultiObject(base.File(exists=True),
+                                            desc='modulated and smoothed GM images (4D), one per sigma')
+    mask_file = base.File(exists=True, desc='mask of the thresholded mean GM image')
+
+
+class ModulateSmooth(base.BaseInterface):
+    """Modulate the GM images by their Jacobians, smooth them and build the GM mask in one pass
+
+    Replaces per-subject fslmaths -mul and -s calls and the -Tmean -thr -bin mask on a
+    4D merge. Subjects are streamed through a thread pool in float32, each subject is
+    loaded once for all sigmas and only the smoothed 4D images and the mask are written.
+    """
+    input_spec = ModulateSmoothInputSpec
+    output_spec = ModulateSmoothOutputSpec
+
+    def _run_interface(self, runtime):
+        import collections
+        import concurrent.futures
+        import contextlib
+        import nibabel as nib
+        import numpy as np
+
+        if len(self.inputs.gm_files) != len(self.inputs.jacobian_files):
+            raise ValueError('gm_files and jacobian_files must have the same length')
+
+        ref_obj = nib.load(self.inputs.gm_files[0])
+        zooms = ref_obj.header.get_zooms()[:3]
+        sigmas_vox = [[sigma / zoom for zoom in zooms] for sigma in self.inputs.sigma]
+        mean_data = np.zeros(ref_obj.shape[:3], dtype=np.float64)
+
+        num_threads = max(1, self.inputs.num_threads)
+        subjects = iter(zip(self.inputs.gm_files, self.inputs.jacobian_files))
+
+        def submit_next(pool, pending):
+            subject = next(subjects, None)
+            if subject is not None:
+                pending.append(pool.submit(_modulate_smooth, subject[0], subject[1], sigmas_vox))
+
+        def smoothed_volumes(pool):
+            # Keep at most num_threads subjects in flight so memory stays bounded, yielding in input order
+            pending = collections.deque()
+            for _ in range(num_threads):
+                submit_next(pool, pending)
+            while pending:
+                result = pending.popleft().result()
+                submit_next(pool, pending)
+                yield result
+
+        with contextlib.ExitStack() as stack:
+            outputs = []
+            for smoothed_file in self._smoothed_filenames():
+                fileobj, data_dtype = _open_4d(smoothed_file, ref_obj, len(self.inputs.gm_files),
+                                               self.inputs.compression, num_threads)
+                outputs.append((stack.enter_context(fileobj), data_dtype))
+            pool = stack.enter_context(concurrent.futures.ThreadPoolExecutor(num_threads))
+            for gm_data, smoothed_data in smoothed_volumes(pool):
+                mean_data += gm_data
+                for (fileobj, data_dtype), vol_data in zip(outputs, smoothed_data):
+                    fileobj.write(vol_data.astype(data_dtype).tobytes(order='F'))
+
+        mean_data /= len(self.inputs.gm_files)
+        mask_obj = nib.Nifti1Image((mean_data >= self.inputs.mask_threshold).astype(np.uint8), ref_obj.affine,
+                                   ref_obj.header)
+        mask_obj.set_data_dtype(np.uint8)
+        mask_obj.to_filename(self._mask_filename())
 
         return runtime
 
+    def _extension(self):
+        return '.nii' if self.inputs.compression == 0 else '.nii.gz'
+
+    def _smoothed_filenames(self):
+        return [self.inputs.output_name + '_s%g' % sigma + self._extension() for sigma in self.inputs.sigma]
+
+    def _mask_filename(self):
+        return 'GM_mask' + self._extension()
+
     def _list_outputs(self):
         outputs = self._outputs().get()
-        basename = fip.split_filename(self.inputs.reference_file)[1]
-        outputs['prior_3D_files'] = glob.glob(os.path.abspath(basename + '_prior*.nii.gz'))
-        outputs['prior_string'] = os.path.abspath(basename + '_prior%02d.nii.gz')
+        outputs['smoothed_files'] = [os.path.abspath(f) for f in self._smoothed_filenames()]
+        outputs['mask_file'] = os.path.abspath(self._mask_filename())
         return outputs
 
 
+def _flatten_files(value):
+    if isinstance(value, (list, tuple)):
+        return [f for v in value for f in _flatten_files(v)]
+    if isinstance(value, str):
+        return [value]
+    return []
+
+
+class _TransformCacheMixin(object):
+    """Reuse the outputs of a command from a TransformCache when its inputs match
+
+    The cache key is computed from the contents of the input files and the
+    remaining parameters, so it does not depend on where the working directory is.
+    """
+    _cache_ignore = ['cache_dir', 'cache_max_gb', 'num_threads', 'environ', 'terminal_output']
+
+    def _cache_key(self):
+        inputs = {}
+        for name, value in self.inputs.get().items():
+            if name not in self._cache_ignore and base.isdefined(value):
+                inputs[name] = digest_files(value)
+        inputs['interface'] = self.__class__.__name__
+        return TransformCache.key(inputs)
+
+    def _cached_output_files(self, cwd):
+        outputs = self._list_outputs()
+        out_files = []
+        for name in sorted(outputs):
+            out_files += [os.path.abspath(f) for f in _flatten_files(outputs[name])
+                          if os.path.abspath(f).startswith(cwd + os.sep)]
+        return out_files
+
+    def _run_interface(self, runtime, **kwargs):
+        if not base.isdefined(self.inputs.cache_dir):
+            return super()._run_interface(runtime, **kwargs)
+
+        max_size_gb = self.inputs.cache_max_gb if base.isdefined(self.inputs.cache_max_gb) else None
+        cache = TransformCache(self.inputs.cache_dir, max_size_gb)
+        key = self._cache_key()
+        out_files = self._cached_output_files(os.path.abspath(runtime.cwd))
+        if cache.fetch(key, out_files):
+            runtime.returncode = 0
+            return runtime
+
+        runtime = super()._run_interface(runtime, **kwargs)
+        cache.store(key, out_files)
+        return runtime
+
+
+class CachedRegistrationInputSpec(ants.registration.RegistrationInputSpec):
+    cache_dir = base.Directory(desc='Directory of the transform cache', nohash=True)
+    cache_max_gb = base.traits.Float(desc='Size cap of the transform cache in GB', nohash=True)
+
+
+class CachedRegistration(_TransformCacheMixin, ants.Registration):
+    input_spec = CachedRegistrationInputSpec
+
+
+class CachedApplyTransformsInputSpec(ants.resampling.ApplyTransformsInputSpec):
+    cache_dir = base.Directory(desc='Directory of the transform cache', nohash=True)
+    cache_max_gb = base.traits.Float(desc='Size cap of the transform cache in GB', nohash=True)
+
+
+class CachedApplyTransforms(_TransformCacheMixin, ants.ApplyTransforms):
+    input_spec = CachedApplyTransformsInputSpec
+
+
+class _ChildPeakMemory(object):
+    """Context manager sampling the resident memory of the child processes, like nipype's resource monitor
+
+    peak_gb holds the largest total seen, in GB. Commands run by a node are the only
+    children of the process running it, so this is the peak of the command.
+    """
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.peak_gb = 0.0
+
+    def _sample(self, process):
+        import psutil
+
+        rss = 0
+        for child in process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        self.peak_gb = max(self.peak_gb, rss / 2 ** 30)
+
+    def _monitor(self):
+        import psutil
+
+        process = psutil.Process()
+        while not self._done.wait(self.interval):
+            self._sample(process)
+
+    def __enter__(self):
+        import threading
+
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._monitor, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._done.set()
+        self._thread.join()
+        return False
+
+
+class RandomiseShardOutputSpec(fsl.model.RandomiseOutputSpec):
+    peak_mem_gb = base.traits.Float(desc='peak resident memory of the randomise process in GB')
+
+
+class RandomiseShard(fsl.Randomise):
+    """fsl.Randomise that reports its peak memory, for running one shard of the permutations"""
+    output_spec = RandomiseShardOutputSpec
+
+    def _run_interface(self, runtime, correct_return_codes=(0,)):
+        with _ChildPeakMemory() as peak:
+            runtime = super()._run_interface(runtime, correct_return_codes)
+        self._peak_mem_gb = peak.peak_gb
+        return runtime
+
+    def _list_outputs(self):
+        outputs = super()._list_outputs()
+        outputs['peak_mem_gb'] = getattr(self, '_peak_mem_gb', base.Undefined)
+        return outputs
+
+
+class CombineRandomiseInputSpec(base.BaseInterfaceInputSpec):
+    shard_tstat_files = base.traits.List(base.traits.Either(base.traits.List(base.File(exists=True)),
+                                                            base.File(exists=True)),
+                                         mandatory=True, desc='tstat_files of each randomise shard')
+    shard_num_perms = base.traits.List(base.traits.Int, mandatory=True,
+                                       desc='Number of permutations of each shard')
+    shard_seeds = base.traits.List(base.traits.Int, desc='Seed of each shard, for the report')
+    shard_peak_mem_gb = base.traits.List(base.traits.Any, desc='Peak memory of each shard, for the report')
+    base_name = base.traits.Str('randomise', usedefault=True, desc='Base name of the shard outputs')
+    mask = base.File(exists=True, mandatory=True, desc='Mask used by randomise')
+
+
+class CombineRandomiseOutputSpec(base.TraitedSpec):
+    out_files = base.traits.List(base.File(exists=True), desc='combined statistic and p-value images')
+    t_p_files = base.traits.List(base.File(exists=True), desc='t contrast uncorrected p values files')
+    t_corrected_p_files = base.traits.List(base.File(exists=True),
+                                           desc='t contrast FWE (Family-wise error) corrected p values files')
+    report_file = base.File(exists=True, desc='CSV of the permutations and peak memory of each shard')
+
+
+class CombineRandomise(base.BaseInterface):
+    """Merge randomise shards run with different seeds into one set of p-value images
+
+    Follows randomise_parallel: uncorrected p-values are averaged weighted by the number of
+    permutations of each shard, and corrected p-values are recomputed from the concatenated
+    null distributions of the maximum statistic (the *_perm_<stat>.txt files written with -P).
+    The unpermuted labelling that every shard evaluates first is only counted once. The
+    TFCE correction needs the unpermuted *_tfce_tstat<n> images, written with -R.
+    """
+    input_spec = CombineRandomiseInputSpec
+    output_spec = CombineRandomiseOutputSpec
+
+    def _run_interface(self, runtime):
+        import csv
+        import glob
+        import nibabel as nib
+        import numpy as np
+
+        shard_dirs = []
+        for tstat_files in self.inputs.shard_tstat_files:
+            if isinstance(tstat_files, list):
+                tstat_files = tstat_files[0]
+            shard_dirs.append(os.path.dirname(tstat_files))
+        base_name = self.inputs.base_name
+        mask_data = nib.load(self.inputs.mask).get_fdata() > 0
+        num_perms = np.array(self.inputs.shard_num_perms, dtype=np.float64)
+
+        self._out_files = []
+        first_files = sorted(glob.glob(os.path.join(shard_dirs[0], base_name + '_*.nii*')))
+        stats = [os.path.basename(f)[len(base_name) + 1:].split('.nii')[0] for f in first_files]
+        missing = ['tfce_' + stat[len('tfce_p_'):] for stat in stats
+                   if stat.startswith('tfce_p_') and 'tfce_' + stat[len('tfce_p_'):] not in stats]
+        if missing:
+            raise ValueError('The shards have no unpermuted %s image to correct, run them with -R '
+                             '(raw_stats_imgs)' % ', '.join(missing))
+
+        for first_file, stat in zip(first_files, stats):
+            image_name = os.path.basename(first_file)
+
+            if '_corrp_' in stat:
+                continue
+            elif '_p_' in stat:
+                # Uncorrected p-values: weighted average over the shards
+                p_data = sum(n * nib.load(os.path.join(shard_dir, image_name)).get_fdata()
+                             for n, shard_dir in zip(num_perms, shard_dirs)) / num_perms.sum()
+                first_obj = nib.load(first_file)
+                nib.Nifti1Image(p_data, first_obj.affine, first_obj.header).to_filename(image_name)
+            else:
+                # The unpermuted statistic is the same in every shard
+                shutil.copyfile(first_file, image_name)
+                perm_files = [os.path.join(shard_dir, base_name + '_perm_' + stat + '.txt')
+                              for shard_dir in shard_dirs]
+                if all(os.path.exists(f) for f in perm_files):
+                    self._combine_corrp(first_file, stat, perm_files, mask_data)
+                elif stat.startswith('tfce_'):
+                    raise ValueError('Missing null distributions of %s: %s, run the shards with -P '
+                                     '(p_vec_n_dist_files)'
+                                     % (stat, ', '.join(f for f in perm_files if not os.path.exists(f))))
+            self._out_files.append(os.path.abspath(image_name))
+
+        with open('shard_report.csv', 'w', newline='') as fileobj:
+            writer = csv.writer(fileobj)
+            writer.writerow(['shard', 'seed', 'num_perm', 'peak_mem_gb'])
+            for i, n in enumerate(self.inputs.shard_num_perms):
+                seed = self.inputs.shard_seeds[i] if self.inputs.shard_seeds else ''
+                peak_mem_gb = self.inputs.shard_peak_mem_gb[i] if self.inputs.shard_peak_mem_gb else ''
+                writer.writerow([i, seed, n, peak_mem_gb])
+
+        return runtime
+
+    def _combine_corrp(self, stat_file, stat, perm_files, mask_data):
+        import nibabel as nib
+        import numpy as np
+
+        null_dist = [np.loadtxt(f, ndmin=1) for f in perm_files]
+        null_dist = np.sort(np.concatenate([null_dist[0]] + [d[1:] for d in null_dist[1:]]))
+
+        stat_obj = nib.load(stat_file)
+        stat_data = stat_obj.get_fdata()
+        # Fraction of the null distribution at or above each statistic, stored as 1 - p like randomise
+        num_ge = null_dist.size - np.searchsorted(null_dist, stat_data, side='left')
+        corrp_data = np.where(mask_data, 1 - num_ge / null_dist.size, 0)
+
+        if stat.startswith('tfce_'):
+            corrp_name = self.inputs.base_name + '_tfce_corrp_' + stat[len('tfce_'):]
+        else:
+            corrp_name = self.inputs.base_name + '_vox_corrp_' + stat
+        corrp_name += '.nii.gz'
+        nib.Nifti1Image(corrp_data.astype(np.float32), stat_obj.affine, stat_obj.header).to_filename(corrp_name)
+        self._out_files.append(os.path.abspath(corrp_name))
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_files'] = self._out_files
+        # Like fsl.Randomise, the TFCE p-values when the shards ran with tfce, the voxelwise ones otherwise
+        names = [os.path.basename(f) for f in self._out_files]
+        prefix = 'tfce' if any('_tfce_p_tstat' in name for name in names) else 'vox'
+        for field, stat in [('t_p_files', '_%s_p_tstat'), ('t_corrected_p_files', '_%s_corrp_tstat')]:
+            outputs[field] = sorted(f for f, name in zip(self._out_files, names) if stat % prefix in name)
+        outputs['report_file'] = os.path.abspath('shard_report.csv')
+        return outputs
+
+
+class SingleWarpCompositeTransformUtil(ants.CompositeTransformUtil):
+    """ants.CompositeTransformUtil disassembling a composite of one affine followed by one displacement field
+
+    CompositeTransformUtil returns the files of the first two transforms whatever the
+    composite holds. This raises an error instead when the composite has other transforms,
+    e.g. an initial transform that ANTs could not collapse into them, since the
+    displacement_field would then only be part of the warp.
+    """
+
+    def _run_interface(self, runtime, correct_return_codes=(0,)):
+        import glob
+
+        runtime = super()._run_interface(runtime, correct_return_codes)
+        if self.inputs.process != 'disassemble' or runtime.returncode not in correct_return_codes:
+            return runtime
+        outputs = self._list_outputs()
+        transform_files = sorted(glob.glob(os.path.join(runtime.cwd, '[0-9][0-9]_%s_*' % self.inputs.output_prefix)))
+        if transform_files != [outputs['affine_transform'], outputs['displacement_field']]:
+            raise ValueError('%s does not hold one affine followed by one displacement field: %s'
+                             % (self.inputs.in_file, ', '.join(os.path.basename(f) for f in transform_files)))
+        return runtime
+
+
+class SkippableRegistrationInputSpec(ants.registration.RegistrationInputSpec):
+    skip = base.traits.Bool(False, usedefault=True, desc='Pass the previous outputs through instead of registering')
+    previous_warped_image = base.File(exists=True, desc='warped_image returned when skipping')
+    previous_composite_transform = base.File(exists=True, desc='composite_transform returned when skipping')
+    previous_inverse_composite_transform = base.File(exists=True,
+                                                     desc='inverse_composite_transform returned when skipping')
+
+
+class SkippableRegistration(ants.Registration):
+    """ants.Registration that can be switched off at run time, for unrolled iterative loops
+
+    nipype graphs cannot stop early, so once a loop has converged the remaining
+    iterations pass the outputs of the previous iteration through unchanged.
+    """
+    input_spec = SkippableRegistrationInputSpec
+
+    def _run_interface(self, runtime, correct_return_codes=(0,)):
+        if self.inputs.skip:
+            runtime.returncode = 0
+            return runtime
+        return super()._run_interface(runtime, correct_return_codes)
+
+    def _list_outputs(self):
+        if not self.inputs.skip:
+            return super()._list_outputs()
+        outputs = self._outputs().get()
+        outputs['warped_image'] = self.inputs.previous_warped_image
+        outputs['composite_transform'] = self.inputs.previous_composite_transform
+        outputs['inverse_composite_transform'] = self.inputs.previous_inverse_composite_transform
+        outputs['forward_transforms'] = [self.inputs.previous_composite_transform]
+        outputs['forward_invert_flags'] = [False]
+        outputs['reverse_transforms'] = [self.inputs.previous_inverse_composite_transform]
+        outputs['reverse_invert_flags'] = [False]
+        return outputs
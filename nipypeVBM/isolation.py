@@ -0,0 +1,392 @@
+import concurrent.futures
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+
+from nipype import logging
+
+from nipypeVBM.cache import file_digest
+
+STATUS_FILE = 'subject_status.json'
+
+logger = logging.getLogger('nipype.workflow')
+
+
+def subject_ids(struct_files):
+    """Stable per-subject names, prefixed with their index so equal basenames stay distinct"""
+    return ['%03d_%s' % (i, os.path.basename(f).split('.nii')[0]) for i, f in enumerate(struct_files)]
+
+
+def load_status(output_root):
+    """Load the run configuration and per-subject stage results of a previous run"""
+    status_file = os.path.join(output_root, STATUS_FILE)
+    if not os.path.exists(status_file):
+        return {'config': None, 'subjects': {}}
+    with open(status_file) as fileobj:
+        return json.load(fileobj)
+
+
+def save_status(output_root, status):
+    # Write then rename so an interrupted run never leaves a truncated status file
+    status_file = os.path.join(output_root, STATUS_FILE)
+    with open(status_file + '.tmp', 'w') as fileobj:
+        json.dump(status, fileobj, indent=2)
+    os.replace(status_file + '.tmp', status_file)
+
+
+def _run_isolated(job, job_dir, timeout):
+    """Run one job in its own process group, killing the group (and any ANTs/FSL children) on timeout
+
+    Returns (outputs, error), one of which is None.
+    """
+    os.makedirs(job_dir, exist_ok=True)
+    job_file = os.path.join(job_dir, 'job.json')
+    result_file = os.path.join(job_dir, 'result.json')
+    if os.path.exists(result_file):
+        os.remove(result_file)
+    with open(job_file, 'w') as fileobj:
+        json.dump(job, fileobj, indent=2)
+
+    # Also limits the ITK tools not run through a nipype interface
+    env = dict(os.environ, ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=str(job['num_threads']))
+    with open(os.path.join(job_dir, 'job.log'), 'w') as log:
+        proc = subprocess.Popen([sys.executable, '-m', 'nipypeVBM.isolation', job_file], stdout=log,
+                                stderr=subprocess.STDOUT, start_new_session=True, env=env)
+        try:
+            returncode = proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+            return None, 'timed out after %g s' % timeout
+
+    if returncode != 0 or not os.path.exists(result_file):
+        with open(os.path.join(job_dir, 'job.log')) as log:
+            tail = log.read()[-2000:]
+        return None, 'exit code %d: %s' % (returncode, tail.strip().splitlines()[-1] if tail.strip() else '')
+    with open(result_file) as fileobj:
+        return json.load(fileobj), None
+
+
+def run_subject_stage(output_root, status, stage, jobs, profiles, timeout=None, max_workers=1):
+    """Run a per-subject stage for every subject not already done or quarantined
+
+    Each job is tried with each registration profile in turn, in an isolated process
+    with an optional timeout in seconds. Subjects failing every attempt are quarantined
+    and left out of the later stages. The status is saved after every subject, so an
+    interrupted run resumes from the completed subjects.
+
+    Keyword arguments:
+    output_root -- directory of the status file and the per-subject working directories
+    status -- status dict from load_status, updated in place
+    stage -- name of the stage, the key of its results in the status
+    jobs -- dict of subject id to job dict for the worker (without the profile)
+    profiles -- registration profiles to try in order, e.g. ['default', 'fast']
+    timeout -- seconds an attempt may take before it is killed (default None, no limit)
+    max_workers -- CPUs of the stage, up to this many jobs run at once and share them as ANTs threads (default 1)
+    """
+    lock = threading.Lock()
+    pending = {subject: job for subject, job in jobs.items() if not _is_done(status, subject, stage, job)}
+    num_threads = max(1, max_workers // max(1, min(max_workers, len(pending))))
+
+    def run(subject, job):
+        subject_status = status['subjects'].setdefault(subject, {'stages': {}, 'quarantined': None})
+        attempts = []
+        for profile in profiles:
+            job_dir = os.path.join(output_root, 'subjects', subject, stage)
+            outputs, error = _run_isolated(dict(job, stage=stage, profile=profile, num_threads=num_threads),
+                                           job_dir, timeout)
+            attempts.append({'profile': profile, 'error': error})
+            if outputs is not None:
+                break
+        with lock:
+            subject_status['stages'][stage] = {'job': job, 'outputs': outputs, 'attempts': attempts}
+            if outputs is None:
+                subject_status['quarantined'] = {'stage': stage, 'error': attempts[-1]['error']}
+            save_status(output_root, status)
+        if outputs is not None:
+            logger.info('%s %s: done', stage, subject)
+        else:
+            logger.warning('%s %s: quarantined (%s)', stage, subject, error)
+
+    with concurrent.futures.ThreadPoolExecutor(max(1, max_workers)) as pool:
+        for future in [pool.submit(run, subject, job) for subject, job in pending.items()]:
+            future.result()
+    return {subject: stage_outputs(status, subject, stage) for subject in jobs
+            if stage_outputs(status, subject, stage) is not None}
+
+
+def _is_done(status, subject, stage, job):
+    """Whether a stage can be skipped: quarantined, or done with the same job and its outputs still on disk"""
+    subject_status = status['subjects'].get(subject)
+    if subject_status is None:
+        return False
+    if subject_status['quarantined'] is not None:
+        return True
+    stage_status = subject_status['stages'].get(stage)
+    if stage_status is None or stage_status['outputs'] is None or stage_status.get('job') != job:
+        return False
+    return all(os.path.exists(f) for f in stage_status['outputs'].values())
+
+
+def stage_outputs(status, subject, stage):
+    subject_status = status['subjects'].get(subject)
+    if subject_status is None or subject_status['quarantined'] is not None:
+        return None
+    return subject_status['stages'].get(stage, {}).get('outputs')
+
+
+def release_quarantine(status):
+    """Clear the quarantine so the failed subjects are retried from their failed stage"""
+    for subject_status in status['subjects'].values():
+        if subject_status['quarantined'] is not None:
+            subject_status['stages'].pop(subject_status['quarantined']['stage'], None)
+            subject_status['quarantined'] = None
+
+
+def _read_fsl_matrix(file_name):
+    import numpy as np
+
+    with open(file_name) as fileobj:
+        lines = [line.strip() for line in fileobj]
+    start = lines.index('/Matrix') + 1
+    return np.array([[float(v) for v in line.split()] for line in lines[start:] if line.strip()], ndmin=2)
+
+
+def filter_design(design_mat, tcon, keep, out_dir):
+    """Write the design matrix rows of the kept subjects and the matching contrasts
+
+    EVs left without any non-zero value (e.g. a group whose subjects were all dropped)
+    are removed from the design. Contrasts weighting a removed EV can no longer test
+    the same hypothesis, so they are removed rather than truncated.
+    Returns the paths of the new design matrix and contrasts.
+    """
+    import numpy as np
+
+    design = _read_fsl_matrix(design_mat)[keep]
+    contrasts = _read_fsl_matrix(tcon)
+    evs = np.any(design != 0, axis=0)
+    dropped = np.any(contrasts[:, ~evs] != 0, axis=1)
+    if dropped.any():
+        logger.warning('Dropping contrast(s) %s, they weight EVs without any remaining subject',
+                       ', '.join(str(i + 1) for i in np.flatnonzero(dropped)))
+    design = design[:, evs]
+    contrasts = contrasts[~dropped][:, evs]
+    if not len(contrasts):
+        raise ValueError('No contrast can be estimated from the remaining %d subjects' % len(design))
+
+    os.makedirs(out_dir, exist_ok=True)
+    out_mat = os.path.join(out_dir, 'design.mat')
+    out_con = os.path.join(out_dir, 'design.con')
+    _write_matrix(out_mat, '/NumWaves %d\n/NumPoints %d\n/Matrix\n' % (design.shape[1], design.shape[0]), design)
+    _write_matrix(out_con, '/NumWaves %d\n/NumContrasts %d\n/Matrix\n' % (contrasts.shape[1], contrasts.shape[0]),
+                  contrasts)
+    return out_mat, out_con
+
+
+def _write_matrix(file_name, header, matrix):
+    """Write an FSL matrix file, leaving an identical existing file untouched
+
+    nipype hashes the proc inputs by timestamp, so rewriting the design on --resume would rerun randomise.
+    """
+    import io
+    import numpy as np
+
+    text = io.StringIO()
+    text.write(header)
+    np.savetxt(text, matrix, fmt='%g')
+    if os.path.exists(file_name):
+        with open(file_name) as fileobj:
+            if fileobj.read() == text.getvalue():
+                return
+    with open(file_name, 'w') as fileobj:
+        fileobj.write(text.getvalue())
+
+
+def _segment(job, job_dir):
+    """BET and Atropos segmentation of one subject"""
+    import nipype.pipeline.engine as pe
+    from nipypeVBM.execution import workflow_outputs
+    from nipypeVBM.workflows import create_bet_workflow, create_preproc_workflow
+
+    wf = pe.Workflow(name='subject', base_dir=job_dir)
+    wf_root = os.path.join(job_dir, 'subject')
+    bet_workflow = create_bet_workflow(wf_root, job['intermediate_format'])
+    preproc_workflow = create_preproc_workflow(wf_root, job['cache_dir'], job['cache_max_gb'], job['profile'],
+                                               build_template=False, atlas_image=job['atlas_image'],
+                                               atlas_priors=job['atlas_priors'],
+                                               intermediate_format=job['intermediate_format'])
+    wf.connect(bet_workflow, 'output_node.brain_files', preproc_workflow, 'input_node.brain_files')
+    wf.connect(bet_workflow, 'output_node.mask_files', preproc_workflow, 'input_node.mask_files')
+    wf.inputs.fslvbm_1_bet.input_node.struct_files = [job['struct_file']]
+    # ANTs interfaces default to one thread, use the share of the CPUs given to this job
+    for name in wf.list_node_names():
+        node = wf.get_node(name)
+        if 'num_threads' in node.inputs.copyable_trait_names():
+            node.n_procs = job['num_threads']
+    exec_graph = wf.run(plugin='Linear')
+
+    bet_outputs = workflow_outputs(wf, exec_graph, 'fslvbm_1_bet')
+    preproc_outputs = workflow_outputs(wf, exec_graph, 'fslvbm_2_template')
+    return {'brain_file': bet_outputs['brain_files'][0], 'mask_file': bet_outputs['mask_files'][0],
+            'GM_file': preproc_outputs['GM_files'][0]}
+
+
+def _register(job, job_dir):
+    """Registration of one GM image to a template, with role 'affine', 'nonlinear' or 'refine'
+
+    A refine registration starts from job['initial_transform'], the composite transform of the
+    previous template iteration, instead of aligning the centres of mass.
+    """
+    import nipype.interfaces.ants as ants
+    from nipypeVBM.registration import configure_registration
+    from nipypeVBM.workflows import _extension
+
+    registration = ants.Registration()
+    configure_registration(registration, job['role'], job['profile'])
+    registration.inputs.fixed_image = job['fixed_image']
+    registration.inputs.moving_image = job['moving_image']
+    registration.inputs.write_composite_transform = True
+    if job.get('initial_transform') is None:
+        registration.inputs.initial_moving_transform_com = 1
+    else:
+        registration.inputs.initial_moving_transform = job['initial_transform']
+    registration.inputs.output_warped_image = 'transform_Warped' + _extension(job['intermediate_format'])
+    registration.inputs.num_threads = job['num_threads']
+    run_dir = os.path.join(job_dir, job['profile'])
+    os.makedirs(run_dir, exist_ok=True)
+    outputs = registration.run(cwd=run_dir).outputs
+    return {'warped_image': outputs.warped_image, 'composite_transform': outputs.composite_transform}
+
+
+_STAGES = {'segment': _segment, 'register': _register}
+
+
+def _generate_template(out_dir, warped_files, output_type='NIFTI_GZ'):
+    """Average the warped images in a cached node, left untouched on --resume if they have not changed
+
+    Rewriting the template would give it a new timestamp and invalidate the proc results.
+    """
+    import nipype.pipeline.engine as pe
+    from nipypeVBM.interfaces import GenerateTemplate
+
+    node = pe.Node(GenerateTemplate(input_files=warped_files, output_type=output_type),
+                   name=os.path.basename(out_dir), base_dir=os.path.dirname(out_dir))
+    return node.run().outputs.template_file
+
+
+def run_isolated_cohort(config, args):
+    """Run the full pipeline with every per-subject stage isolated, then proc on the surviving subjects
+
+    BET and segmentation, the affine and the nonlinear registrations run per subject in
+    separate processes through run_subject_stage, retried with config['fallback_profile'].
+    The templates are averaged over the subjects that passed, and proc warps the GM images
+    with the nonlinear transforms instead of registering them again, using the design rows
+    of the remaining subjects. Returns the executed proc graph.
+
+    Up to config['template_iterations'] nonlinear registrations refine the study template as in
+    create_preproc_workflow, each starting from the transforms of the previous one, until the
+    relative template change drops below config['template_threshold'].
+
+    Keyword arguments:
+    config -- dict of the run settings, saved in the status file so a run can be resumed
+    args -- parsed arguments of add_execution_arguments
+    """
+    from nipypeVBM.execution import cohort_resources, run_workflow
+    from nipypeVBM.workflows import _template_change, create_proc_workflow
+
+    output_root = config['output_root']
+    os.makedirs(output_root, exist_ok=True)
+    status = load_status(output_root)
+    status['config'] = config
+    save_status(output_root, status)
+
+    ids = subject_ids(config['struct_files'])
+    # Settings missing from the status file of an older run take their defaults
+    intermediate_format = config.get('intermediate_format', 'NIFTI_GZ')
+    merge_compression = config['merge_compression']
+    if merge_compression is None:
+        merge_compression = 0 if intermediate_format == 'NIFTI' else 1
+    profiles = [config['registration_profile']]
+    if config['fallback_profile'] not in (None, config['registration_profile']):
+        profiles.append(config['fallback_profile'])
+
+    def stage(name, jobs):
+        return run_subject_stage(output_root, status, name, jobs, profiles, config['subject_timeout'],
+                                 args.num_threads)
+
+    segmented = stage('segment', {subject: {'kind': 'segment', 'struct_file': struct_file,
+                                            'cache_dir': config['cache_dir'], 'cache_max_gb': config['cache_max_gb'],
+                                            'atlas_image': config['atlas_image'],
+                                            'atlas_priors': config['atlas_priors'],
+                                            'intermediate_format': intermediate_format}
+                                  for subject, struct_file in zip(ids, config['struct_files'])})
+
+    def register(name, role, subjects, fixed_image, initial=None):
+        # The image digests are part of the job, so a changed template or segmentation invalidates a registration
+        fixed_digest = file_digest(fixed_image)
+        jobs = {}
+        for subject in subjects:
+            jobs[subject] = {'kind': 'register', 'role': role, 'fixed_image': fixed_image,
+                             'fixed_digest': fixed_digest, 'moving_image': segmented[subject]['GM_file'],
+                             'moving_digest': file_digest(segmented[subject]['GM_file']),
+                             'intermediate_format': intermediate_format}
+            if initial is not None:
+                jobs[subject]['initial_transform'] = initial[subject]['composite_transform']
+                jobs[subject]['initial_digest'] = file_digest(initial[subject]['composite_transform'])
+        return stage(name, jobs)
+
+    if config['freeze_template'] is None:
+        affine = register('affine', 'affine', [s for s in ids if s in segmented], config['GM_template'])
+        affine_template = _generate_template(os.path.join(output_root, 'templates', 'affine'),
+                                             [affine[s]['warped_image'] for s in ids if s in affine],
+                                             intermediate_format)
+        nonlinear = register('nonlinear', 'nonlinear', [s for s in ids if s in affine], affine_template)
+        study_template = _generate_template(os.path.join(output_root, 'templates', 'nonlinear'),
+                                            [nonlinear[s]['warped_image'] for s in ids if s in nonlinear])
+
+        previous_template = affine_template
+        for iteration in range(2, config.get('template_iterations', 1) + 1):
+            converged, change = _template_change(study_template, previous_template,
+                                                 config.get('template_threshold', 0.01), False)
+            logger.info('Template change before iteration %d: %g', iteration, change)
+            if converged:
+                break
+            name = 'nonlinear_iter%d' % iteration
+            nonlinear = register(name, 'refine', [s for s in ids if s in nonlinear], study_template, nonlinear)
+            previous_template = study_template
+            study_template = _generate_template(os.path.join(output_root, 'templates', name),
+                                                [nonlinear[s]['warped_image'] for s in ids if s in nonlinear])
+    else:
+        study_template = config['freeze_template']
+        nonlinear = register('nonlinear', 'nonlinear', [s for s in ids if s in segmented], study_template)
+
+    kept = [s for s in ids if s in nonlinear]
+    if len(kept) < 2:
+        raise RuntimeError('Only %d subjects completed the per-subject stages' % len(kept))
+
+    design_mat, tcon = filter_design(config['design_mat'], config['tcon'], [ids.index(s) for s in kept],
+                                     os.path.join(output_root, 'design'))
+
+    wf = create_proc_workflow(output_root, config['sigma'], merge_compression, config['registration_profile'],
+                              config['randomise_shards'], reuse_transforms=True,
+                              intermediate_format=intermediate_format,
+                              resources=cohort_resources(args, len(kept), study_template))
+    wf.inputs.input_node.GM_files = [segmented[s]['GM_file'] for s in kept]
+    wf.inputs.input_node.transforms = [nonlinear[s]['composite_transform'] for s in kept]
+    wf.inputs.input_node.GM_template = study_template
+    wf.inputs.input_node.design_mat = design_mat
+    wf.inputs.input_node.tcon = tcon
+    return run_workflow(wf, args)
+
+
+if __name__ == '__main__':
+    job_file = sys.argv[1]
+    with open(job_file) as fileobj:
+        job = json.load(fileobj)
+    job_dir = os.path.dirname(os.path.abspath(job_file))
+    outputs = _STAGES[job.get('kind', job['stage'])](job, job_dir)
+    with open(os.path.join(job_dir, 'result.json'), 'w') as fileobj:
+        json.dump(outputs, fileobj, indent=2)
@@ -0,0 +1,140 @@
+import csv
+import json
+import os
+import time
+
+from nipype.pipeline.engine import MapNode
+
+_FIELDS = ['workflow', 'node', 'iteration', 'status', 'wall_time_s', 'cpu_time_s', 'peak_rss_gb',
+           'input_file_bytes', 'output_file_bytes', 'start_time']
+
+
+def _file_bytes(value):
+    """Total size of the existing files in a (nested) input or output value"""
+    if isinstance(value, (list, tuple)):
+        return sum(_file_bytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(_file_bytes(v) for v in value.values())
+    if isinstance(value, str) and os.path.isfile(value):
+        return os.path.getsize(value)
+    return 0
+
+
+def _split_name(node):
+    """Return the parent workflow, node name and MapNode iteration of a node"""
+    base_dir = node.base_dir or ''
+    if os.path.basename(base_dir) == 'mapflow':
+        # MapNode iterations have no workflow of their own, are named _<mapnode><index> and
+        # run in <workflow dir>/[<iterables dirs>/]<mapnode>/mapflow
+        mapnode_dir = os.path.dirname(base_dir)
+        name = os.path.basename(mapnode_dir)
+        workflow_dir = os.path.dirname(mapnode_dir)
+        while os.path.basename(workflow_dir).startswith('_'):
+            workflow_dir = os.path.dirname(workflow_dir)
+        return os.path.basename(workflow_dir), name, int(node.name[len(name) + 1:])
+    parts = node.fullname.split('.')
+    return parts[-2] if len(parts) > 1 else '', node.name, ''
+
+
+class NodeProfiler(object):
+    """status_callback for nipype plugins that records the resource use of every node
+
+    Wall and CPU time and peak RSS come from nipype's resource monitor, which also covers
+    in-process interfaces such as GenerateTemplate and GeneratePriors. The input and output
+    file bytes are the sizes on disk of the files named in the inputs and outputs of a node,
+    not the I/O it performed: a file read by several nodes is counted for each of them, and
+    whether a node reads all of its input files is not known.
+
+    Only the MultiProc plugin runs the MapNode iterations as nodes of their own and reports
+    a row per iteration; with Linear a MapNode is a single row summed over its iterations.
+    """
+
+    def __init__(self):
+        self.records = []
+        self._start_times = {}
+        self._iterated = set()
+
+    def __call__(self, node, status):
+        if status == 'start':
+            self._start_times[node.fullname] = time.time()
+            return
+
+        start_time = self._start_times.pop(node.fullname, None)
+        workflow, name, iteration = _split_name(node)
+        if iteration != '':
+            self._iterated.add((workflow, name))
+        elif isinstance(node, MapNode) and (workflow, name) in self._iterated:
+            # Collating the results of iterations that already have their own rows
+            return
+        record = {'workflow': workflow, 'node': name, 'iteration': iteration, 'status': status,
+                  'start_time': start_time, 'wall_time_s': None, 'cpu_time_s': None, 'peak_rss_gb': None,
+                  'input_file_bytes': None, 'output_file_bytes': None}
+        if start_time is not None:
+            record['wall_time_s'] = time.time() - start_time
+
+        try:
+            result = node.result
+        except Exception:
+            result = None
+        if result is not None:
+            # A MapNode run without per-iteration callbacks has a runtime per iteration
+            runtimes = result.runtime if isinstance(result.runtime, list) else [result.runtime]
+            durations = [getattr(runtime, 'duration', None) for runtime in runtimes]
+            if runtimes and None not in durations:
+                record['wall_time_s'] = sum(durations)
+                cpu_percents = [getattr(runtime, 'cpu_percent', None) for runtime in runtimes]
+                if None not in cpu_percents:
+                    record['cpu_time_s'] = sum(c / 100 * d for c, d in zip(cpu_percents, durations))
+            peaks = [getattr(runtime, 'mem_peak_gb', None) for runtime in runtimes]
+            if runtimes and None not in peaks:
+                record['peak_rss_gb'] = max(peaks)
+            if result.inputs is not None:
+                record['input_file_bytes'] = _file_bytes(result.inputs)
+            if result.outputs is not None:
+                # MapNodes return a Bunch rather than a TraitedSpec
+                outputs = result.outputs
+                record['output_file_bytes'] = _file_bytes(outputs.get() if hasattr(outputs, 'trait_get')
+                                                     else outputs.dictcopy())
+        self.records.append(record)
+
+    def hotspots(self):
+        """Aggregate the records per node, MapNode iterations combined, ranked by total wall time"""
+        totals = {}
+        for record in self.records:
+            key = (record['workflow'], record['node'])
+            total = totals.setdefault(key, {'workflow': key[0], 'node': key[1], 'count': 0, 'wall_time_s': 0.0,
+                                            'cpu_time_s': 0.0, 'max_peak_rss_gb': 0.0, 'input_file_bytes': 0,
+                                            'output_file_bytes': 0})
+            total['count'] += 1
+            total['wall_time_s'] += record['wall_time_s'] or 0
+            total['cpu_time_s'] += record['cpu_time_s'] or 0
+            total['max_peak_rss_gb'] = max(total['max_peak_rss_gb'], record['peak_rss_gb'] or 0)
+            total['input_file_bytes'] += record['input_file_bytes'] or 0
+            total['output_file_bytes'] += record['output_file_bytes'] or 0
+        return sorted(totals.values(), key=lambda t: t['wall_time_s'], reverse=True)
+
+    def write(self, out_dir):
+        """Write profile.json, profile.csv (one row per node run) and hotspots.txt to out_dir"""
+        os.makedirs(out_dir, exist_ok=True)
+        hotspots = self.hotspots()
+
+        with open(os.path.join(out_dir, 'profile.json'), 'w') as fileobj:
+            json.dump({'nodes': self.records, 'hotspots': hotspots}, fileobj, indent=2)
+
+        with open(os.path.join(out_dir, 'profile.csv'), 'w', newline='') as fileobj:
+            writer = csv.DictWriter(fileobj, fieldnames=_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.records)
+
+        total_wall = sum(t['wall_time_s'] for t in hotspots) or 1
+        with open(os.path.join(out_dir, 'hotspots.txt'), 'w') as fileobj:
+            fileobj.write('# in_file_MB and out_file_MB are the sizes of the input and output files of the nodes, '
+                          'not the I/O they performed\n')
+            fileobj.write('%-4s %-20s %-26s %5s %10s %6s %10s %9s %11s %11s\n'
+                          % ('rank', 'workflow', 'node', 'runs', 'wall_s', 'wall%', 'cpu_s', 'rss_gb',
+                             'in_file_MB', 'out_file_MB'))
+            for rank, t in enumerate(hotspots, 1):
+                fileobj.write('%-4d %-20s %-26s %5d %10.1f %6.1f %10.1f %9.2f %11.1f %11.1f\n'
+                              % (rank, t['workflow'], t['node'], t['count'], t['wall_time_s'],
+                                 100 * t['wall_time_s'] / total_wall, t['cpu_time_s'], t['max_peak_rss_gb'],
+                                 t['input_file_bytes'] / 2 ** 20, t['output_file_bytes'] / 2 ** 20))
@@ -0,0 +1,149 @@
+import csv
+import os
+import time
+
+
+def _stage(transform, parameters, iterations, smoothing_sigmas, shrink_factors, convergence_threshold=1e-6,
+           sampling_percentage=0.25):
+    return dict(transform=transform, transform_parameters=parameters, number_of_iterations=iterations,
+                smoothing_sigmas=smoothing_sigmas, shrink_factors=shrink_factors,
+                convergence_threshold=convergence_threshold, sampling_percentage=sampling_percentage)
+
+
+# Stage settings of the ANTs registrations, by profile and role:
+#   atlas -- MNI atlas to subject brain (deformable_priors)
+#   affine -- GM to GM template (affine_reg_to_GM)
+#   nonlinear -- GM to study template (nonlinear_reg_to_temp in preproc and proc)
+#   refine -- GM to study template starting from the transform of a preview run, so
+#             only the finer SyN levels are repeated
+_DEFAULT_LINEAR = [_stage('Rigid', (0.1,), [100, 50, 25], [4, 2, 1], [4, 2, 1]),
+                   _stage('Affine', (0.1,), [100, 50, 25], [4, 2, 1], [4, 2, 1])]
+_FAST_LINEAR = [_stage('Rigid', (0.1,), [100, 50], [4, 2], [4, 2], sampling_percentage=0.1),
+                _stage('Affine', (0.1,), [100, 50], [4, 2], [4, 2], sampling_percentage=0.1)]
+_ACCURATE_LINEAR = [_stage('Rigid', (0.1,), [1000, 500, 250, 100], [3, 2, 1, 0], [8, 4, 2, 1],
+                           sampling_percentage=0.5),
+                    _stage('Affine', (0.1,), [1000, 500, 250, 100], [3, 2, 1, 0], [8, 4, 2, 1],
+                           sampling_percentage=0.5)]
+
+REGISTRATION_PROFILES = {
+    'default': {
+        'float': False,
+        'atlas': _DEFAULT_LINEAR + [_stage('SyN', (0.1, 3, 0), [100, 20, 10], [3, 2, 1], [8, 4, 2], 1e-4)],
+        'affine': _DEFAULT_LINEAR,
+        'nonlinear': _DEFAULT_LINEAR + [_stage('SyN', (0.1, 3, 0), [100, 10, 5], [2, 1, 0], [4, 2, 1], 1e-4)],
+        'refine': [_stage('SyN', (0.1, 3, 0), [10, 5], [1, 0], [2, 1], 1e-4)],
+    },
+    # Stops at shrink factor 2 with sparser sampling and fewer SyN iterations, for large screening studies
+    'fast': {
+        'float': True,
+        'atlas': _FAST_LINEAR + [_stage('SyN', (0.1, 3, 0), [50, 10, 5], [3, 2, 1], [8, 4, 2], 1e-4, 0.1)],
+        'affine': _FAST_LINEAR,
+        'nonlinear': _FAST_LINEAR + [_stage('SyN', (0.1, 3, 0), [50, 5], [2, 1], [4, 2], 1e-4, 0.1)],
+        'refine': [_stage('SyN', (0.1, 3, 0), [5], [1], [2], 1e-4, 0.1)],
+    },
+    'accurate': {
+        'float': False,
+        'atlas': _ACCURATE_LINEAR + [_stage('SyN', (0.1, 3, 0), [100, 70, 50, 20], [3, 2, 1, 0], [8, 4, 2, 1],
+                                            1e-6, 0.5)],
+        'affine': _ACCURATE_LINEAR,
+        'nonlinear': _ACCURATE_LINEAR + [_stage('SyN', (0.1, 3, 0), [100, 70, 50, 20], [3, 2, 1, 0],
+                                                [8, 4, 2, 1], 1e-6, 0.5)],
+        'refine': [_stage('SyN', (0.1, 3, 0), [50, 20], [1, 0], [2, 1], 1e-6, 0.5)],
+    },
+}
+
+
+def configure_registration(node, role, profile='default'):
+    """Set the stage parameters of an ants.Registration node from a named profile
+
+    Keyword arguments:
+    node -- ants.Registration interface, or a Node or MapNode wrapping one
+    role -- 'atlas', 'affine', 'nonlinear' or 'refine', see REGISTRATION_PROFILES
+    profile -- name of the registration profile (default 'default')
+    """
+    if profile not in REGISTRATION_PROFILES:
+        raise ValueError('Unknown registration profile %s, expected one of %s'
+                         % (profile, ', '.join(sorted(REGISTRATION_PROFILES))))
+    stages = REGISTRATION_PROFILES[profile][role]
+    num_stages = len(stages)
+
+    node.inputs.dimension = 3
+    node.inputs.interpolation = 'Linear'
+    node.inputs.metric = ['MI'] * num_stages
+    node.inputs.metric_weight = [1.0] * num_stages
+    node.inputs.radius_or_number_of_bins = [32] * num_stages
+    node.inputs.sampling_strategy = ['Regular'] * num_stages
+    node.inputs.sampling_percentage = [stage['sampling_percentage'] for stage in stages]
+    node.inputs.transforms = [stage['transform'] for stage in stages]
+    node.inputs.transform_parameters = [stage['transform_parameters'] for stage in stages]
+    node.inputs.number_of_iterations = [stage['number_of_iterations'] for stage in stages]
+    node.inputs.convergence_threshold = [stage['convergence_threshold'] for stage in stages]
+    node.inputs.convergence_window_size = [10] * num_stages
+    node.inputs.smoothing_sigmas = [stage['smoothing_sigmas'] for stage in stages]
+    node.inputs.sigma_units = ['vox'] * num_stages
+    node.inputs.shrink_factors = [stage['shrink_factors'] for stage in stages]
+    if REGISTRATION_PROFILES[profile]['float']:
+        node.inputs.float = True
+
+
+def template_correlation(template_file, reference_file):
+    """Pearson correlation between two templates on the same grid"""
+    import nibabel as nib
+    import numpy as np
+
+    template_data = nib.load(template_file).get_fdata(dtype=np.float32).ravel()
+    reference_data = nib.load(reference_file).get_fdata(dtype=np.float32).ravel()
+    return float(np.corrcoef(template_data, reference_data)[0, 1])
+
+
+def benchmark_registration_profiles(brain_files, mask_files, GM_template, output_root,
+                                    profiles=('fast', 'default', 'accurate'), reference_profile='accurate',
+                                    plugin='Linear', plugin_args=None, atlas_image=None, atlas_priors=None):
+    """Run the template workflow once per profile and write runtime and template correlation to a CSV
+
+    The template of each profile is correlated with the template of reference_profile,
+    which is run first. The atlas defaults to ATLAS_IMAGE and ATLAS_PRIORS of workflows.
+    Returns the path of the CSV table.
+    """
+    from nipypeVBM.workflows import ATLAS_IMAGE, ATLAS_PRIORS, create_preproc_workflow
+
+    atlas_image = atlas_image or ATLAS_IMAGE
+    atlas_priors = atlas_priors or ATLAS_PRIORS
+
+    profiles = list(profiles)
+    if reference_profile in profiles:
+        profiles.remove(reference_profile)
+        profiles.insert(0, reference_profile)
+
+    results = []
+    for profile in profiles:
+        wf = create_preproc_workflow(os.path.join(output_root, profile), registration_profile=profile,
+                                     atlas_image=atlas_image, atlas_priors=atlas_priors)
+        wf.inputs.input_node.brain_files = brain_files
+        wf.inputs.input_node.mask_files = mask_files
+        wf.inputs.input_node.GM_template = GM_template
+
+        start = time.time()
+        exec_graph = wf.run(plugin=plugin, plugin_args=plugin_args)
+        runtime = time.time() - start
+
+        template_file = [node.result.outputs.template_file for node in exec_graph.nodes()
+                         if node.name == 'nonlinear_template'][0]
+        results.append({'profile': profile, 'runtime_s': runtime, 'template_file': template_file})
+
+    reference = [r for r in results if r['profile'] == reference_profile]
+    default = [r for r in results if r['profile'] == 'default']
+    for result in results:
+        if reference:
+            result['template_correlation'] = template_correlation(result['template_file'],
+                                                                  reference[0]['template_file'])
+        if default:
+            result['speedup_vs_default'] = default[0]['runtime_s'] / result['runtime_s']
+
+    table_file = os.path.join(output_root, 'registration_profiles.csv')
+    with open(table_file, 'w', newline='') as fileobj:
+        writer = csv.DictWriter(fileobj, fieldnames=['profile', 'runtime_s', 'speedup_vs_default',
+                                                     'template_correlation', 'template_file'])
+        writer.writeheader()
+        writer.writerows(results)
+    return table_file
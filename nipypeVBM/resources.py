@@ -0,0 +1,159 @@
+import math
+import re
+
+
+# Estimated memory of each node as (fixed GB, bytes per voxel), by node name. Nodes that
+# read the whole cohort at once (randomise) also scale with the number of subjects.
+_MULTITHREADED = {
+    'deformable_priors': (0.5, 400),
+    'affine_reg_to_GM': (0.5, 100),
+    'nonlinear_reg_to_temp': (0.5, 400),
+    'warp_priors': (0.3, 100),
+    'ants_atropos': (0.5, 200),
+}
+_SINGLE_THREADED = {
+    'fsl_bet': (0.3, 20),
+    'downsample_brains': (0.2, 16),
+    'downsample_masks': (0.2, 8),
+    'downsample_template': (0.2, 16),
+    'downsample_study_template': (0.2, 16),
+    'generate_priors': (0.2, 32),
+    'affine_template': (0.2, 24),
+    'nonlinear_template': (0.2, 24),
+    'create_jac': (0.3, 50),
+    'warp_GM': (0.3, 50),
+    'split_transforms': (0.3, 50),
+    'combine_randomise': (0.3, 24),
+}
+# Cohort nodes that process subjects in parallel in-process, memory per thread
+_POOLED = {
+    'gm_mod_smooth': (0.3, 16),
+}
+_PER_SUBJECT_BYTES = {
+    'randomise': 12,
+    'final_randomise': 12,
+}
+
+
+def image_voxels(image_file):
+    """Number of voxels in the first three dimensions of an image, read from its header"""
+    import nibabel as nib
+
+    shape = nib.load(image_file).shape
+    return int(shape[0] * shape[1] * shape[2])
+
+
+def estimate_resources(node_name, n_subjects, n_voxels, max_procs, max_mem_gb=None, shared=True):
+    """Return (n_procs, mem_gb) for a node, or None for nodes without an estimate
+
+    When the copies of a node share max_procs (MultiProc), multithreaded ANTs nodes get
+    max_procs divided by the number of copies that can run at once, limited by the cohort
+    size and by how many fit in max_mem_gb. Cluster jobs each get a node of their own,
+    shared=False, so every copy gets max_procs.
+    """
+    if node_name in _MULTITHREADED:
+        fixed_gb, bytes_per_voxel = _MULTITHREADED[node_name]
+        mem_gb = fixed_gb + n_voxels * bytes_per_voxel / 2 ** 30
+        concurrent = min(n_subjects, max_procs) if shared else 1
+        if max_mem_gb is not None:
+            concurrent = min(concurrent, int(max_mem_gb // mem_gb))
+        n_procs = max(1, max_procs // max(1, concurrent))
+    elif node_name in _SINGLE_THREADED:
+        fixed_gb, bytes_per_voxel = _SINGLE_THREADED[node_name]
+        mem_gb = fixed_gb + n_voxels * bytes_per_voxel / 2 ** 30
+        n_procs = 1
+    elif node_name in _POOLED:
+        fixed_gb, bytes_per_voxel = _POOLED[node_name]
+        n_procs = max_procs
+        if max_mem_gb is not None:
+            n_procs = max(1, min(n_procs, int((max_mem_gb - fixed_gb) // (n_voxels * bytes_per_voxel / 2 ** 30))))
+        mem_gb = fixed_gb + n_procs * n_voxels * bytes_per_voxel / 2 ** 30
+    elif node_name in _PER_SUBJECT_BYTES:
+        mem_gb = 0.5 + n_subjects * n_voxels * _PER_SUBJECT_BYTES[node_name] / 2 ** 30
+        n_procs = 1
+    else:
+        return None
+
+    if max_mem_gb is not None:
+        mem_gb = min(mem_gb, max_mem_gb)
+    return min(n_procs, max_procs), mem_gb
+
+
+class NodeResources(object):
+    """n_procs and mem_gb of the nodes of a workflow run on a cohort, from estimate_resources
+
+    Passed as resources to the create_*_workflow functions, which give each node
+    the Node keyword arguments returned for its name.
+
+    Keyword arguments:
+    n_subjects -- number of subjects in the cohort
+    n_voxels -- voxels of the images, see image_voxels
+    max_procs -- CPUs available to the workflow, or to each job with shared=False
+    max_mem_gb -- memory budget in GB, or of each job with shared=False (default None, no limit)
+    shared -- whether the nodes share max_procs and max_mem_gb, False for cluster jobs (default True)
+    """
+
+    def __init__(self, n_subjects, n_voxels, max_procs, max_mem_gb=None, shared=True):
+        self.n_subjects = n_subjects
+        self.n_voxels = n_voxels
+        self.max_procs = max_procs
+        self.max_mem_gb = max_mem_gb
+        self.shared = shared
+
+    def __call__(self, name):
+        # Iterations of the template loop are sized like the first one
+        resources = estimate_resources(_node_name(name), self.n_subjects, self.n_voxels, self.max_procs,
+                                       self.max_mem_gb, self.shared)
+        if resources is None:
+            return {}
+        n_procs, mem_gb = resources
+        return {'n_procs': n_procs, 'mem_gb': mem_gb}
+
+
+def _node_name(name):
+    return re.sub(r'_iter\d+$', '', name.split('.')[-1])
+
+
+def _has_estimate(node_name):
+    return any(node_name in table for table in (_MULTITHREADED, _SINGLE_THREADED, _POOLED, _PER_SUBJECT_BYTES))
+
+
+def resize_nodes(wf, resources):
+    """Give the nodes of a built workflow the sizes of resources, as the create_*_workflow functions do
+
+    For copies of a workflow built once and run on cohorts of different sizes. nipype only
+    has a public setter for n_procs, mem_gb is set where the Node constructor stores it.
+    """
+    for name in wf.list_node_names():
+        sizes = resources(name)
+        if sizes:
+            node = wf.get_node(name)
+            node.n_procs = sizes['n_procs']
+            node._mem_gb = sizes['mem_gb']
+
+
+def configure_scheduler(wf, plugin, queue_args=''):
+    """Request the n_procs and mem_gb of every sized node from SLURM or SGE
+
+    The requests are appended to queue_args in the plugin_args of each node that has
+    an estimate in estimate_resources. The nodes have to be sized with shared=False, see
+    NodeResources, so that each job asks for the threads it needs rather than a share of
+    a local MultiProc pool. Other plugins read n_procs and mem_gb themselves.
+    """
+    if plugin not in ('SLURM', 'SGE'):
+        return
+    for name in wf.list_node_names():
+        if not _has_estimate(_node_name(name)):
+            continue
+        node = wf.get_node(name)
+        n_procs, mem_gb = node.n_procs, node.mem_gb
+
+        if plugin == 'SLURM':
+            node.plugin_args = {'sbatch_args': '%s --cpus-per-task=%d --mem=%dG'
+                                               % (queue_args, n_procs, math.ceil(mem_gb)),
+                                'overwrite': True}
+        else:
+            # h_vmem is requested per slot
+            node.plugin_args = {'qsub_args': '%s -pe smp %d -l h_vmem=%dG'
+                                             % (queue_args, n_procs, math.ceil(mem_gb / n_procs)),
+                                'overwrite': True}
@@ -0,0 +1,315 @@
+import copy
+import getpass
+import glob
+import gzip
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import time
+import traceback
+from argparse import Namespace
+
+from nipypeVBM.cache import file_digest
+from nipypeVBM.execution import cohort_resources, run_workflow
+from nipypeVBM.resources import resize_nodes
+from nipypeVBM.workflows import ATLAS_IMAGE, ATLAS_PRIORS, create_nipypevbm_workflow
+
+QUEUE_DIRS = ['incoming', 'running', 'done', 'failed']
+MANIFEST_FILES = ['struct_files', 'GM_template', 'design_mat', 'tcon']
+# Manifest options passed on to create_nipypevbm_workflow, the transform cache is shared by the service
+WORKFLOW_OPTIONS = ['sigma', 'merge_compression', 'registration_profile', 'randomise_shards', 'atlas_image',
+                    'atlas_priors', 'template_iterations', 'template_threshold', 'reuse_transforms',
+                    'intermediate_format']
+
+
+def _abspath(path, root):
+    return os.path.abspath(os.path.join(root, os.path.expanduser(path)))
+
+
+def submit(manifest_file, queue_dir):
+    """Copy a study manifest into the queue with absolute paths, returning its queued path
+
+    The manifest is a JSON object with the struct_files, GM_template, design_mat, tcon and
+    output_root of the study, and optionally its name, owner (for the fair sharing, default
+    the current user) and options (a dict of WORKFLOW_OPTIONS). Relative paths are taken
+    from the directory of the manifest.
+    """
+    with open(manifest_file) as fileobj:
+        manifest = json.load(fileobj)
+    root = os.path.dirname(os.path.abspath(manifest_file))
+
+    manifest['struct_files'] = [_abspath(f, root) for f in manifest['struct_files']]
+    for a in MANIFEST_FILES[1:] + ['output_root']:
+        manifest[a] = _abspath(manifest[a], root)
+    options = manifest.setdefault('options', {})
+    for a in ['atlas_image', 'atlas_priors']:
+        if a in options:
+            options[a] = _abspath(options[a], root)
+    manifest.setdefault('name', os.path.basename(manifest_file).split('.json')[0])
+    manifest.setdefault('owner', getpass.getuser())
+
+    # Write then rename, the service only picks up complete .json files
+    incoming = os.path.join(queue_dir, 'incoming')
+    os.makedirs(incoming, exist_ok=True)
+    queued = os.path.join(incoming, '%s_%d.json' % (manifest['name'], time.time() * 1000))
+    with open(os.path.join(incoming, '.' + os.path.basename(queued) + '.tmp'), 'w') as fileobj:
+        json.dump(manifest, fileobj, indent=2)
+    os.replace(fileobj.name, queued)
+    return queued
+
+
+def load_manifest(manifest_file):
+    """Load and check a queued manifest, raising ValueError if it cannot be run"""
+    with open(manifest_file) as fileobj:
+        manifest = json.load(fileobj)
+    missing = [a for a in MANIFEST_FILES + ['output_root'] if a not in manifest]
+    if missing:
+        raise ValueError('Manifest is missing %s' % ', '.join(missing))
+    if not manifest['struct_files']:
+        raise ValueError('Manifest has no struct_files')
+    unknown = set(manifest.get('options', {})) - set(WORKFLOW_OPTIONS)
+    if unknown:
+        raise ValueError('Unknown options %s, expected some of %s' % (', '.join(sorted(unknown)), WORKFLOW_OPTIONS))
+    for f in manifest['struct_files'] + [manifest[a] for a in MANIFEST_FILES[1:]]:
+        if not os.path.isabs(f) or not os.path.exists(f):
+            raise ValueError('%s is not an existing absolute path' % f)
+    manifest.setdefault('options', {})
+    manifest.setdefault('owner', 'default')
+    return manifest
+
+
+class AtlasCache(object):
+    """Uncompressed copies of the atlas images, staged once per atlas version for the life of the service
+
+    ANTs reads every prior warp and registration's atlas from the staged .nii, which stays in
+    the page cache (or in memory if stage_dir is on a tmpfs such as /dev/shm) instead of being
+    gunzipped again. The digests of the staged copies are computed once and memoized, so the
+    transform cache keys computed in the study processes no longer hash the atlas per MapNode iteration.
+    """
+
+    def __init__(self, stage_dir):
+        self.stage_dir = stage_dir
+        self._staged = {}
+        os.makedirs(stage_dir, exist_ok=True)
+
+    def stage(self, image):
+        stat = os.stat(image)
+        key = (os.path.abspath(image), stat.st_size, stat.st_mtime_ns)
+        if key not in self._staged:
+            name = os.path.basename(image).split('.nii')[0]
+            staged = os.path.join(self.stage_dir, '%s_%s.nii' % (name, file_digest(image)[:16]))
+            if not os.path.exists(staged):
+                opener = gzip.open if image.endswith('.gz') else open
+                with opener(image, 'rb') as src, open(staged + '.tmp', 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 2 ** 24)
+                os.replace(staged + '.tmp', staged)
+            file_digest(staged)
+            self._staged[key] = staged
+        return self._staged[key]
+
+
+class WorkflowCache(object):
+    """Built nipypevbm workflows, one per distinct set of options, copied and sized for each study"""
+
+    def __init__(self, work_dir, cache_dir=None, cache_max_gb=50):
+        self.work_dir = work_dir
+        self.cache_dir = cache_dir
+        self.cache_max_gb = cache_max_gb
+        self._workflows = {}
+
+    def get(self, options, output_root, resources=None):
+        key = json.dumps(options, sort_keys=True)
+        if key not in self._workflows:
+            self._workflows[key] = create_nipypevbm_workflow(self.work_dir, cache_dir=self.cache_dir,
+                                                             cache_max_gb=self.cache_max_gb, **options)
+        wf = copy.deepcopy(self._workflows[key])
+        if resources is not None:
+            resize_nodes(wf, resources)
+        # At run time nipype places every node under the base_dir of the top-level workflow
+        wf.base_dir = output_root
+        return wf
+
+
+class FairShareScheduler(object):
+    """Pick the next study of the owner that has used the least CPU time, oldest first within an owner
+
+    The CPU time of an owner is the threads times the wall time of their finished studies,
+    plus that of their running studies so far.
+    """
+
+    def __init__(self):
+        self.usage = {}
+
+    def charge(self, owner, cpu_seconds):
+        self.usage[owner] = self.usage.get(owner, 0) + cpu_seconds
+
+    def pick(self, pending, running):
+        now = time.time()
+        load = dict(self.usage)
+        for study in running:
+            load[study['owner']] = load.get(study['owner'], 0) + study['n_procs'] * (now - study['start'])
+        return min(pending, key=lambda study: (load.get(study['owner'], 0), study['submitted']))
+
+
+def _run_study(wf, manifest, args, log_file, error_file):
+    """Body of the forked study process"""
+    # Own process group, so the service can stop the study with its ANTs and FSL children
+    os.setsid()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    log = open(log_file, 'a')
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+
+    try:
+        # wf.inputs of the copied workflow does not reach its nodes, set them on the node itself
+        input_node = wf.get_node('input_node')
+        for a in MANIFEST_FILES:
+            setattr(input_node.inputs, a, manifest[a])
+        run_workflow(wf, args)
+    except BaseException:
+        with open(error_file, 'w') as fileobj:
+            fileobj.write(traceback.format_exc())
+        raise
+
+
+class BatchService(object):
+    """Long-running runner of the study manifests queued in a directory
+
+    The service imports nipype once, stages the atlases, memoizes their digests and keeps
+    one built workflow per set of options. Each study runs in a process forked from the
+    service, which inherits all of this, so its startup only copies the cached workflow.
+    Up to max_studies studies run at once, picked by FairShareScheduler. A study gets an
+    equal share of num_threads and mem_gb between the studies that will be running with it,
+    counting the queued ones, so a study alone gets all of them. Running studies keep the
+    share they started with, so CPUs can be oversubscribed until they finish. Manifests move
+    from incoming to running, then to done or failed with a .result.json next to them;
+    manifests left in running by a stopped service are queued again on start, and nipype
+    resumes them from their output_root.
+
+    Keyword arguments:
+    queue_dir -- directory holding the incoming, running, done and failed manifests
+    num_threads -- CPUs shared by the running studies (default 1)
+    max_studies -- number of studies run at once (default 1)
+    mem_gb -- memory in GB shared by the running studies (default None, let the plugin decide)
+    cache_dir -- transform cache shared by all studies (default None, no caching)
+    cache_max_gb -- size cap of cache_dir in GB (default 50)
+    stage_dir -- directory of the uncompressed atlases, e.g. on /dev/shm (default queue_dir/atlas)
+    atlas_image -- masked T1 atlas of the studies not giving their own (default ATLAS_IMAGE)
+    atlas_priors -- 4D priors of the studies not giving their own (default ATLAS_PRIORS)
+    profile -- write a node profile to output_root/profile for every study (default False)
+    """
+
+    def __init__(self, queue_dir, num_threads=1, max_studies=1, mem_gb=None, cache_dir=None, cache_max_gb=50,
+                 stage_dir=None, atlas_image=ATLAS_IMAGE, atlas_priors=ATLAS_PRIORS, profile=False):
+        self.queue_dir = os.path.abspath(queue_dir)
+        for d in QUEUE_DIRS:
+            os.makedirs(os.path.join(self.queue_dir, d), exist_ok=True)
+        self.num_threads = num_threads
+        self.max_studies = max_studies
+        self.mem_gb = mem_gb
+        self.atlas_image = atlas_image
+        self.atlas_priors = atlas_priors
+        self.profile = profile
+        self.atlases = AtlasCache(stage_dir or os.path.join(self.queue_dir, 'atlas'))
+        self.workflows = WorkflowCache(os.path.join(self.queue_dir, 'work'), cache_dir, cache_max_gb)
+        self.scheduler = FairShareScheduler()
+        self.running = {}
+        self._stop = False
+
+        for manifest_file in glob.glob(os.path.join(self.queue_dir, 'running', '*.json')):
+            os.replace(manifest_file, os.path.join(self.queue_dir, 'incoming', os.path.basename(manifest_file)))
+
+    def _path(self, state, manifest_file, suffix=''):
+        return os.path.join(self.queue_dir, state, os.path.basename(manifest_file).split('.json')[0] + suffix)
+
+    def _finish(self, manifest_file, state, result):
+        os.replace(manifest_file, self._path(state, manifest_file, '.json'))
+        with open(self._path(state, manifest_file, '.result.json'), 'w') as fileobj:
+            json.dump(result, fileobj, indent=2)
+        print('%s: %s' % (os.path.basename(manifest_file), state))
+
+    def _pending(self):
+        pending = []
+        for manifest_file in sorted(glob.glob(os.path.join(self.queue_dir, 'incoming', '*.json'))):
+            try:
+                manifest = load_manifest(manifest_file)
+            except (ValueError, KeyError, TypeError) as error:
+                self._finish(manifest_file, 'failed', {'error': str(error)})
+                continue
+            pending.append({'file': manifest_file, 'manifest': manifest, 'owner': manifest['owner'],
+                            'submitted': os.path.getmtime(manifest_file)})
+        return pending
+
+    def _start(self, study, concurrent):
+        n_procs = max(1, self.num_threads // concurrent)
+        mem_gb = self.mem_gb / concurrent if self.mem_gb is not None else None
+        manifest = study['manifest']
+        running_file = self._path('running', study['file'], '.json')
+        os.replace(study['file'], running_file)
+        try:
+            options = dict(manifest['options'])
+            options['atlas_image'] = self.atlases.stage(options.get('atlas_image', self.atlas_image))
+            options['atlas_priors'] = self.atlases.stage(options.get('atlas_priors', self.atlas_priors))
+            args = Namespace(num_threads=n_procs, mem_gb=mem_gb, plugin=None, queue_args='',
+                             profile=os.path.join(manifest['output_root'], 'profile') if self.profile else None)
+            resources = cohort_resources(args, len(manifest['struct_files']), manifest['struct_files'][0])
+            wf = self.workflows.get(options, manifest['output_root'], resources)
+        except (ValueError, KeyError, OSError) as error:
+            self._finish(running_file, 'failed', {'error': str(error)})
+            return
+
+        os.makedirs(manifest['output_root'], exist_ok=True)
+        error_file = self._path('running', running_file, '.error')
+        process = multiprocessing.get_context('fork').Process(
+            target=_run_study, args=(wf, manifest, args, os.path.join(manifest['output_root'], 'service.log'),
+                                     error_file))
+        process.start()
+        self.running[running_file] = {'process': process, 'owner': study['owner'], 'n_procs': n_procs,
+                                      'start': time.time(), 'error_file': error_file}
+        print('%s: started with %d threads' % (os.path.basename(running_file), n_procs))
+
+    def _reap(self):
+        for running_file, study in list(self.running.items()):
+            if study['process'].is_alive():
+                continue
+            del self.running[running_file]
+            end = time.time()
+            self.scheduler.charge(study['owner'], study['n_procs'] * (end - study['start']))
+            result = {'owner': study['owner'], 'n_procs': study['n_procs'], 'start': study['start'], 'end': end,
+                      'exitcode': study['process'].exitcode}
+            if os.path.exists(study['error_file']):
+                with open(study['error_file']) as fileobj:
+                    result['error'] = fileobj.read()
+                os.remove(study['error_file'])
+            self._finish(running_file, 'done' if result['exitcode'] == 0 else 'failed', result)
+
+    def stop(self, *_):
+        self._stop = True
+
+    def serve(self, poll_interval=5, exit_when_idle=False):
+        """Run the queued studies until stopped (SIGTERM or SIGINT), or until the queue is empty"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        while not self._stop:
+            self._reap()
+            pending = self._pending()
+            while pending and len(self.running) < self.max_studies:
+                study = self.scheduler.pick(pending, self.running.values())
+                pending.remove(study)
+                self._start(study, min(self.max_studies, len(self.running) + 1 + len(pending)))
+            if exit_when_idle and not pending and not self.running:
+                break
+            time.sleep(poll_interval)
+
+        # Stopped: kill the running studies and queue them again for the next start
+        for running_file, study in self.running.items():
+            try:
+                os.killpg(study['process'].pid, signal.SIGKILL)
+            except ProcessLookupError:
+                study['process'].kill()
+            study['process'].join()
+            os.replace(running_file, os.path.join(self.queue_dir, 'incoming', os.path.basename(running_file)))
+        self.running = {}
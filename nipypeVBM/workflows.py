@@ -1,39 +1,162 @@
+import math
 import os
+from typing import List, Union
 
 import nipype.pipeline.engine as pe
 import nipype.interfaces.fsl as fsl
 import nipype.interfaces.ants as ants
 import nipype.interfaces.utility as util
 
-from nipypeVBM.interfaces import GenerateTemplate, GeneratePriors
+from nipypeVBM.interfaces import GenerateTemplate, GeneratePriors, ModulateSmooth, CachedRegistration, \
+    CachedApplyTransforms, RandomiseShard, CombineRandomise, SkippableRegistration, SingleWarpCompositeTransformUtil
+from nipypeVBM.registration import configure_registration
+from nipypeVBM.resources import NodeResources
 
+# Masked T1 of the mni_icbm152_nlin_sym_09c atlas and its 4D CSF, GM and WM priors
+ATLAS_IMAGE = '/home/j/jiwonoh/jglaist1/atlas/mni_icbm152_nlin_sym_09c/mni_icbm152_t1_tal_nlin_sym_09c_masked_RAI.nii.gz'
+ATLAS_PRIORS = '/home/j/jiwonoh/jglaist1/atlas/mni_icbm152_nlin_sym_09c/mni_icbm152_combined_tal_nlin_sym_09c_RAI.nii.gz'
 
-def create_nipypevbm_workflow(output_root: str, sigma: float = 2) -> pe.Workflow:
+INTERMEDIATE_FORMATS = ['NIFTI_GZ', 'NIFTI']
+
+
+def _extension(image_format):
+    return '.nii' if image_format == 'NIFTI' else '.nii.gz'
+
+
+def _sized(resources, name):
+    """n_procs and mem_gb keyword arguments of a node, none without resources"""
+    return resources(name) if resources is not None else {}
+
+
+def create_nipypevbm_workflow(output_root: str, sigma: Union[float, List[float]] = 2, merge_compression: int = None,
+                              cache_dir: str = None, cache_max_gb: float = 50,
+                              registration_profile: str = 'default', incremental: bool = False,
+                              freeze_template: bool = False, randomise_shards: int = 1,
+                              atlas_image: str = ATLAS_IMAGE, atlas_priors: str = ATLAS_PRIORS,
+                              preview: bool = False, preview_spacing: float = 3, preview_profile: str = 'fast',
+                              warm_start: bool = False, template_iterations: int = 1,
+                              template_threshold: float = 0.01, reuse_transforms: bool = False,
+                              intermediate_format: str = 'NIFTI_GZ',
+                              reuse_affine_template: bool = False, resources: NodeResources = None) -> pe.Workflow:
     """Run the NipypeVBM workflow from start to finish
 
     Keyword arguments:
-    real -- the real part (default 0.0)
-    imag -- the imaginary part (default 0.0)
+    sigma -- sigma of the Gaussian smoothing in mm, or a list of sigmas to compare (default 2)
+    merge_compression -- gzip level of the 4D randomise input, 0 for uncompressed .nii
+                         (default 1, or 0 with NIFTI intermediates)
+    cache_dir -- directory caching the atlas-to-subject registrations across runs (default None, no caching)
+    cache_max_gb -- size cap of cache_dir in GB, least recently used entries are evicted (default 50)
+    registration_profile -- 'fast', 'default' or 'accurate' ANTs settings, see REGISTRATION_PROFILES
+    incremental -- register only the subjects after the first n_previous to the affine template given on the
+                   input node, and add them to the nonlinear template running sums (default False)
+    freeze_template -- skip template building and register to the input node's study_template (default False)
+    randomise_shards -- number of parallel randomise jobs the TFCE permutations are split over (default 1)
+    atlas_image -- masked T1 atlas registered to each subject (default ATLAS_IMAGE)
+    atlas_priors -- 4D CSF, GM and WM priors on the atlas grid (default ATLAS_PRIORS)
+    preview -- only run a draft of the pipeline on BET outputs downsampled to preview_spacing, giving a
+               GM template, mask and uncorrected t-maps (default False)
+    preview_spacing -- voxel size in mm of the preview (default 3)
+    preview_profile -- registration profile of the preview (default 'fast')
+    warm_start -- initialise the full resolution nonlinear_reg_to_temp with the transforms of the preview,
+                  which is reused from an earlier preview run in the same output_root (default False)
+    template_iterations -- maximum number of nonlinear template iterations (default 1)
+    template_threshold -- relative template change below which the remaining iterations are skipped (default 0.01)
+    reuse_transforms -- warp the GM images in proc with the transforms of the last template iteration
+                        instead of registering them again (default False)
+    intermediate_format -- 'NIFTI' to hand uncompressed images between nodes, which skips gzip and lets
+                           nibabel memory-map them; the templates and randomise outputs stay compressed
+                           (default 'NIFTI_GZ')
+    reuse_affine_template -- in an incremental run after the first, register the new subjects to the
+                             affine_template_file of the input node instead of building an affine template
+                             (default False)
+    resources -- n_procs and mem_gb of the nodes for the cohort, see execution.cohort_resources
+                 (default None, the nipype defaults)
     """
+    if merge_compression is None:
+        merge_compression = 0 if intermediate_format == 'NIFTI' else 1
+    if preview and (incremental or warm_start):
+        raise ValueError('preview cannot be combined with incremental or warm_start')
+    if warm_start and freeze_template:
+        raise ValueError('warm_start needs a template to be built, it cannot be combined with freeze_template')
+    if reuse_transforms and freeze_template:
+        raise ValueError('reuse_transforms needs a template to be built, it cannot be combined with freeze_template')
+    if reuse_affine_template and not incremental:
+        raise ValueError('reuse_affine_template is only used in incremental mode')
+    if reuse_transforms and incremental:
+        raise ValueError('incremental mode only registers the new subjects to the template, '
+                         'it cannot be combined with reuse_transforms')
+
     wf = pe.Workflow(name='nipypevbm', base_dir=output_root)
     wf_root = os.path.join(output_root, 'nipypevbm')
 
     input_node = pe.Node(
         interface=util.IdentityInterface(
-            fields=['struct_files', 'GM_template', 'design_mat', 'tcon']),
+            fields=['struct_files', 'GM_template', 'design_mat', 'tcon', 'study_template', 'n_previous',
+                    'affine_template_file', 'nonlinear_sum_file', 'nonlinear_count']),
         name='input_node')
+    input_node.inputs.n_previous = 0
 
-    bet_workflow = create_bet_workflow(wf_root)
+    bet_workflow = create_bet_workflow(wf_root, intermediate_format, resources)
     wf.connect(input_node, 'struct_files', bet_workflow, 'input_node.struct_files')
 
-    preproc_workflow = create_preproc_workflow(wf_root)
+    if preview or warm_start:
+        # The preview sub-workflows keep the same names either way, so a warm start reuses a finished preview
+        downsample_workflow = create_downsample_workflow(wf_root, preview_spacing, intermediate_format,
+                                                         preview and freeze_template, resources)
+        wf.connect(bet_workflow, 'output_node.brain_files', downsample_workflow, 'input_node.brain_files')
+        wf.connect(bet_workflow, 'output_node.mask_files', downsample_workflow, 'input_node.mask_files')
+        wf.connect(input_node, 'GM_template', downsample_workflow, 'input_node.GM_template')
+        if preview and freeze_template:
+            wf.connect(input_node, 'study_template', downsample_workflow, 'input_node.study_template')
+
+        preview_preproc = create_preproc_workflow(wf_root, cache_dir, cache_max_gb, preview_profile,
+                                                  build_template=not freeze_template, atlas_image=atlas_image,
+                                                  atlas_priors=atlas_priors, intermediate_format=intermediate_format,
+                                                  name='fslvbm_2_template_preview', resources=resources)
+        for field in ['brain_files', 'mask_files', 'GM_template']:
+            wf.connect(downsample_workflow, 'output_node.' + field, preview_preproc, 'input_node.' + field)
+
+    if preview:
+        preview_proc = create_proc_workflow(wf_root, sigma, merge_compression, preview_profile, tfce=False,
+                                            num_perm=100, intermediate_format=intermediate_format,
+                                            name='fslvbm_3_proc_preview', resources=resources)
+        wf.connect(preview_preproc, 'output_node.GM_files', preview_proc, 'input_node.GM_files')
+        if freeze_template:
+            # Register the downsampled GM images to the study template on the same grid
+            wf.connect(downsample_workflow, 'output_node.study_template', preview_proc, 'input_node.GM_template')
+        else:
+            wf.connect(preview_preproc, 'output_node.GM_template', preview_proc, 'input_node.GM_template')
+        wf.connect(input_node, 'design_mat', preview_proc, 'input_node.design_mat')
+        wf.connect(input_node, 'tcon', preview_proc, 'input_node.tcon')
+        return wf
+
+    preproc_workflow = create_preproc_workflow(wf_root, cache_dir, cache_max_gb, registration_profile,
+                                               build_template=not freeze_template, incremental=incremental,
+                                               reuse_affine_template=reuse_affine_template,
+                                               atlas_image=atlas_image, atlas_priors=atlas_priors,
+                                               warm_start=warm_start, template_iterations=template_iterations,
+                                               template_threshold=template_threshold,
+                                               intermediate_format=intermediate_format, resources=resources)
     wf.connect(bet_workflow, 'output_node.brain_files', preproc_workflow, 'input_node.brain_files')
     wf.connect(bet_workflow, 'output_node.mask_files', preproc_workflow, 'input_node.mask_files')
     wf.connect(input_node, 'GM_template', preproc_workflow, 'input_node.GM_template')
-
-    proc_workflow = create_proc_workflow(wf_root, sigma)
+    if incremental and not freeze_template:
+        for field in ['n_previous', 'affine_template_file', 'nonlinear_sum_file', 'nonlinear_count']:
+            wf.connect(input_node, field, preproc_workflow, 'input_node.' + field)
+    if warm_start:
+        wf.connect(preview_preproc, 'output_node.nonlinear_transforms', preproc_workflow,
+                   'input_node.initial_transforms')
+
+    proc_workflow = create_proc_workflow(wf_root, sigma, merge_compression, registration_profile, randomise_shards,
+                                         reuse_transforms=reuse_transforms, intermediate_format=intermediate_format,
+                                         resources=resources)
     wf.connect(preproc_workflow, 'output_node.GM_files', proc_workflow, 'input_node.GM_files')
-    wf.connect(preproc_workflow, 'output_node.GM_template', proc_workflow, 'input_node.GM_template')
+    if reuse_transforms:
+        wf.connect(preproc_workflow, 'output_node.nonlinear_transforms', proc_workflow, 'input_node.transforms')
+    if freeze_template:
+        wf.connect(input_node, 'study_template', proc_workflow, 'input_node.GM_template')
+    else:
+        wf.connect(preproc_workflow, 'output_node.GM_template', proc_workflow, 'input_node.GM_template')
     wf.connect(input_node, 'design_mat', proc_workflow, 'input_node.design_mat')
     wf.connect(input_node, 'tcon', proc_workflow, 'input_node.tcon')
 
@@ -42,7 +165,8 @@ def create_nipypevbm_workflow(output_root: str, sigma: float = 2) -> pe.Workflow
     return wf
 
 
-def create_bet_workflow(output_root: str) -> pe.Workflow:
+def create_bet_workflow(output_root: str, intermediate_format: str = 'NIFTI_GZ',
+                        resources: NodeResources = None) -> pe.Workflow:
     # Set up workflow
     wf = pe.Workflow(name='fslvbm_1_bet', base_dir=output_root)
 
@@ -52,9 +176,11 @@ def create_bet_workflow(output_root: str) -> pe.Workflow:
     
     fsl_bet = pe.MapNode(interface=fsl.BET(),
                          iterfield=['in_file'],
-                         name='fsl_bet')
+                         name='fsl_bet', **_sized(resources, 'fsl_bet'))
     fsl_bet.inputs.frac = 0.4
     fsl_bet.inputs.mask = True
+    # Sets FSLOUTPUTTYPE for the bet call
+    fsl_bet.inputs.output_type = intermediate_format
     wf.connect(input_node, 'struct_files', fsl_bet, 'in_file')
 
     # Set up output node with brain mask and masked brains
@@ -67,56 +193,133 @@ def create_bet_workflow(output_root: str) -> pe.Workflow:
     return wf
 
 
-def create_preproc_workflow(output_root: str) -> pe.Workflow:
-    wf = pe.Workflow(name='fslvbm_2_template', base_dir=output_root)
-    wf_root = os.path.join(output_root, 'fslvbm_2_template')
+def create_downsample_workflow(output_root: str, spacing: float = 3, intermediate_format: str = 'NIFTI_GZ',
+                               study_template: bool = False, resources: NodeResources = None) -> pe.Workflow:
+    """Downsample the BET outputs and the GM template to spacing mm for a preview run
+
+    Keyword arguments:
+    study_template -- also downsample the study_template of the input node, for a preview with
+                      a frozen template (default False)
+    """
+    extension = _extension(intermediate_format)
+    wf = pe.Workflow(name='fslvbm_1_downsample', base_dir=output_root)
 
     input_node = pe.Node(
-        interface=util.IdentityInterface(fields=['brain_files', 'mask_files', 'GM_template']),
+        interface=util.IdentityInterface(fields=['brain_files', 'mask_files', 'GM_template', 'study_template']),
         name='input_node')
 
+    # Smooth before downsampling the images and use nearest neighbour for the masks
+    downsample_brains = pe.MapNode(interface=ants.ResampleImageBySpacing(), iterfield=['input_image'],
+                                   name='downsample_brains', **_sized(resources, 'downsample_brains'))
+    downsample_brains.inputs.dimension = 3
+    downsample_brains.inputs.out_spacing = (spacing, spacing, spacing)
+    downsample_brains.inputs.apply_smoothing = True
+    downsample_brains.inputs.output_image = 'brain_downsampled' + extension
+    wf.connect(input_node, 'brain_files', downsample_brains, 'input_image')
+
+    downsample_masks = pe.MapNode(interface=ants.ResampleImageBySpacing(), iterfield=['input_image'],
+                                  name='downsample_masks', **_sized(resources, 'downsample_masks'))
+    downsample_masks.inputs.dimension = 3
+    downsample_masks.inputs.out_spacing = (spacing, spacing, spacing)
+    downsample_masks.inputs.apply_smoothing = False
+    downsample_masks.inputs.addvox = 0
+    downsample_masks.inputs.nn_interp = True
+    downsample_masks.inputs.output_image = 'mask_downsampled' + extension
+    wf.connect(input_node, 'mask_files', downsample_masks, 'input_image')
+
+    downsample_template = pe.Node(interface=ants.ResampleImageBySpacing(), name='downsample_template',
+                                  **_sized(resources, 'downsample_template'))
+    downsample_template.inputs.dimension = 3
+    downsample_template.inputs.out_spacing = (spacing, spacing, spacing)
+    downsample_template.inputs.apply_smoothing = True
+    downsample_template.inputs.output_image = 'template_downsampled' + extension
+    wf.connect(input_node, 'GM_template', downsample_template, 'input_image')
+
+    output_node = pe.Node(
+        interface=util.IdentityInterface(fields=['brain_files', 'mask_files', 'GM_template', 'study_template']),
+        name='output_node')
+    wf.connect(downsample_brains, 'output_image', output_node, 'brain_files')
+    wf.connect(downsample_masks, 'output_image', output_node, 'mask_files')
+    wf.connect(downsample_template, 'output_image', output_node, 'GM_template')
+
+    if study_template:
+        downsample_study_template = pe.Node(interface=ants.ResampleImageBySpacing(),
+                                            name='downsample_study_template',
+                                            **_sized(resources, 'downsample_study_template'))
+        downsample_study_template.inputs.dimension = 3
+        downsample_study_template.inputs.out_spacing = (spacing, spacing, spacing)
+        downsample_study_template.inputs.apply_smoothing = True
+        downsample_study_template.inputs.output_image = 'study_template_downsampled' + extension
+        wf.connect(input_node, 'study_template', downsample_study_template, 'input_image')
+        wf.connect(downsample_study_template, 'output_image', output_node, 'study_template')
+
+    return wf
+
+
+def create_preproc_workflow(output_root: str, cache_dir: str = None, cache_max_gb: float = 50,
+                            registration_profile: str = 'default', build_template: bool = True,
+                            incremental: bool = False, reuse_affine_template: bool = False,
+                            atlas_image: str = ATLAS_IMAGE,
+                            atlas_priors: str = ATLAS_PRIORS, warm_start: bool = False,
+                            template_iterations: int = 1, template_threshold: float = 0.01,
+                            intermediate_format: str = 'NIFTI_GZ', name: str = 'fslvbm_2_template',
+                            resources: NodeResources = None) -> pe.Workflow:
+    if incremental and template_iterations > 1:
+        raise ValueError('Incremental mode keeps running sums of a single template iteration, '
+                         'template_iterations must be 1')
+    if incremental and warm_start:
+        raise ValueError('warm_start cannot be combined with incremental mode')
+    if reuse_affine_template and not incremental:
+        raise ValueError('reuse_affine_template is only used in incremental mode')
+
+    wf = pe.Workflow(name=name, base_dir=output_root)
+    wf_root = os.path.join(output_root, name)
+    extension = _extension(intermediate_format)
+
+    input_node = pe.Node(
+        interface=util.IdentityInterface(fields=['brain_files', 'mask_files', 'GM_template', 'n_previous',
+                                                 'affine_template_file', 'nonlinear_sum_file', 'nonlinear_count',
+                                                 'initial_transforms']),
+        name='input_node')
+    input_node.inputs.n_previous = 0
+
     # Register template to brain
-    deformable_priors = pe.MapNode(ants.Registration(), iterfield=['fixed_image'], name='deformable_priors')
-    deformable_priors.inputs.dimension = 3
-    deformable_priors.inputs.interpolation = 'Linear'
-    deformable_priors.inputs.metric = ['MI', 'MI', 'MI']
-    deformable_priors.inputs.metric_weight = [1.0, 1.0, 1.0]
-    deformable_priors.inputs.radius_or_number_of_bins = [32, 32, 32]
-    deformable_priors.inputs.sampling_strategy = ['Regular', 'Regular', 'Regular']
-    deformable_priors.inputs.sampling_percentage = [0.25, 0.25, 0.25]
-    deformable_priors.inputs.transforms = ['Rigid', 'Affine', 'SyN']
-    deformable_priors.inputs.transform_parameters = [(0.1,), (0.1,), (0.1, 3, 0)]
-    deformable_priors.inputs.number_of_iterations = [[100, 50, 25], [100, 50, 25], [100, 20, 10]]
-    deformable_priors.inputs.convergence_threshold = [1e-6, 1e-6, 1e-4]
-    deformable_priors.inputs.convergence_window_size = [10, 10, 10]
-    deformable_priors.inputs.smoothing_sigmas = [[4, 2, 1], [4, 2, 1], [3, 2, 1]]
-    deformable_priors.inputs.sigma_units = ['vox', 'vox', 'vox']
-    deformable_priors.inputs.shrink_factors = [[4, 2, 1], [4, 2, 1], [8, 4, 2]]
+    deformable_priors = pe.MapNode(CachedRegistration(), iterfield=['fixed_image'], name='deformable_priors',
+                                   **_sized(resources, 'deformable_priors'))
+    configure_registration(deformable_priors, 'atlas', registration_profile)
     deformable_priors.inputs.write_composite_transform = True
     deformable_priors.inputs.initial_moving_transform_com = 1
-    # TODO: Set prior atlas as a parameter
-    deformable_priors.inputs.moving_image = '/home/j/jiwonoh/jglaist1/atlas/mni_icbm152_nlin_sym_09c/mni_icbm152_t1_tal_nlin_sym_09c_masked_RAI.nii.gz'
+    deformable_priors.inputs.moving_image = atlas_image
     wf.connect(input_node, 'brain_files', deformable_priors, 'fixed_image')
+    if cache_dir is not None:
+        deformable_priors.inputs.cache_dir = cache_dir
+        deformable_priors.inputs.cache_max_gb = cache_max_gb
 
     # Warp priors
-    warp_priors = pe.MapNode(ants.ApplyTransforms(), iterfield=['reference_image', 'transforms'], name='warp_priors')
-    warp_priors.inputs.input_image = '/home/j/jiwonoh/jglaist1/atlas/mni_icbm152_nlin_sym_09c/mni_icbm152_combined_tal_nlin_sym_09c_RAI.nii.gz'
+    warp_priors = pe.MapNode(CachedApplyTransforms(), iterfield=['reference_image', 'transforms'], name='warp_priors',
+                             **_sized(resources, 'warp_priors'))
+    warp_priors.inputs.input_image = atlas_priors
     warp_priors.inputs.input_image_type = 3
+    warp_priors.inputs.output_image = 'priors_warped' + extension
     wf.connect(input_node, 'brain_files', warp_priors, 'reference_image')
     wf.connect(deformable_priors, 'composite_transform', warp_priors, 'transforms')
+    if cache_dir is not None:
+        warp_priors.inputs.cache_dir = cache_dir
+        warp_priors.inputs.cache_max_gb = cache_max_gb
 
     generate_priors = pe.MapNode(GeneratePriors(),
                                  iterfield=['reference_file', 'prior_4D_file'],
-                                 name='generate_priors', needed_outputs=['prior_3D_files','prior_string'])
+                                 name='generate_priors', needed_outputs=['prior_3D_files','prior_string'],
+                                 **_sized(resources, 'generate_priors'))
+    generate_priors.inputs.output_type = intermediate_format
+    # Atropos reads the prior files through the prior_string pattern, which nipype does not recognise as
+    # files, so they would be removed as unnecessary outputs
+    generate_priors.config = {'execution': {'remove_unnecessary_outputs': False}}
     wf.connect(input_node, 'brain_files', generate_priors, 'reference_file')
     wf.connect(warp_priors, 'output_image', generate_priors, 'prior_4D_file')
 
-    merge_priors = pe.MapNode(fsl.Merge(), iterfield=['in_files'], name='merge_priors')
-    merge_priors.inputs.dimension = 't'
-    wf.connect(generate_priors, 'prior_3D_files', merge_priors, 'in_files')
-
     ants_atropos = pe.MapNode(ants.Atropos(), iterfield=['intensity_images', 'mask_image', 'prior_image'],
-                              name='ants_atropos')
+                              name='ants_atropos', **_sized(resources, 'ants_atropos'))
     ants_atropos.inputs.args = '--partial-volume-label-set 2x3 --partial-volume-label-set 3x4'
     ants_atropos.inputs.dimension = 3
     ants_atropos.inputs.initialization = 'PriorProbabilityImages'
@@ -127,6 +330,8 @@ def create_preproc_workflow(output_root: str) -> pe.Workflow:
     ants_atropos.inputs.likelihood_model = 'Gaussian'
 
     ants_atropos.inputs.save_posteriors = True
+    ants_atropos.inputs.output_posteriors_name_template = 'POSTERIOR_%02d' + extension
+    ants_atropos.inputs.out_classified_image_name = 'labels' + extension
     wf.connect(input_node, 'brain_files', ants_atropos, 'intensity_images')
     wf.connect(generate_priors, 'prior_string', ants_atropos, 'prior_image')
     wf.connect(input_node, 'mask_files', ants_atropos, 'mask_image')
@@ -138,175 +343,301 @@ def create_preproc_workflow(output_root: str) -> pe.Workflow:
     split_posteriors.inputs.squeeze = True
     wf.connect(ants_atropos, 'posteriors', split_posteriors, 'inlist')
 
-    # Affine registration of GM from FAST to GM template
-    affine_reg_to_gm = pe.MapNode(ants.Registration(), iterfield=['moving_image'], name='affine_reg_to_GM')
-    affine_reg_to_gm.inputs.dimension = 3
-    affine_reg_to_gm.inputs.interpolation = 'Linear'
-    affine_reg_to_gm.inputs.metric = ['MI', 'MI']
-    affine_reg_to_gm.inputs.metric_weight = [1.0, 1.0]
-    affine_reg_to_gm.inputs.radius_or_number_of_bins = [32, 32]
-    affine_reg_to_gm.inputs.sampling_strategy = ['Regular', 'Regular']
-    affine_reg_to_gm.inputs.sampling_percentage = [0.25, 0.25]
-    affine_reg_to_gm.inputs.transforms = ['Rigid', 'Affine']
-    affine_reg_to_gm.inputs.transform_parameters = [(0.1,), (0.1,)]
-    affine_reg_to_gm.inputs.number_of_iterations = [[100, 50, 25], [100, 50, 25]]
-    affine_reg_to_gm.inputs.convergence_threshold = [1e-6, 1e-6]
-    affine_reg_to_gm.inputs.convergence_window_size = [10, 10]
-    affine_reg_to_gm.inputs.smoothing_sigmas = [[4, 2, 1], [4, 2, 1]]
-    affine_reg_to_gm.inputs.sigma_units = ['vox', 'vox']
-    affine_reg_to_gm.inputs.shrink_factors = [[4, 2, 1], [4, 2, 1]]
-    affine_reg_to_gm.inputs.write_composite_transform = True
-    affine_reg_to_gm.inputs.initial_moving_transform_com = 1
-    affine_reg_to_gm.inputs.output_warped_image = True
-    wf.connect(split_posteriors, 'out2', affine_reg_to_gm, 'moving_image')
-    wf.connect(input_node, 'GM_template', affine_reg_to_gm, 'fixed_image')
-
-    # Average 4D template and its flipped template to create an initial template
-    affine_4d_template = pe.Node(interface=fsl.Merge(),
-                                 name='affine_4D_template')
-    affine_4d_template.inputs.dimension = 't'
-    wf.connect(affine_reg_to_gm, 'warped_image', affine_4d_template, 'in_files')
-
-    affine_template = pe.Node(interface=GenerateTemplate(),
-                              name='affine_template')
-    wf.connect(affine_4d_template, 'merged_file', affine_template, 'input_file')
+    output_node = pe.Node(
+        interface=util.IdentityInterface(fields=['GM_template', 'GM_files', 'affine_template_file',
+                                                 'nonlinear_sum_file', 'nonlinear_count', 'nonlinear_transforms',
+                                                 'template_change']),
+        name='output_node')
+    wf.connect(split_posteriors, 'out2', output_node, 'GM_files')
+
+    # With a frozen study template only the segmentation is needed
+    if not build_template:
+        return wf
+
+    # In incremental mode only the subjects after the first n_previous are registered. The affine template of
+    # the first run stays the reference, so the new warps share the space of the nonlinear running sums.
+    if incremental:
+        select_new = pe.Node(interface=util.Function(input_names=['inlist', 'n_previous'], output_names=['outlist'],
+                                                     function=_select_new),
+                             name='select_new')
+        wf.connect(split_posteriors, 'out2', select_new, 'inlist')
+        wf.connect(input_node, 'n_previous', select_new, 'n_previous')
+        gm_files, gm_field = select_new, 'outlist'
+    else:
+        gm_files, gm_field = split_posteriors, 'out2'
+
+    if reuse_affine_template:
+        # The new subjects are registered straight to the affine template of the first run
+        affine_template = None
+        fixed_template, fixed_field = input_node, 'affine_template_file'
+    else:
+        # Affine registration of GM from FAST to GM template
+        affine_reg_to_gm = pe.MapNode(ants.Registration(), iterfield=['moving_image'], name='affine_reg_to_GM',
+                                      **_sized(resources, 'affine_reg_to_GM'))
+        configure_registration(affine_reg_to_gm, 'affine', registration_profile)
+        affine_reg_to_gm.inputs.write_composite_transform = True
+        affine_reg_to_gm.inputs.initial_moving_transform_com = 1
+        affine_reg_to_gm.inputs.output_warped_image = 'transform_Warped' + extension
+        wf.connect(gm_files, gm_field, affine_reg_to_gm, 'moving_image')
+        wf.connect(input_node, 'GM_template', affine_reg_to_gm, 'fixed_image')
+
+        # Average the registered GM images and their flipped versions to create an initial template
+        affine_template = pe.Node(interface=GenerateTemplate(),
+                                  name='affine_template', **_sized(resources, 'affine_template'))
+        affine_template.inputs.output_type = intermediate_format
+        wf.connect(affine_reg_to_gm, 'warped_image', affine_template, 'input_files')
+        fixed_template, fixed_field = affine_template, 'template_file'
 
     # Nonlinear registration to initial template
-    nonlinear_reg_to_temp = pe.MapNode(interface=ants.Registration(),
-                                       iterfield=['moving_image'],
-                                       name='nonlinear_reg_to_temp')
-    nonlinear_reg_to_temp.inputs.dimension = 3
-    nonlinear_reg_to_temp.inputs.interpolation = 'Linear'
-    nonlinear_reg_to_temp.inputs.metric = ['MI', 'MI', 'MI']
-    nonlinear_reg_to_temp.inputs.metric_weight = [1.0, 1.0, 1.0]
-    nonlinear_reg_to_temp.inputs.radius_or_number_of_bins = [32, 32, 32]
-    nonlinear_reg_to_temp.inputs.sampling_strategy = ['Regular', 'Regular', 'Regular']
-    nonlinear_reg_to_temp.inputs.sampling_percentage = [0.25, 0.25, 0.25]
-    nonlinear_reg_to_temp.inputs.transforms = ['Rigid', 'Affine', 'SyN']
-    nonlinear_reg_to_temp.inputs.transform_parameters = [(0.1,), (0.1,), (0.1, 3, 0)]
-    nonlinear_reg_to_temp.inputs.number_of_iterations = [[100, 50, 25], [100, 50, 25], [100, 10, 5]]
-    nonlinear_reg_to_temp.inputs.convergence_threshold = [1e-6, 1e-6, 1e-4]
-    nonlinear_reg_to_temp.inputs.convergence_window_size = [10, 10, 10]
-    nonlinear_reg_to_temp.inputs.smoothing_sigmas = [[4, 2, 1], [4, 2, 1], [2, 1, 0]]
-    nonlinear_reg_to_temp.inputs.sigma_units = ['vox', 'vox', 'vox']
-    nonlinear_reg_to_temp.inputs.shrink_factors = [[4, 2, 1], [4, 2, 1], [4, 2, 1]]
+    if not warm_start:
+        nonlinear_reg_to_temp = pe.MapNode(interface=ants.Registration(),
+                                           iterfield=['moving_image'],
+                                           name='nonlinear_reg_to_temp', **_sized(resources, 'nonlinear_reg_to_temp'))
+        configure_registration(nonlinear_reg_to_temp, 'nonlinear', registration_profile)
+        nonlinear_reg_to_temp.inputs.initial_moving_transform_com = 1
+    else:
+        # Start from the preview transforms (in world space, so valid on any grid) and only refine the SyN
+        nonlinear_reg_to_temp = pe.MapNode(interface=ants.Registration(),
+                                           iterfield=['moving_image', 'initial_moving_transform'],
+                                           name='nonlinear_reg_to_temp', **_sized(resources, 'nonlinear_reg_to_temp'))
+        configure_registration(nonlinear_reg_to_temp, 'refine', registration_profile)
+        wf.connect(input_node, 'initial_transforms', nonlinear_reg_to_temp, 'initial_moving_transform')
     nonlinear_reg_to_temp.inputs.write_composite_transform = True
-    nonlinear_reg_to_temp.inputs.initial_moving_transform_com = 1
-    nonlinear_reg_to_temp.inputs.output_warped_image = True
-    wf.connect(split_posteriors, 'out2', nonlinear_reg_to_temp, 'moving_image')
-    wf.connect(affine_template, 'template_file', nonlinear_reg_to_temp, 'fixed_image')
-
-    nonlinear_4d_template = pe.Node(interface=fsl.Merge(),
-                                    name='nonlinear_4d_template')
-    nonlinear_4d_template.inputs.dimension = 't'
-    wf.connect(nonlinear_reg_to_temp, 'warped_image', nonlinear_4d_template, 'in_files')
+    nonlinear_reg_to_temp.inputs.output_warped_image = 'transform_Warped' + extension
+    wf.connect(gm_files, gm_field, nonlinear_reg_to_temp, 'moving_image')
+    wf.connect(fixed_template, fixed_field, nonlinear_reg_to_temp, 'fixed_image')
 
     # TODO: Allow for variable size cohorts instead of matched sizes
     nonlinear_template = pe.Node(interface=GenerateTemplate(),
-                                 name='nonlinear_template')
-    wf.connect(nonlinear_4d_template, 'merged_file', nonlinear_template, 'input_file')
-
-    output_node = pe.Node(
-        interface=util.IdentityInterface(fields=['GM_template', 'GM_files']),
-        name='output_node')
-    wf.connect(nonlinear_template, 'template_file', output_node, 'GM_template')
-    wf.connect(split_posteriors, 'out2', output_node, 'GM_files')
+                                 name='nonlinear_template', **_sized(resources, 'nonlinear_template'))
+    nonlinear_template.inputs.output_type = intermediate_format
+    wf.connect(nonlinear_reg_to_temp, 'warped_image', nonlinear_template, 'input_files')
+    if incremental:
+        wf.connect(input_node, 'nonlinear_sum_file', nonlinear_template, 'prior_sum_file')
+        wf.connect(input_node, 'nonlinear_count', nonlinear_template, 'prior_count')
+
+    # Unrolled template refinement: each iteration registers to the previous template starting from the
+    # previous transforms, and is skipped once the template has stopped changing
+    previous_template, template, registration, template_change = (affine_template, nonlinear_template,
+                                                                  nonlinear_reg_to_temp, None)
+    for iteration in range(2, template_iterations + 1):
+        check = pe.Node(interface=util.Function(input_names=['template_file', 'previous_template_file',
+                                                             'threshold', 'converged'],
+                                                output_names=['converged', 'change'],
+                                                function=_template_change),
+                        name='template_change_iter%d' % iteration)
+        check.inputs.threshold = template_threshold
+        wf.connect(template, 'template_file', check, 'template_file')
+        wf.connect(previous_template, 'template_file', check, 'previous_template_file')
+        if template_change is None:
+            check.inputs.converged = False
+        else:
+            wf.connect(template_change, 'converged', check, 'converged')
+
+        refine_reg = pe.MapNode(interface=SkippableRegistration(),
+                                iterfield=['moving_image', 'initial_moving_transform', 'previous_warped_image',
+                                           'previous_composite_transform', 'previous_inverse_composite_transform'],
+                                name='nonlinear_reg_to_temp_iter%d' % iteration,
+                                **_sized(resources, 'nonlinear_reg_to_temp'))
+        configure_registration(refine_reg, 'refine', registration_profile)
+        refine_reg.inputs.write_composite_transform = True
+        refine_reg.inputs.output_warped_image = 'transform_Warped' + extension
+        wf.connect(split_posteriors, 'out2', refine_reg, 'moving_image')
+        wf.connect(template, 'template_file', refine_reg, 'fixed_image')
+        wf.connect(registration, 'composite_transform', refine_reg, 'initial_moving_transform')
+        wf.connect(registration, 'warped_image', refine_reg, 'previous_warped_image')
+        wf.connect(registration, 'composite_transform', refine_reg, 'previous_composite_transform')
+        wf.connect(registration, 'inverse_composite_transform', refine_reg, 'previous_inverse_composite_transform')
+        wf.connect(check, 'converged', refine_reg, 'skip')
+
+        refine_template = pe.Node(interface=GenerateTemplate(), name='nonlinear_template_iter%d' % iteration,
+                                  **_sized(resources, 'nonlinear_template'))
+        refine_template.inputs.output_type = intermediate_format
+        wf.connect(refine_reg, 'warped_image', refine_template, 'input_files')
+
+        previous_template, template, registration, template_change = (template, refine_template, refine_reg,
+                                                                      check)
+
+    # The study template is a deliverable and stays compressed
+    template.inputs.output_type = 'NIFTI_GZ'
+    wf.connect(template, 'template_file', output_node, 'GM_template')
+    wf.connect(fixed_template, fixed_field, output_node, 'affine_template_file')
+    wf.connect(template, 'sum_file', output_node, 'nonlinear_sum_file')
+    wf.connect(template, 'count', output_node, 'nonlinear_count')
+    wf.connect(registration, 'composite_transform', output_node, 'nonlinear_transforms')
+    if template_change is not None:
+        wf.connect(template_change, 'change', output_node, 'template_change')
 
     return wf
 
 
-def create_proc_workflow(output_root: str, sigma: float = 2) -> pe.Workflow:
-    wf = pe.Workflow(name='fslvbm_3_proc', base_dir=output_root)
+def _template_change(template_file, previous_template_file, threshold, converged):
+    import nibabel as nib
+    import numpy as np
+
+    template_data = nib.load(template_file).get_fdata(dtype=np.float32)
+    previous_data = nib.load(previous_template_file).get_fdata(dtype=np.float32)
+    change = float(np.linalg.norm(template_data - previous_data) / np.linalg.norm(previous_data))
+    return bool(converged) or change < threshold, change
+
+
+def _select_new(inlist, n_previous):
+    return inlist[n_previous:]
+
+
+def _select_sigma(smoothed_files, sigmas, sigma):
+    if not isinstance(smoothed_files, list):
+        smoothed_files = [smoothed_files]
+    return smoothed_files[list(sigmas).index(sigma)], 'GM_mod_merg_s%g' % sigma
+
+
+def create_proc_workflow(output_root: str, sigma: Union[float, List[float]] = 2, merge_compression: int = 1,
+                         registration_profile: str = 'default', randomise_shards: int = 1,
+                         num_perm: int = 1000, tfce: bool = True, reuse_transforms: bool = False,
+                         intermediate_format: str = 'NIFTI_GZ', name: str = 'fslvbm_3_proc',
+                         resources: NodeResources = None) -> pe.Workflow:
+    """Register the GM images to the study template, modulate and smooth them and run randomise
+
+    Keyword arguments:
+    num_perm -- permutations of the final TFCE randomise, or of the voxelwise randomise without tfce (default 1000)
+    tfce -- run the final TFCE randomise, otherwise only uncorrected voxelwise p-values (default True)
+    reuse_transforms -- warp the GM images with the composite transforms on the input node instead of
+                        registering them to GM_template (default False)
+    intermediate_format -- 'NIFTI' or 'NIFTI_GZ' format of the warped images, fields and Jacobians
+    resources -- n_procs and mem_gb of the nodes for the cohort (default None, the nipype defaults)
+    """
+    wf = pe.Workflow(name=name, base_dir=output_root)
+    extension = _extension(intermediate_format)
 
     input_node = pe.Node(
-        interface=util.IdentityInterface(fields=['GM_files', 'GM_template', 'design_mat', 'tcon']),
+        interface=util.IdentityInterface(fields=['GM_files', 'GM_template', 'design_mat', 'tcon', 'transforms']),
         name='input_node')
 
-    nonlinear_reg_to_temp = pe.MapNode(interface=ants.Registration(),
-                                       iterfield=['moving_image'],
-                                       name='nonlinear_reg_to_temp')
-    nonlinear_reg_to_temp.inputs.dimension = 3
-    nonlinear_reg_to_temp.inputs.interpolation = 'Linear'
-    nonlinear_reg_to_temp.inputs.metric = ['MI', 'MI', 'MI']
-    nonlinear_reg_to_temp.inputs.metric_weight = [1.0, 1.0, 1.0]
-    nonlinear_reg_to_temp.inputs.radius_or_number_of_bins = [32, 32, 32]
-    nonlinear_reg_to_temp.inputs.sampling_strategy = ['Regular', 'Regular', 'Regular']
-    nonlinear_reg_to_temp.inputs.sampling_percentage = [0.25, 0.25, 0.25]
-    nonlinear_reg_to_temp.inputs.transforms = ['Rigid', 'Affine', 'SyN']
-    nonlinear_reg_to_temp.inputs.transform_parameters = [(0.1,), (0.1,), (0.1, 3, 0)]
-    nonlinear_reg_to_temp.inputs.number_of_iterations = [[100, 50, 25], [100, 50, 25], [100, 10, 5]]
-    nonlinear_reg_to_temp.inputs.convergence_threshold = [1e-6, 1e-6, 1e-4]
-    nonlinear_reg_to_temp.inputs.convergence_window_size = [10, 10, 10]
-    nonlinear_reg_to_temp.inputs.smoothing_sigmas = [[4, 2, 1], [4, 2, 1], [2, 1, 0]]
-    nonlinear_reg_to_temp.inputs.sigma_units = ['vox', 'vox', 'vox']
-    nonlinear_reg_to_temp.inputs.shrink_factors = [[4, 2, 1], [4, 2, 1], [4, 2, 1]]
-    nonlinear_reg_to_temp.inputs.write_composite_transform = False
-    nonlinear_reg_to_temp.inputs.initial_moving_transform_com = 1
-    nonlinear_reg_to_temp.inputs.output_warped_image = True
-    wf.connect(input_node, 'GM_files', nonlinear_reg_to_temp, 'moving_image')
-    wf.connect(input_node, 'GM_template', nonlinear_reg_to_temp, 'fixed_image')
-
-    split_transforms = pe.MapNode(interface=util.Split(),
-                              iterfield=['inlist'],
-                              name='split_transforms')
-    split_transforms.inputs.splits = [1, 1]
-    split_transforms.inputs.squeeze = True
-    wf.connect(nonlinear_reg_to_temp, 'forward_transforms', split_transforms, 'inlist')
+    if not reuse_transforms:
+        nonlinear_reg_to_temp = pe.MapNode(interface=ants.Registration(),
+                                           iterfield=['moving_image'],
+                                           name='nonlinear_reg_to_temp', **_sized(resources, 'nonlinear_reg_to_temp'))
+        configure_registration(nonlinear_reg_to_temp, 'nonlinear', registration_profile)
+        nonlinear_reg_to_temp.inputs.write_composite_transform = False
+        nonlinear_reg_to_temp.inputs.initial_moving_transform_com = 1
+        nonlinear_reg_to_temp.inputs.output_warped_image = 'transform_Warped' + extension
+        wf.connect(input_node, 'GM_files', nonlinear_reg_to_temp, 'moving_image')
+        wf.connect(input_node, 'GM_template', nonlinear_reg_to_temp, 'fixed_image')
+
+        split_transforms = pe.MapNode(interface=util.Split(),
+                                  iterfield=['inlist'],
+                                  name='split_transforms', **_sized(resources, 'split_transforms'))
+        split_transforms.inputs.splits = [1, 1]
+        split_transforms.inputs.squeeze = True
+        wf.connect(nonlinear_reg_to_temp, 'forward_transforms', split_transforms, 'inlist')
+        warped_gm, warped_gm_field = nonlinear_reg_to_temp, 'warped_image'
+        # ANTs names the collapsed warp field itself, always .nii.gz whatever intermediate_format is
+        deformation, deformation_field = split_transforms, 'out2'
+    else:
+        # Resample with the transforms of the last template iteration instead of registering again
+        warp_gm = pe.MapNode(interface=ants.ApplyTransforms(), iterfield=['input_image', 'transforms'],
+                             name='warp_GM', **_sized(resources, 'warp_GM'))
+        warp_gm.inputs.dimension = 3
+        warp_gm.inputs.output_image = 'GM_warped' + extension
+        wf.connect(input_node, 'GM_files', warp_gm, 'input_image')
+        wf.connect(input_node, 'GM_template', warp_gm, 'reference_image')
+        wf.connect(input_node, 'transforms', warp_gm, 'transforms')
+
+        # Break the composite transform apart so the Jacobian, as with split_transforms above, only
+        # covers the SyN displacement field and not the affine part. ANTs collapses the refined SyN
+        # fields of later iterations and warm starts into one, anything else fails here
+        split_transforms = pe.MapNode(interface=SingleWarpCompositeTransformUtil(), iterfield=['in_file'],
+                                      name='split_transforms', **_sized(resources, 'split_transforms'))
+        split_transforms.inputs.process = 'disassemble'
+        split_transforms.inputs.output_prefix = 'transform'
+        wf.connect(input_node, 'transforms', split_transforms, 'in_file')
+        warped_gm, warped_gm_field = warp_gm, 'output_image'
+        deformation, deformation_field = split_transforms, 'displacement_field'
 
     create_jac = pe.MapNode(interface=ants.utils.CreateJacobianDeterminantImage(),
                             iterfield=['deformationField'],
-                            name='create_jac')
+                            name='create_jac', **_sized(resources, 'create_jac'))
     create_jac.inputs.imageDimension = 3
-    create_jac.inputs.outputImage = 'Jacobian.nii.gz'
+    create_jac.inputs.outputImage = 'Jacobian' + extension
     create_jac.inputs.doLogJacobian = 0
     create_jac.inputs.useGeometric = 1
-    wf.connect(split_transforms, 'out2', create_jac, 'deformationField')
-
-    # Multiply JAC and GM
-    gm_mul_jac = pe.MapNode(interface=fsl.ImageMaths(),
-                            iterfield=['in_file', 'in_file2'],
-                            name='gm_mul_jac')
-    gm_mul_jac.inputs.op_string = '-mul'
-    wf.connect(nonlinear_reg_to_temp, 'warped_image', gm_mul_jac, 'in_file')
-    wf.connect(create_jac, 'jacobian_image', gm_mul_jac, 'in_file2')
-
-    # Merge GMs
-    gm_merge = pe.Node(interface=fsl.Merge(),
-                                    name='gm_merge')
-    gm_merge.inputs.dimension = 't'
-    wf.connect(nonlinear_reg_to_temp, 'warped_image', gm_merge, 'in_files')
-
-    gm_mod_merge = pe.Node(interface=fsl.Merge(),
-                       name='gm_mod_merge')
-    gm_mod_merge.inputs.dimension = 't'
-    wf.connect(gm_mul_jac, 'out_file', gm_mod_merge, 'in_files')
-
-    gm_mask = pe.Node(interface=fsl.ImageMaths(), name='gm_mask')
-    gm_mask.inputs.op_string = '-Tmean -thr 0.01 -bin'
-    gm_mask.inputs.out_data_type = 'char'
-    wf.connect(gm_merge, 'merged_file', gm_mask, 'in_file')
-
-    gaussian_filter = pe.Node(interface=fsl.ImageMaths(), name='gaussian')
-    gaussian_filter.inputs.op_string = '-s ' + str(sigma)
-    wf.connect(gm_mod_merge, 'merged_file', gaussian_filter, 'in_file')
-
-    init_randomise = pe.Node(interface=fsl.model.Randomise(), name='randomise')
-    init_randomise.inputs.base_name = 'GM_mod_merg_s' + str(sigma)
-    wf.connect(gaussian_filter, 'out_file', init_randomise, 'in_file')
-    wf.connect(gm_mask, 'out_file', init_randomise, 'mask')
+    wf.connect(deformation, deformation_field, create_jac, 'deformationField')
+
+    # Modulate by the Jacobian, smooth with every sigma and build the mask in a single in-process pass
+    sigmas = list(sigma) if isinstance(sigma, (list, tuple)) else [sigma]
+    gm_mod_smooth = pe.Node(interface=ModulateSmooth(), name='gm_mod_smooth', **_sized(resources, 'gm_mod_smooth'))
+    gm_mod_smooth.inputs.sigma = sigmas
+    gm_mod_smooth.inputs.output_name = 'GM_mod_merg'
+    gm_mod_smooth.inputs.compression = merge_compression
+    wf.connect(warped_gm, warped_gm_field, gm_mod_smooth, 'gm_files')
+    wf.connect(create_jac, 'jacobian_image', gm_mod_smooth, 'jacobian_files')
+
+    # Only the randomise nodes are expanded per sigma
+    select_sigma = pe.Node(interface=util.Function(input_names=['smoothed_files', 'sigmas', 'sigma'],
+                                                   output_names=['smoothed_file', 'base_name'],
+                                                   function=_select_sigma),
+                           name='select_sigma')
+    select_sigma.inputs.sigmas = sigmas
+    select_sigma.iterables = ('sigma', sigmas)
+    wf.connect(gm_mod_smooth, 'smoothed_files', select_sigma, 'smoothed_files')
+
+    init_randomise = pe.Node(interface=fsl.model.Randomise(), name='randomise', **_sized(resources, 'randomise'))
+    wf.connect(select_sigma, 'base_name', init_randomise, 'base_name')
+    wf.connect(select_sigma, 'smoothed_file', init_randomise, 'in_file')
+    wf.connect(gm_mod_smooth, 'mask_file', init_randomise, 'mask')
     wf.connect(input_node, 'design_mat', init_randomise, 'design_mat')
     wf.connect(input_node, 'tcon', init_randomise, 'tcon')
 
-    # TODO: Add output node
-    final_randomise = pe.Node(interface=fsl.model.Randomise(), name='final_randomise')
-    final_randomise.inputs.base_name = 'GM_mod_merg_s' + str(sigma)
+    output_node = pe.Node(
+        interface=util.IdentityInterface(fields=['mask_file', 'tstat_files', 't_p_files', 't_corrected_p_files']),
+        name='output_node')
+    wf.connect(gm_mod_smooth, 'mask_file', output_node, 'mask_file')
+    wf.connect(init_randomise, 'tstat_files', output_node, 'tstat_files')
+
+    if not tfce:
+        init_randomise.inputs.vox_p_values = True
+        init_randomise.inputs.num_perm = num_perm
+        wf.connect(init_randomise, 't_p_files', output_node, 't_p_files')
+        return wf
+
+    if randomise_shards == 1:
+        final_randomise = pe.Node(interface=fsl.model.Randomise(), name='final_randomise',
+                                  **_sized(resources, 'final_randomise'))
+        final_randomise.inputs.num_perm = num_perm
+    else:
+        # Split the permutations over shards with distinct seeds, each evaluating the unpermuted labelling
+        final_randomise = pe.MapNode(interface=RandomiseShard(), iterfield=['seed'], name='final_randomise',
+                                     **_sized(resources, 'final_randomise'))
+        final_randomise.inputs.seed = list(range(1, randomise_shards + 1))
+        final_randomise.inputs.num_perm = int(math.ceil((num_perm - 1) / randomise_shards)) + 1
+        # CombineRandomise recomputes the TFCE correction from the null distributions (-P) and
+        # the unpermuted TFCE images, which randomise only writes with -R
+        final_randomise.inputs.p_vec_n_dist_files = True
+        final_randomise.inputs.raw_stats_imgs = True
+        # CombineRandomise globs the shard directories, keep the images and text files not passed on
+        final_randomise.config = {'execution': {'remove_unnecessary_outputs': False}}
     final_randomise.inputs.tfce = True
-    final_randomise.inputs.num_perm = 1000
-    wf.connect(gaussian_filter, 'out_file', final_randomise, 'in_file')
-    wf.connect(gm_mask, 'out_file', final_randomise, 'mask')
+    wf.connect(select_sigma, 'base_name', final_randomise, 'base_name')
+    wf.connect(select_sigma, 'smoothed_file', final_randomise, 'in_file')
+    wf.connect(gm_mod_smooth, 'mask_file', final_randomise, 'mask')
     wf.connect(input_node, 'design_mat', final_randomise, 'design_mat')
     wf.connect(input_node, 'tcon', final_randomise, 'tcon')
 
+    if randomise_shards > 1:
+        combine_randomise = pe.Node(interface=CombineRandomise(), name='combine_randomise',
+                                    **_sized(resources, 'combine_randomise'))
+        combine_randomise.inputs.shard_seeds = final_randomise.inputs.seed
+        combine_randomise.inputs.shard_num_perms = [final_randomise.inputs.num_perm] * randomise_shards
+        wf.connect(select_sigma, 'base_name', combine_randomise, 'base_name')
+        wf.connect(gm_mod_smooth, 'mask_file', combine_randomise, 'mask')
+        wf.connect(final_randomise, 'tstat_files', combine_randomise, 'shard_tstat_files')
+        wf.connect(final_randomise, 'peak_mem_gb', combine_randomise, 'shard_peak_mem_gb')
+        corrected = combine_randomise
+    else:
+        corrected = final_randomise
+    wf.connect(corrected, 't_p_files', output_node, 't_p_files')
+    wf.connect(corrected, 't_corrected_p_files', output_node, 't_corrected_p_files')
+
     return wf
 
 
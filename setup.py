@@ -19,7 +19,7 @@ args = dict(
     url='https://github.com/jglaister/nipypevbm'
 )
 
-setup(install_requires=['nipype', 'numpy', 'nibabel'],
+setup(install_requires=['nipype', 'numpy', 'nibabel', 'scipy', 'psutil>=5.0'],
       packages=['nipypeVBM'],
       scripts=glob('bin/*'), **args)
 
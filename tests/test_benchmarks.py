@@ -0,0 +1,24 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+BENCHMARKS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks')
+
+
+@pytest.mark.parametrize('intermediate_format', ['NIFTI_GZ', 'NIFTI'])
+def test_benchmark_smoke(tmp_path, intermediate_format):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.dirname(BENCHMARKS),
+                                                       os.environ.get('PYTHONPATH', '')]))
+    output_file = str(tmp_path / 'results.json')
+    subprocess.run([sys.executable, os.path.join(BENCHMARKS, 'run_benchmarks.py'), '-o', output_file,
+                    '--sizes', '8', '--cohorts', '2', '--repeat', '1', '--workflow-size', '12',
+                    '--workflow-subjects', '4', '--num-perm', '10', '--intermediate-format', intermediate_format,
+                    '--work-dir', str(tmp_path / 'work')], check=True, cwd=str(tmp_path), env=env)
+
+    with open(output_file) as fileobj:
+        results = json.load(fileobj)
+    assert [r['workflow'] for r in results['workflows']] == ['fslvbm_1_bet', 'fslvbm_2_template', 'fslvbm_3_proc']
+    assert all(r['nodes'] for r in results['workflows'])
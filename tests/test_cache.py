@@ -0,0 +1,96 @@
+import os
+import shutil
+
+import nibabel as nib
+import numpy as np
+
+from nipypeVBM import cache as cache_module
+from nipypeVBM.cache import TransformCache, digest_files
+from nipypeVBM.interfaces import CachedApplyTransforms
+
+
+def _write_files(out_dir, contents):
+    os.makedirs(str(out_dir), exist_ok=True)
+    files = []
+    for name, content in contents.items():
+        files.append(str(out_dir / name))
+        with open(files[-1], 'wb') as fileobj:
+            fileobj.write(content)
+    return files
+
+
+def _write_image(path, value):
+    nib.Nifti1Image(np.full((3, 3, 3), value, np.float32), np.eye(4)).to_filename(str(path))
+    return str(path)
+
+
+def test_key_ignores_working_directory(tmp_path):
+    keys = []
+    for run in ['run1', 'run2']:
+        run_dir = tmp_path / run
+        run_dir.mkdir()
+        with open(str(run_dir / 'transform.mat'), 'w') as fileobj:
+            fileobj.write('identity')
+        interface = CachedApplyTransforms(input_image=_write_image(run_dir / 'atlas.nii.gz', 1),
+                                          reference_image=_write_image(run_dir / 'brain.nii.gz', 2),
+                                          transforms=[str(run_dir / 'transform.mat')],
+                                          cache_dir=str(tmp_path / 'cache'), num_threads=len(keys) + 1)
+        keys.append(interface._cache_key())
+    assert keys[0] == keys[1]
+
+    # A different image is a different entry
+    interface.inputs.reference_image = _write_image(tmp_path / 'run2' / 'brain.nii.gz', 3)
+    assert interface._cache_key() != keys[0]
+
+
+def test_hit_across_working_directories(tmp_path):
+    cache = TransformCache(str(tmp_path / 'cache'))
+    key = TransformCache.key(digest_files({'fixed_image': _write_files(tmp_path / 'a', {'in.nii': b'x'})[0]}))
+    out_files = _write_files(tmp_path / 'run1', {'warp.nii.gz': b'warp', 'affine.mat': b'affine'})
+    cache.store(key, out_files + [str(tmp_path / 'run1' / 'missing.h5')])
+
+    # Same input content at another path, fetched into another working directory
+    other_key = TransformCache.key(digest_files({'fixed_image': _write_files(tmp_path / 'b', {'in.nii': b'x'})[0]}))
+    assert other_key == key
+    os.makedirs(str(tmp_path / 'run2'))
+    fetched = [str(tmp_path / 'run2' / os.path.basename(f)) for f in out_files + ['missing.h5']]
+    assert cache.fetch(other_key, fetched)
+    with open(fetched[0], 'rb') as fileobj:
+        assert fileobj.read() == b'warp'
+    with open(fetched[1], 'rb') as fileobj:
+        assert fileobj.read() == b'affine'
+    assert not os.path.exists(fetched[2])
+
+    assert not cache.fetch(TransformCache.key({'fixed_image': 'other'}), fetched)
+    assert not cache.fetch(key, fetched[:1])
+
+
+def test_evicts_least_recently_used(tmp_path):
+    # Each entry holds 1 MB, the cap fits two of them
+    cache = TransformCache(str(tmp_path / 'cache'), max_size_gb=2.5 / 2 ** 10)
+    for i, key in enumerate(['a', 'b']):
+        cache.store(key, _write_files(tmp_path / key, {'warp.nii': bytes(2 ** 20)}))
+        os.utime(cache._manifest(key), (i, i))
+
+    # Using 'a' makes 'b' the oldest entry, evicted by the third store
+    assert cache.fetch('a', [str(tmp_path / 'fetched.nii')])
+    cache.store('c', _write_files(tmp_path / 'c', {'warp.nii': bytes(2 ** 20)}))
+    assert sorted(os.listdir(cache.cache_dir)) == ['a', 'c']
+
+
+def test_evicted_during_fetch_is_a_miss(tmp_path, monkeypatch):
+    cache = TransformCache(str(tmp_path / 'cache'))
+    cache.store('a', _write_files(tmp_path / 'run1', {'warp.nii': b'warp', 'affine.mat': b'affine'}))
+    out_files = [str(tmp_path / 'run2' / 'warp.nii'), str(tmp_path / 'run2' / 'affine.mat')]
+    os.makedirs(str(tmp_path / 'run2'))
+
+    # Another process evicts the entry after the first file was copied
+    copyfile = shutil.copyfile
+
+    def copy_then_evict(src, dst):
+        copyfile(src, dst)
+        shutil.rmtree(os.path.join(cache.cache_dir, 'a'))
+
+    monkeypatch.setattr(cache_module.shutil, 'copyfile', copy_then_evict)
+    assert not cache.fetch('a', out_files)
+    assert not any(os.path.exists(f) for f in out_files)
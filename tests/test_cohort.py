@@ -0,0 +1,76 @@
+import json
+import os
+
+import pytest
+
+from nipypeVBM.cohort import STATE_FILE, check_design, has_templates, load_cohort, merge_cohort, save_cohort
+
+PREVIOUS = ['/data/sub01.nii.gz', '/data/sub02.nii.gz', '/data/sub03.nii.gz']
+
+
+def test_merge_first_run():
+    assert merge_cohort(load_cohort('/nonexistent'), PREVIOUS) == (PREVIOUS, 0)
+
+
+def test_merge_appends_in_order():
+    struct_files = PREVIOUS + ['/data/sub04.nii.gz', '/data/sub05.nii.gz']
+    assert merge_cohort({'struct_files': PREVIOUS, 'templates': {}}, struct_files) == (struct_files, 3)
+
+
+@pytest.mark.parametrize('struct_files, match', [
+    ([PREVIOUS[1], PREVIOUS[0], PREVIOUS[2], '/data/sub04.nii.gz'], 'have to come first'),
+    (['/data/sub04.nii.gz'] + PREVIOUS, 'have to come first'),
+    (PREVIOUS[:2] + ['/data/sub04.nii.gz'], 'missing: /data/sub03.nii.gz'),
+    (PREVIOUS + ['/data/sub04.nii.gz', '/data/sub04.nii.gz'], 'more than once'),
+    (PREVIOUS, 'No new subjects'),
+])
+def test_merge_rejects(struct_files, match):
+    with pytest.raises(ValueError, match=match):
+        merge_cohort({'struct_files': PREVIOUS, 'templates': {}}, struct_files)
+
+
+def test_check_design(tmp_path):
+    design_mat = tmp_path / 'design.mat'
+    design_mat.write_text('/NumWaves 2\n/NumPoints 4\n/Matrix\n1 0\n1 0\n0 1\n0 1\n')
+    check_design(str(design_mat), 4)
+    with pytest.raises(ValueError, match='has 4 rows but the cohort has 5 subjects'):
+        check_design(str(design_mat), 5)
+
+    design_mat.write_text('/NumWaves 2\n/Matrix\n1 0\n')
+    with pytest.raises(ValueError, match='no /NumPoints'):
+        check_design(str(design_mat), 1)
+
+
+def test_save_and_load(tmp_path):
+    work_dir = tmp_path / 'work'
+    work_dir.mkdir()
+    (work_dir / 'affine_template.nii').write_bytes(b'affine')
+    (work_dir / 'template_sum.nii.gz').write_bytes(b'sum')
+    outputs = {'affine_template_file': str(work_dir / 'affine_template.nii'),
+               'nonlinear_sum_file': str(work_dir / 'template_sum.nii.gz'), 'nonlinear_count': 3}
+    state_dir = str(tmp_path / 'cohort_state')
+
+    save_cohort(state_dir, PREVIOUS, outputs)
+    state = load_cohort(state_dir)
+    assert state['struct_files'] == PREVIOUS
+    assert has_templates(state)
+    # Copied out of the working directory, keeping their format
+    assert state['templates']['affine']['template_file'] == os.path.join(state_dir, 'affine_template.nii')
+    assert state['templates']['nonlinear'] == {'sum_file': os.path.join(state_dir, 'nonlinear_sum.nii.gz'),
+                                               'count': 3}
+    with open(state['templates']['nonlinear']['sum_file'], 'rb') as fileobj:
+        assert fileobj.read() == b'sum'
+    with open(os.path.join(state_dir, 'struct_files.txt')) as fileobj:
+        assert fileobj.read().split() == PREVIOUS
+
+    # A later run passes the stored affine template through, which stays in place
+    struct_files = PREVIOUS + ['/data/sub04.nii.gz']
+    (work_dir / 'template_sum.nii.gz').write_bytes(b'sum4')
+    affine_template_file = state['templates']['affine']['template_file']
+    save_cohort(state_dir, struct_files, dict(outputs, affine_template_file=affine_template_file, nonlinear_count=4))
+    with open(os.path.join(state_dir, STATE_FILE)) as fileobj:
+        state = json.load(fileobj)
+    assert state['struct_files'] == struct_files
+    assert state['templates']['nonlinear']['count'] == 4
+    with open(state['templates']['affine']['template_file'], 'rb') as fileobj:
+        assert fileobj.read() == b'affine'
@@ -0,0 +1,235 @@
+import os
+import sys
+
+import nibabel as nib
+import numpy as np
+import pytest
+from scipy import ndimage
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import standins
+from nipypeVBM.interfaces import CombineRandomise, GeneratePriors, GenerateTemplate, ModulateSmooth, \
+    SingleWarpCompositeTransformUtil, SkippableRegistration
+from nipypeVBM.registration import configure_registration
+
+
+def _write(path, data, zooms=(2.0, 2.0, 2.0)):
+    nib.Nifti1Image(data.astype(np.float32), np.diag(list(zooms) + [1.0])).to_filename(str(path))
+    return str(path)
+
+
+def _baseline_template(vol_data, flip_axis=0):
+    """Whole-array mean of the volumes and of their flipped versions"""
+    if flip_axis == -1:
+        return np.average(vol_data, axis=-1)
+    return (np.average(vol_data, axis=-1) + np.average(np.flip(vol_data, axis=flip_axis), axis=-1)) / 2
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3])
+def test_generate_template_4d(tmp_path, chunk_size):
+    vol_data = np.random.default_rng(0).uniform(0, 1, (6, 7, 5, 5))
+    in_file = _write(tmp_path / 'gm_4d.nii.gz', vol_data)
+
+    outputs = GenerateTemplate(input_file=in_file, chunk_size=chunk_size).run(cwd=str(tmp_path)).outputs
+
+    expected = _baseline_template(vol_data.astype(np.float32))
+    np.testing.assert_allclose(nib.load(outputs.template_file).get_fdata(), expected, rtol=1e-6)
+    np.testing.assert_allclose(nib.load(outputs.sum_file).get_fdata(), vol_data.astype(np.float32).sum(axis=-1),
+                               rtol=1e-6)
+    assert outputs.count == 5
+
+
+def test_generate_template_3d_files(tmp_path):
+    vol_data = np.random.default_rng(1).uniform(0, 1, (6, 7, 5, 3))
+    in_files = [_write(tmp_path / ('gm%d.nii.gz' % i), vol_data[..., i]) for i in range(3)]
+
+    outputs = GenerateTemplate(input_files=in_files, flip_axis=-1, output_type='NIFTI',
+                               output_name='GM_template').run(cwd=str(tmp_path)).outputs
+
+    assert outputs.template_file == str(tmp_path / 'GM_template.nii')
+    expected = _baseline_template(vol_data.astype(np.float32), flip_axis=-1)
+    np.testing.assert_allclose(nib.load(outputs.template_file).get_fdata(), expected, rtol=1e-6)
+
+
+def test_generate_template_prior_sum(tmp_path):
+    # Adding subjects to the running sum of a previous run gives the template of the whole cohort
+    vol_data = np.random.default_rng(2).uniform(0, 1, (6, 7, 5, 4))
+    in_files = [_write(tmp_path / ('gm%d.nii.gz' % i), vol_data[..., i]) for i in range(4)]
+    first_dir = tmp_path / 'first'
+    second_dir = tmp_path / 'second'
+    first_dir.mkdir()
+    second_dir.mkdir()
+
+    first = GenerateTemplate(input_files=in_files[:3]).run(cwd=str(first_dir)).outputs
+    second = GenerateTemplate(input_files=in_files[3:], prior_sum_file=first.sum_file,
+                              prior_count=first.count).run(cwd=str(second_dir)).outputs
+
+    assert second.count == 4
+    np.testing.assert_allclose(nib.load(second.template_file).get_fdata(),
+                               _baseline_template(vol_data.astype(np.float32)), rtol=1e-6)
+
+
+@pytest.mark.parametrize('output_type', ['NIFTI_GZ', 'NIFTI'])
+def test_generate_priors(tmp_path, output_type):
+    priors = np.random.default_rng(3).dirichlet(np.ones(4), (5, 6, 7))[..., :3]
+    prior_4d_file = _write(tmp_path / 'priors.nii.gz', priors)
+    reference_file = _write(tmp_path / 'sub01_brain.nii.gz', np.ones((5, 6, 7)))
+
+    outputs = GeneratePriors(reference_file=reference_file, prior_4D_file=prior_4d_file,
+                             output_type=output_type).run(cwd=str(tmp_path)).outputs
+
+    # Background first, then the classes of the 4D file in order, as Atropos reads them through prior_string
+    extension = '.nii' if output_type == 'NIFTI' else '.nii.gz'
+    assert outputs.prior_string == str(tmp_path / ('sub01_brain_prior%02d' + extension))
+    assert outputs.prior_3D_files == [outputs.prior_string % i for i in range(1, 5)]
+    expected = [1 - priors.astype(np.float32).sum(axis=-1)] + [priors[..., i] for i in range(3)]
+    for prior_file, expected_data in zip(outputs.prior_3D_files, expected):
+        prior_obj = nib.load(prior_file)
+        assert prior_obj.get_data_dtype() == np.float32
+        np.testing.assert_allclose(prior_obj.get_fdata(), expected_data, rtol=1e-5, atol=1e-6)
+
+
+def test_modulate_smooth(tmp_path):
+    rng = np.random.default_rng(0)
+    gm = [rng.uniform(0, 1, (8, 9, 10)) * (rng.uniform(0, 1, (8, 9, 10)) > 0.3) for _ in range(3)]
+    jac = [rng.uniform(0.5, 1.5, (8, 9, 10)) for _ in range(3)]
+    gm_files = [_write(tmp_path / ('gm%d.nii.gz' % i), d) for i, d in enumerate(gm)]
+    jac_files = [_write(tmp_path / ('jac%d.nii.gz' % i), d) for i, d in enumerate(jac)]
+
+    result = ModulateSmooth(gm_files=gm_files, jacobian_files=jac_files, sigma=[2, 4], mask_threshold=0.4,
+                            num_threads=2).run(cwd=str(tmp_path))
+
+    outputs = result.outputs
+    assert len(outputs.smoothed_files) == 2
+    for sigma, smoothed_file in zip([2, 4], outputs.smoothed_files):
+        smoothed = nib.load(smoothed_file).get_fdata()
+        assert smoothed.shape == (8, 9, 10, 3)
+        for i in range(3):
+            expected = ndimage.gaussian_filter((gm[i] * jac[i]).astype(np.float32), sigma / 2.0, mode='constant')
+            np.testing.assert_allclose(smoothed[..., i], expected, rtol=1e-5, atol=1e-6)
+
+    mean = np.mean([d.astype(np.float32) for d in gm], axis=0)
+    np.testing.assert_array_equal(nib.load(outputs.mask_file).get_fdata(), mean >= 0.4)
+
+
+def test_modulate_smooth_uncompressed(tmp_path):
+    gm_files = [_write(tmp_path / ('gm%d.nii' % i), np.full((4, 4, 4), 0.5)) for i in range(2)]
+    jac_files = [_write(tmp_path / ('jac%d.nii' % i), np.full((4, 4, 4), 2.0)) for i in range(2)]
+
+    outputs = ModulateSmooth(gm_files=gm_files, jacobian_files=jac_files, sigma=[2],
+                             compression=0).run(cwd=str(tmp_path)).outputs
+
+    # A single output collapses to a file name
+    assert outputs.smoothed_files.endswith('_s2.nii') and outputs.mask_file.endswith('GM_mask.nii')
+    expected = ndimage.gaussian_filter(np.ones((4, 4, 4), np.float32), 1.0, mode='constant')
+    np.testing.assert_allclose(nib.load(outputs.smoothed_files).get_fdata()[..., 1], expected, rtol=1e-5)
+
+
+def _write_shard(shard_dir, tfce, null_dist, raw=True):
+    shard_dir.mkdir()
+    _write(shard_dir / 'GM_tfce_p_tstat1.nii.gz', np.full((3, 3, 3), 0.5))
+    _write(shard_dir / 'GM_tfce_corrp_tstat1.nii.gz', np.zeros((3, 3, 3)))
+    _write(shard_dir / 'GM_tstat1.nii.gz', tfce)
+    if raw:
+        _write(shard_dir / 'GM_tfce_tstat1.nii.gz', tfce)
+    np.savetxt(str(shard_dir / 'GM_perm_tfce_tstat1.txt'), null_dist)
+    return str(shard_dir / 'GM_tstat1.nii.gz')
+
+
+def test_combine_randomise(tmp_path):
+    tfce = np.arange(27, dtype=np.float32).reshape(3, 3, 3)
+    # Both shards evaluate the unpermuted labelling first, its maximum is counted once
+    shard_files = [_write_shard(tmp_path / 'shard0', tfce, [26, 5, 30]),
+                   _write_shard(tmp_path / 'shard1', tfce, [26, 10, 20])]
+    mask = _write(tmp_path / 'mask.nii.gz', np.ones((3, 3, 3)))
+    out_dir = tmp_path / 'combine'
+    out_dir.mkdir()
+
+    outputs = CombineRandomise(shard_tstat_files=shard_files, shard_num_perms=[3, 3], base_name='GM',
+                               mask=mask).run(cwd=str(out_dir)).outputs
+
+    corrp = nib.load(str(out_dir / 'GM_tfce_corrp_tstat1.nii.gz')).get_fdata()
+    null_dist = np.array([26, 5, 30, 10, 20])
+    expected = 1 - (null_dist[None, :] >= tfce.ravel()[:, None]).mean(axis=1)
+    np.testing.assert_allclose(corrp.ravel(), expected, rtol=1e-6)
+    assert str(out_dir / 'GM_tfce_corrp_tstat1.nii.gz') in outputs.out_files
+    assert outputs.t_corrected_p_files == [str(out_dir / 'GM_tfce_corrp_tstat1.nii.gz')]
+    assert outputs.t_p_files == [str(out_dir / 'GM_tfce_p_tstat1.nii.gz')]
+
+
+def test_combine_randomise_without_raw_tfce(tmp_path):
+    tfce = np.ones((3, 3, 3))
+    shard_files = [_write_shard(tmp_path / ('shard%d' % i), tfce, [1, 2], raw=False) for i in range(2)]
+    mask = _write(tmp_path / 'mask.nii.gz', np.ones((3, 3, 3)))
+
+    with pytest.raises(ValueError, match='-R'):
+        CombineRandomise(shard_tstat_files=shard_files, shard_num_perms=[2, 2], base_name='GM',
+                         mask=mask).run(cwd=str(tmp_path))
+
+
+def _write_composite(tmp_path, fixed_file):
+    # The stand-in of CompositeTransformUtil writes the field on the grid recorded in the composite
+    composite = tmp_path / 'Composite.h5'
+    composite.write_text('#Insight Transform File V1.0\n#Fixed: %s\n' % fixed_file)
+    return str(composite)
+
+
+def test_single_warp_composite(tmp_path, monkeypatch):
+    for name, value in standins.install(str(tmp_path / 'standins')).items():
+        monkeypatch.setenv(name, value)
+    composite = _write_composite(tmp_path, _write(tmp_path / 'template.nii.gz', np.ones((3, 3, 3))))
+
+    outputs = SingleWarpCompositeTransformUtil(process='disassemble', in_file=composite,
+                                               output_prefix='transform').run(cwd=str(tmp_path)).outputs
+    assert outputs.displacement_field == str(tmp_path / '01_transform_DisplacementFieldTransform.nii.gz')
+
+    # A second field that ANTs did not collapse into the first one
+    run_dir = tmp_path / 'run'
+    run_dir.mkdir()
+    (run_dir / '02_transform_DisplacementFieldTransform.nii.gz').write_bytes(b'')
+    with pytest.raises(ValueError, match='02_transform_DisplacementFieldTransform'):
+        SingleWarpCompositeTransformUtil(process='disassemble', in_file=composite,
+                                         output_prefix='transform').run(cwd=str(run_dir))
+
+
+def _skippable_registration(tmp_path, skip):
+    fixed_file = _write(tmp_path / 'template.nii.gz', np.ones((3, 3, 3)))
+    previous = {name: str(tmp_path / ('previous_' + name)) for name in ['Warped.nii.gz', 'Composite.h5',
+                                                                       'InverseComposite.h5']}
+    for previous_file in previous.values():
+        with open(previous_file, 'w'):
+            pass
+    registration = SkippableRegistration(fixed_image=fixed_file, moving_image=_write(tmp_path / 'gm.nii.gz',
+                                                                                     np.ones((3, 3, 3))),
+                                         write_composite_transform=True, output_warped_image='Warped.nii.gz',
+                                         skip=skip,
+                                         previous_warped_image=previous['Warped.nii.gz'],
+                                         previous_composite_transform=previous['Composite.h5'],
+                                         previous_inverse_composite_transform=previous['InverseComposite.h5'])
+    configure_registration(registration, 'refine')
+    return registration, previous
+
+
+def test_skippable_registration_skip(tmp_path, monkeypatch):
+    # Skipping must not run antsRegistration, which is not on the PATH
+    monkeypatch.setenv('PATH', str(tmp_path))
+    registration, previous = _skippable_registration(tmp_path, True)
+
+    outputs = registration.run(cwd=str(tmp_path)).outputs
+    assert outputs.warped_image == previous['Warped.nii.gz']
+    assert outputs.composite_transform == previous['Composite.h5']
+    assert outputs.inverse_composite_transform == previous['InverseComposite.h5']
+    assert outputs.forward_transforms == [previous['Composite.h5']]
+    assert outputs.reverse_transforms == [previous['InverseComposite.h5']]
+    assert not os.path.exists(str(tmp_path / 'Warped.nii.gz'))
+
+
+def test_skippable_registration_runs(tmp_path, monkeypatch):
+    for name, value in standins.install(str(tmp_path / 'standins')).items():
+        monkeypatch.setenv(name, value)
+    registration, previous = _skippable_registration(tmp_path, False)
+
+    outputs = registration.run(cwd=str(tmp_path)).outputs
+    assert outputs.composite_transform == str(tmp_path / 'transformComposite.h5')
+    assert outputs.warped_image == str(tmp_path / 'Warped.nii.gz')
@@ -0,0 +1,70 @@
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from nipypeVBM.isolation import _generate_template, _read_fsl_matrix, filter_design
+
+
+def _write_design(tmp_path, contrasts):
+    design_mat = tmp_path / 'design.mat'
+    design_mat.write_text('/NumWaves 3\n/NumPoints 4\n/Matrix\n1 0 30\n1 0 40\n0 1 20\n0 1 50\n')
+    tcon = tmp_path / 'design.con'
+    tcon.write_text('/NumWaves 3\n/NumContrasts %d\n/Matrix\n%s\n'
+                    % (len(contrasts), '\n'.join(' '.join(str(w) for w in c) for c in contrasts)))
+    return str(design_mat), str(tcon)
+
+
+def test_filter_design_keeps_rows_and_contrasts(tmp_path):
+    design_mat, tcon = _write_design(tmp_path, [[1, -1, 0], [0, 0, 1]])
+    out_mat, out_con = filter_design(design_mat, tcon, [0, 2, 3], str(tmp_path / 'out'))
+
+    np.testing.assert_array_equal(_read_fsl_matrix(out_mat), [[1, 0, 30], [0, 1, 20], [0, 1, 50]])
+    np.testing.assert_array_equal(_read_fsl_matrix(out_con), [[1, -1, 0], [0, 0, 1]])
+
+
+def test_filter_design_drops_contrasts_of_removed_evs(tmp_path):
+    # The second group is gone, so the group differences cannot be tested any more
+    design_mat, tcon = _write_design(tmp_path, [[1, -1, 0], [-1, 1, 0], [0, 0, 1]])
+    out_mat, out_con = filter_design(design_mat, tcon, [0, 1], str(tmp_path / 'out'))
+
+    np.testing.assert_array_equal(_read_fsl_matrix(out_mat), [[1, 30], [1, 40]])
+    np.testing.assert_array_equal(_read_fsl_matrix(out_con), [[0, 1]])
+
+
+def test_filter_design_without_contrast_left(tmp_path):
+    design_mat, tcon = _write_design(tmp_path, [[1, -1, 0]])
+    with pytest.raises(ValueError):
+        filter_design(design_mat, tcon, [0, 1], str(tmp_path / 'out'))
+
+
+def test_filter_design_keeps_unchanged_files(tmp_path):
+    # A rewritten design would have a new timestamp and rerun randomise on --resume
+    design_mat, tcon = _write_design(tmp_path, [[1, -1, 0]])
+    out_files = filter_design(design_mat, tcon, [0, 2, 3], str(tmp_path / 'out'))
+    for f in out_files:
+        os.utime(f, ns=(0, 0))
+
+    assert filter_design(design_mat, tcon, [0, 2, 3], str(tmp_path / 'out')) == out_files
+    assert [os.stat(f).st_mtime_ns for f in out_files] == [0, 0]
+
+    filter_design(design_mat, tcon, [0, 1, 2], str(tmp_path / 'out'))
+    assert os.stat(out_files[0]).st_mtime_ns != 0
+
+
+def test_generate_template_reused_on_resume(tmp_path):
+    warped_files = []
+    for i in range(2):
+        warped_files.append(str(tmp_path / ('warped%d.nii.gz' % i)))
+        nib.Nifti1Image(np.full((4, 4, 4), i, np.float32), np.eye(4)).to_filename(warped_files[-1])
+    out_dir = str(tmp_path / 'templates' / 'affine')
+
+    template_file = _generate_template(out_dir, warped_files)
+    mtime = os.stat(template_file).st_mtime_ns
+    np.testing.assert_allclose(nib.load(template_file).get_fdata(), 0.5)
+    assert _generate_template(out_dir, warped_files) == template_file
+    assert os.stat(template_file).st_mtime_ns == mtime
+
+    nib.Nifti1Image(np.full((4, 4, 4), 3, np.float32), np.eye(4)).to_filename(warped_files[1])
+    np.testing.assert_allclose(nib.load(_generate_template(out_dir, warped_files)).get_fdata(), 1.5)
@@ -0,0 +1,34 @@
+import nipype.interfaces.ants as ants
+import pytest
+
+from nipypeVBM.registration import REGISTRATION_PROFILES, configure_registration
+
+ROLES = ['atlas', 'affine', 'nonlinear', 'refine']
+
+
+@pytest.mark.parametrize('profile', sorted(REGISTRATION_PROFILES))
+@pytest.mark.parametrize('role', ROLES)
+def test_profile_builds_cmdline(tmp_path, profile, role):
+    for image in ['fixed.nii.gz', 'moving.nii.gz']:
+        (tmp_path / image).write_bytes(b'')
+    registration = ants.Registration(fixed_image=str(tmp_path / 'fixed.nii.gz'),
+                                     moving_image=str(tmp_path / 'moving.nii.gz'))
+    configure_registration(registration, role, profile)
+
+    # Every per-stage input has one entry per stage
+    num_stages = len(REGISTRATION_PROFILES[profile][role])
+    for name in ['transforms', 'transform_parameters', 'metric', 'metric_weight', 'radius_or_number_of_bins',
+                 'sampling_strategy', 'sampling_percentage', 'number_of_iterations', 'convergence_threshold',
+                 'convergence_window_size', 'smoothing_sigmas', 'sigma_units', 'shrink_factors']:
+        assert len(getattr(registration.inputs, name)) == num_stages, name
+    for stage in REGISTRATION_PROFILES[profile][role]:
+        assert len(stage['smoothing_sigmas']) == len(stage['shrink_factors']) == len(stage['number_of_iterations'])
+
+    cmdline = registration.cmdline
+    assert cmdline.count('--transform ') == num_stages
+    assert ('--float 1' in cmdline) == REGISTRATION_PROFILES[profile]['float']
+
+
+def test_unknown_profile():
+    with pytest.raises(ValueError, match='Unknown registration profile'):
+        configure_registration(ants.Registration(), 'nonlinear', 'fastest')
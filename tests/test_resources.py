@@ -0,0 +1,74 @@
+import pytest
+
+from nipypeVBM.resources import NodeResources, configure_scheduler, estimate_resources
+from nipypeVBM.workflows import create_bet_workflow, create_proc_workflow
+
+N_VOXELS = 2 ** 20
+
+
+def test_estimate_multithreaded():
+    # 8 CPUs over 4 subjects: 4 registrations at once with 2 threads each
+    n_procs, mem_gb = estimate_resources('deformable_priors', 4, N_VOXELS, 8)
+    assert n_procs == 2
+    assert mem_gb == pytest.approx(0.5 + 400 / 2 ** 10)
+
+    # Only 2 copies fit in 2 GB, so each gets half of the CPUs
+    n_procs, _ = estimate_resources('deformable_priors', 16, N_VOXELS, 8, max_mem_gb=2)
+    assert n_procs == 4
+
+
+def test_estimate_single_threaded_and_cohort():
+    assert estimate_resources('fsl_bet', 4, N_VOXELS, 8) == (1, pytest.approx(0.3 + 20 / 2 ** 10))
+    # randomise holds the whole cohort, capped by the budget
+    assert estimate_resources('randomise', 100, N_VOXELS, 8)[1] == pytest.approx(0.5 + 100 * 12 / 2 ** 10)
+    assert estimate_resources('randomise', 100, N_VOXELS, 8, max_mem_gb=1) == (1, 1)
+
+
+def test_estimate_pooled():
+    n_procs, mem_gb = estimate_resources('gm_mod_smooth', 4, N_VOXELS, 8, max_mem_gb=0.3 + 3 * 16 / 2 ** 10)
+    assert n_procs == 3
+    assert mem_gb == pytest.approx(0.3 + 3 * 16 / 2 ** 10)
+
+
+def test_estimate_unknown_node():
+    assert estimate_resources('input_node', 4, N_VOXELS, 8) is None
+    assert NodeResources(4, N_VOXELS, 8)('input_node') == {}
+
+
+def test_nodes_sized_on_creation(tmp_path):
+    resources = NodeResources(4, N_VOXELS, 8)
+    wf = create_proc_workflow(str(tmp_path), resources=resources)
+    registration = wf.get_node('nonlinear_reg_to_temp')
+    assert registration.n_procs == 2
+    assert registration.inputs.num_threads == 2
+    assert registration.mem_gb == pytest.approx(0.5 + 400 / 2 ** 10)
+    assert wf.get_node('final_randomise').mem_gb == pytest.approx(0.5 + 4 * 12 / 2 ** 10)
+
+    # Without resources the nipype defaults are kept
+    assert create_proc_workflow(str(tmp_path)).get_node('nonlinear_reg_to_temp').n_procs == 1
+
+
+def test_estimate_cluster_jobs():
+    # Cluster jobs do not share the CPUs, each registration gets all of them
+    assert estimate_resources('deformable_priors', 4, N_VOXELS, 8, shared=False)[0] == 8
+    assert NodeResources(16, N_VOXELS, 8, max_mem_gb=2, shared=False)('deformable_priors')['n_procs'] == 8
+
+
+def test_scheduler_plugin_args(tmp_path):
+    resources = NodeResources(2, N_VOXELS, 8, shared=False)
+    wf = create_bet_workflow(str(tmp_path), resources=resources)
+    configure_scheduler(wf, 'SLURM', '-p short')
+    assert wf.get_node('fsl_bet').plugin_args == {'sbatch_args': '-p short --cpus-per-task=1 --mem=1G',
+                                                  'overwrite': True}
+    assert wf.get_node('input_node').plugin_args == {}
+
+    wf = create_proc_workflow(str(tmp_path), resources=resources)
+    configure_scheduler(wf, 'SGE')
+    # 8 threads of 0.9 GB in total, h_vmem is per slot
+    registration = wf.get_node('nonlinear_reg_to_temp')
+    assert registration.plugin_args == {'qsub_args': ' -pe smp 8 -l h_vmem=1G', 'overwrite': True}
+    assert registration.inputs.num_threads == 8
+
+    wf = create_bet_workflow(str(tmp_path), resources=resources)
+    configure_scheduler(wf, 'MultiProc')
+    assert wf.get_node('fsl_bet').plugin_args == {}
@@ -0,0 +1,53 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import phantoms
+import standins
+from nipypeVBM.resources import NodeResources
+from nipypeVBM.service import BatchService, WorkflowCache, submit
+
+
+def test_submitted_study_runs(tmp_path, monkeypatch):
+    for name, value in standins.install(str(tmp_path / 'standins')).items():
+        monkeypatch.setenv(name, value)
+    atlas_image, atlas_priors, gm_template = phantoms.make_atlas(str(tmp_path / 'atlas'), 12)
+    struct_files = phantoms.make_subjects(str(tmp_path / 'subjects'), 12, 4)
+    design_mat, tcon = phantoms.make_design(str(tmp_path / 'design'), 4)
+
+    # Relative paths are taken from the directory of the manifest
+    manifest_file = tmp_path / 'study.json'
+    manifest_file.write_text(json.dumps({
+        'struct_files': [os.path.relpath(f, str(tmp_path)) for f in struct_files], 'GM_template': gm_template,
+        'design_mat': design_mat, 'tcon': tcon, 'output_root': 'output', 'owner': 'test'}))
+    queue_dir = str(tmp_path / 'queue')
+    queued = submit(str(manifest_file), queue_dir)
+
+    service = BatchService(queue_dir, atlas_image=atlas_image, atlas_priors=atlas_priors)
+    service.serve(poll_interval=0.1, exit_when_idle=True)
+
+    name = os.path.basename(queued).split('.json')[0]
+    with open(os.path.join(queue_dir, 'done', name + '.result.json')) as fileobj:
+        result = json.load(fileobj)
+    assert result['exitcode'] == 0 and 'error' not in result
+    assert os.path.exists(os.path.join(queue_dir, 'done', name + '.json'))
+    assert os.listdir(os.path.join(queue_dir, 'incoming')) == os.listdir(os.path.join(queue_dir, 'running')) == []
+    assert os.path.isdir(str(tmp_path / 'output' / 'nipypevbm'))
+
+
+def test_workflow_cache_sizes_copies(tmp_path):
+    atlas_image, atlas_priors, _ = phantoms.make_atlas(str(tmp_path / 'atlas'), 12)
+    options = {'atlas_image': atlas_image, 'atlas_priors': atlas_priors}
+    workflows = WorkflowCache(str(tmp_path / 'work'))
+    small = workflows.get(options, str(tmp_path / 'small'), NodeResources(2, 2 ** 20, 8))
+    large = workflows.get(options, str(tmp_path / 'large'), NodeResources(8, 2 ** 20, 8))
+    # Studies of different sizes share the built workflow
+    assert len(workflows._workflows) == 1
+
+    name = 'fslvbm_2_template.deformable_priors'
+    assert small.get_node(name).n_procs == 4
+    assert large.get_node(name).n_procs == 1
+    assert small.get_node('fslvbm_3_proc.final_randomise').mem_gb < large.get_node(
+        'fslvbm_3_proc.final_randomise').mem_gb
@@ -0,0 +1,55 @@
+import os
+import sys
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import phantoms
+from nipypeVBM.workflows import _template_change, create_nipypevbm_workflow, create_preproc_workflow
+
+
+def _write(path, data):
+    nib.Nifti1Image(data.astype(np.float32), np.eye(4)).to_filename(str(path))
+    return str(path)
+
+
+def test_template_change(tmp_path):
+    previous_data = np.random.default_rng(0).uniform(0.5, 1, (6, 7, 5))
+    previous_file = _write(tmp_path / 'previous.nii.gz', previous_data)
+    template_file = _write(tmp_path / 'template.nii.gz', previous_data * 1.05)
+
+    # Relative change of the whole image, compared to the threshold
+    converged, change = _template_change(template_file, previous_file, 0.01, False)
+    assert change == pytest.approx(0.05, rel=1e-5)
+    assert not converged
+    assert _template_change(_write(tmp_path / 'close.nii.gz', previous_data * 1.001), previous_file, 0.01,
+                            False)[0]
+
+    # Once converged the remaining iterations stay skipped, whatever the change
+    assert _template_change(template_file, previous_file, 0.01, True)[0]
+
+
+def test_template_iterations_skip_on_convergence(tmp_path):
+    atlas_image, atlas_priors, _ = phantoms.make_atlas(str(tmp_path / 'atlas'), 8)
+    wf = create_preproc_workflow(str(tmp_path), template_iterations=3, atlas_image=atlas_image,
+                                 atlas_priors=atlas_priors)
+
+    first, second = wf.get_node('template_change_iter2'), wf.get_node('template_change_iter3')
+    assert first.inputs.converged is False
+    assert ('converged', 'converged') in wf._graph.get_edge_data(first, second)['connect']
+    for iteration, check in [(2, first), (3, second)]:
+        registration = wf.get_node('nonlinear_reg_to_temp_iter%d' % iteration)
+        assert ('converged', 'skip') in wf._graph.get_edge_data(check, registration)['connect']
+
+
+def test_frozen_template_preview_is_downsampled(tmp_path):
+    atlas_image, atlas_priors, _ = phantoms.make_atlas(str(tmp_path / 'atlas'), 8)
+    wf = create_nipypevbm_workflow(str(tmp_path), preview=True, freeze_template=True, atlas_image=atlas_image,
+                                   atlas_priors=atlas_priors)
+
+    connections = wf._graph.get_edge_data(wf.get_node('fslvbm_1_downsample'),
+                                          wf.get_node('fslvbm_3_proc_preview'))['connect']
+    assert ('output_node.study_template', 'input_node.GM_template') in connections